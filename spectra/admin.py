@@ -1,27 +1,70 @@
 # spectra/admin.py
 from django.contrib import admin
-from .models import Material, Spectrum
+from .models import ChemSpiderLookup, Material, ProcessingJob, ProcessingProfile, Spectrum, SpectrumPeak
+from .processing import SUMMARY_FIELDS
 
 
 @admin.register(Material)
 class MaterialAdmin(admin.ModelAdmin):
-    list_display = ('name', 'description')
+    list_display = ('name', 'description', 'chemspider_csid')
     search_fields = ('name',)
 
 
+class SpectrumPeakInline(admin.TabularInline):
+    # Detected from the absorption coefficient, see spectra.models.store_peaks
+    model = SpectrumPeak
+    extra = 0
+    can_delete = False
+    readonly_fields = ('frequency', 'height', 'width', 'prominence')
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(Spectrum)
 class SpectrumAdmin(admin.ModelAdmin):
-    list_display = ('material', 'uploaded_by', 'upload_timestamp')
-    list_filter = ('material', 'uploaded_by', 'upload_timestamp')
+    inlines = [SpectrumPeakInline]
+    list_display = ('material', 'uploaded_by', 'upload_timestamp', 'processing_profile')
+    list_filter = ('material', 'uploaded_by', 'upload_timestamp', 'processing_profile')
     search_fields = ('material__name', 'notes')
-    readonly_fields = ('upload_timestamp',)
+    readonly_fields = ('upload_timestamp', 'processing_profile', 'sample_thickness') + SUMMARY_FIELDS
 
     fieldsets = (
         (None, {'fields': ('material', 'metadata', 'notes')}),
+        ('Processing', {'fields': ('processing_profile', 'sample_thickness')}),
+        # Computed from the arrays, see spectra.processing.summarize_spectrum
+        ('Data summary', {'fields': SUMMARY_FIELDS, 'classes': ('collapse',)}),
         ('Upload Information (auto-set)', {'fields': ('uploaded_by', 'upload_timestamp'), 'classes': ('collapse',)}),
     )
 
     def save_model(self, request, obj, form, change):
         if not obj.pk:  # When creating a new object
             obj.uploaded_by = request.user
-        super().save_model(request, obj, form, change)
\ No newline at end of file
+        super().save_model(request, obj, form, change)
+
+
+@admin.register(ProcessingProfile)
+class ProcessingProfileAdmin(admin.ModelAdmin):
+    list_display = ('version', 'description', 'created_at')
+
+    def get_readonly_fields(self, request, obj=None):
+        # Profiles are versioned: once saved their parameters only change by creating a new version
+        if obj is not None:
+            return ('version', 'parameters', 'created_at')
+        return ('created_at',)
+
+
+@admin.register(ProcessingJob)
+class ProcessingJobAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'material_name', 'uploaded_by', 'status', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    search_fields = ('material_name', 'original_filename', 'content_sha256')
+    readonly_fields = ('created_at', 'started_at', 'finished_at', 'spectrum', 'staging_key', 'content_sha256')
+
+
+@admin.register(ChemSpiderLookup)
+class ChemSpiderLookupAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'key', 'found', 'csid', 'fetched_at')
+    list_filter = ('kind', 'found')
+    search_fields = ('key',)
+    exclude = ('image',)
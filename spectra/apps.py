@@ -2,4 +2,9 @@ from django.apps import AppConfig
 
 class SpectraConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'spectra'
\ No newline at end of file
+    name = 'spectra'
+
+    def ready(self):
+        # Connects the signal handlers that discard cached exports of deleted spectra, keep the
+        # similarity and full-text search indexes up to date and renew cached facet counts
+        from . import export, facets, search, similarity  # noqa: F401
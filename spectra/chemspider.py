@@ -0,0 +1,188 @@
+"""
+ChemSpider lookups (compound name -> CSID, CSID -> structure image) with a persistent cache.
+
+Results are cached in the database (ChemSpiderLookup), including searches without a result, so uploads of known
+materials do not make any network calls. The service itself is reached through a pluggable backend selected
+by the CHEMSPIDER_BACKEND setting:
+
+- LiveChemSpiderBackend (default) talks to the RSC API with request timeouts.
+- FixtureChemSpiderBackend answers from a local JSON file (CHEMSPIDER_FIXTURES) and never uses the network,
+  for tests and air-gapped deployments. `manage.py export_chemspider_fixture` writes such a file from the cache.
+"""
+import base64
+import json
+import logging
+import time
+from datetime import timedelta
+from functools import lru_cache
+
+import requests
+from chemspipy import ChemSpider
+from chemspipy.errors import ChemSpiPyError
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from dotenv import dotenv_values
+
+from .models import ChemSpiderLookup
+
+logger = logging.getLogger(__name__)
+
+env_values = dotenv_values("spectra/backend.env")
+RSC_API_KEY = env_values.get('RSC_API_KEY')
+
+DEFAULT_BACKEND = 'spectra.chemspider.LiveChemSpiderBackend'
+DEFAULT_TIMEOUT = 10
+DEFAULT_NEGATIVE_TTL = 7 * 24 * 3600
+
+
+class ChemSpiderUnavailable(Exception):
+    """The lookup could not be answered (network error, timeout, missing API key); nothing is cached."""
+
+
+def normalize_name(name):
+    return ' '.join(str(name).split()).lower()
+
+
+class ChemSpiderBackend:
+    """Interface of ChemSpider backends. Both methods return None if there is no result."""
+
+    def find_csid(self, name):
+        raise NotImplementedError
+
+    def get_image(self, csid):
+        raise NotImplementedError
+
+
+class _TimeoutSession(requests.Session):
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(*args, **kwargs)
+
+
+class LiveChemSpiderBackend(ChemSpiderBackend):
+    FAILED_STATUSES = {'Failed', 'Unknown', 'Suspended', 'Not Found'}
+
+    def __init__(self, api_key=None, timeout=None):
+        self.api_key = api_key or RSC_API_KEY
+        self.timeout = timeout or getattr(settings, 'CHEMSPIDER_TIMEOUT', DEFAULT_TIMEOUT)
+        self._cs = None
+
+    @property
+    def cs(self):
+        if not self.api_key:
+            raise ChemSpiderUnavailable("No RSC_API_KEY configured.")
+        if self._cs is None:
+            self._cs = ChemSpider(self.api_key)
+            # chemspipy does not set request timeouts, a hanging connection would block the upload forever
+            user_agent = self._cs.http.headers['User-Agent']
+            self._cs.http = _TimeoutSession(self.timeout)
+            self._cs.http.headers['User-Agent'] = user_agent
+        return self._cs
+
+    def find_csid(self, name):
+        # Same requests as ChemSpider.search, but polled in this thread and bounded by the timeout
+        deadline = time.monotonic() + self.timeout
+        try:
+            query_id = self.cs.filter_name(name)
+            while True:
+                status = self.cs.filter_status(query_id)
+                if status['status'] == 'Complete':
+                    break
+                if status['status'] in self.FAILED_STATUSES:
+                    raise ChemSpiderUnavailable(f"Search failed: {status.get('message', '')}")
+                if time.monotonic() > deadline:
+                    raise ChemSpiderUnavailable("Search took too long.")
+                time.sleep(0.2)
+            if not status.get('count'):
+                return None
+            results = self.cs.filter_results(query_id, count=1)
+        except (ChemSpiPyError, requests.RequestException) as e:
+            raise ChemSpiderUnavailable(f"{type(e).__name__}: {e}") from e
+        return int(results[0]) if results else None
+
+    def get_image(self, csid):
+        try:
+            return self.cs.get_image(csid) or None
+        except (ChemSpiPyError, requests.RequestException) as e:
+            raise ChemSpiderUnavailable(f"{type(e).__name__}: {e}") from e
+
+
+class FixtureChemSpiderBackend(ChemSpiderBackend):
+    """
+    Offline stand-in answering from a JSON file:
+    {"names": {"lactose": 5951, "unknown stuff": null}, "images": {"5951": "<base64 encoded PNG>"}}
+    Names and CSIDs missing from the file have no result.
+    """
+
+    def __init__(self, path=None, data=None):
+        if data is None:
+            path = path or getattr(settings, 'CHEMSPIDER_FIXTURES', None)
+            data = {}
+            if path:
+                with open(path) as f:
+                    data = json.load(f)
+        self.names = {normalize_name(name): csid for name, csid in data.get('names', {}).items()}
+        self.images = {str(csid): image for csid, image in data.get('images', {}).items()}
+
+    def find_csid(self, name):
+        csid = self.names.get(normalize_name(name))
+        return int(csid) if csid is not None else None
+
+    def get_image(self, csid):
+        image = self.images.get(str(csid))
+        return base64.b64decode(image) if image else None
+
+
+@lru_cache(maxsize=None)
+def get_backend():
+    return import_string(getattr(settings, 'CHEMSPIDER_BACKEND', DEFAULT_BACKEND))()
+
+
+def _is_fresh(entry):
+    if entry.found:
+        ttl = getattr(settings, 'CHEMSPIDER_CACHE_TTL', None)
+    else:
+        ttl = getattr(settings, 'CHEMSPIDER_NEGATIVE_TTL', DEFAULT_NEGATIVE_TTL)
+    return ttl is None or entry.fetched_at >= timezone.now() - timedelta(seconds=ttl)
+
+
+def _cached_lookup(kind, key, fetch):
+    """Return the cached entry for (kind, key), fetching and storing it if it is missing or expired."""
+    entry = ChemSpiderLookup.objects.filter(kind=kind, key=key).first()
+    if entry is not None and _is_fresh(entry):
+        return entry
+    try:
+        values = fetch()
+    except ChemSpiderUnavailable as e:
+        logger.warning("ChemSpider %s lookup for '%s' failed: %s", kind, key, e)
+        # An expired entry is still better than nothing while the service is unavailable
+        return entry
+    entry, _ = ChemSpiderLookup.objects.update_or_create(
+        kind=kind, key=key,
+        defaults=dict(values, found=any(v is not None for v in values.values()), fetched_at=timezone.now()),
+    )
+    return entry
+
+
+def find_csid(name, backend=None):
+    """CSID of the first ChemSpider hit for a compound name, or None."""
+    key = normalize_name(name or '')
+    if not key:
+        return None
+    backend = backend or get_backend()
+    entry = _cached_lookup(ChemSpiderLookup.KIND_NAME, key[:255], lambda: {'csid': backend.find_csid(name)})
+    return entry.csid if entry is not None and entry.found else None
+
+
+def get_structure_image(csid, backend=None):
+    """PNG structure image of a ChemSpider record, or None."""
+    backend = backend or get_backend()
+    entry = _cached_lookup(
+        ChemSpiderLookup.KIND_IMAGE, str(csid), lambda: {'image': backend.get_image(csid)}
+    )
+    return bytes(entry.image) if entry is not None and entry.found else None
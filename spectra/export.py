@@ -0,0 +1,247 @@
+"""
+Export of spectra as dotTHz files, one spectrum per file or many as measurements of one file or as a zip archive.
+
+Generated single-spectrum files are cached on disk (EXPORT_CACHE_ROOT), one per spectrum. The file name contains a hash of
+everything that goes into the export besides the arrays (spectrum id, last change, material and uploader name),
+so a changed spectrum gets a new file and a cache hit needs neither the array columns nor HDF5. Older files of
+the same spectrum are removed when a new one is written, and all of them when the spectrum is deleted.
+
+Bulk exports read the spectra in batches (keyset pagination, one query for the arrays of a batch), so memory use
+does not depend on the number of exported spectra. Zip archives are streamed while they are being built.
+"""
+import hashlib
+import io
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from pydotthz import DotthzFile, DotthzMeasurement, DotthzMetaData
+
+from .models import RAW_ARRAY_FIELDS, Spectrum, load_arrays
+
+# Bump to invalidate all cached exports, e.g. after changes to the file layout
+EXPORT_VERSION = 1
+# Spectra read per query by bulk exports
+EXPORT_BATCH_SIZE = 50
+CHUNK_SIZE = 1024 * 1024
+
+# Known standard metadata fields of pydotthz.DotthzMetaData
+STANDARD_META_FIELDS = (
+    'user', 'email', 'institution', 'orcid', 'description',
+    'date', 'time', 'version', 'instrument', 'mode',
+)
+
+
+def export_filename(spectrum):
+    return f"{spectrum.material.name.replace(' ', '_')}_{spectrum.pk}.thz"
+
+
+def measurement_name(spectrum):
+    return f"{spectrum.material.name.replace(' ', '_')}_ID{spectrum.pk}"
+
+
+def _trace(time_values, pulse_values):
+    """(n, 2) array of a raw trace, or None if it is empty."""
+    if not len(time_values) or not len(pulse_values):
+        return None
+    return np.column_stack((time_values, pulse_values)).astype(np.float64, copy=False)
+
+
+def build_measurement(spectrum):
+    """DotthzMeasurement with the raw traces and metadata of a spectrum (deferred raw arrays load in one query)."""
+    measurement = DotthzMeasurement()
+    measurement.datasets = {}
+
+    meta_data = DotthzMetaData()
+    # Populate metadata from spectrum.metadata
+    if spectrum.metadata:
+        for key, value in spectrum.metadata.items():
+            if value is None:  # Skip None values or pydotthz might error
+                continue
+            if key in STANDARD_META_FIELDS:
+                setattr(meta_data, key, str(value))  # Ensure value is string if expected
+            else:
+                meta_data.md[key] = value
+
+    if not meta_data.description and spectrum.notes:  # If not set from metadata, use notes
+        meta_data.description = spectrum.notes
+    elif not meta_data.description:
+        meta_data.description = f"Exported data for {spectrum.material.name}"
+
+    # Ensure some key identifiers from the database are in the custom metadata
+    meta_data.md["DatabaseSpectrumID"] = spectrum.pk
+    meta_data.md["DatabaseMaterialName"] = spectrum.material.name
+    meta_data.md["DatabaseUploadTimestamp"] = spectrum.upload_timestamp.isoformat()
+    if spectrum.uploaded_by is not None:
+        meta_data.md["DatabaseUploadUser"] = spectrum.uploaded_by.username
+    if spectrum.notes:
+        meta_data.md["DatabaseNotes"] = spectrum.notes
+
+    sample = _trace(spectrum.raw_sample_data_t, spectrum.raw_sample_data_p)
+    if sample is not None:
+        measurement.datasets["Sample"] = sample
+    reference = _trace(spectrum.raw_reference_data_t, spectrum.raw_reference_data_p)
+    if reference is not None:
+        measurement.datasets["Reference"] = reference
+
+    measurement.meta_data = meta_data
+    return measurement
+
+
+def write_spectra(target, spectra):
+    """Write spectra as measurements of one dotTHz file. `target` is a path or a writable binary file object."""
+    with DotthzFile(target, "w") as f:
+        for spectrum in spectra:
+            f.write_measurement(measurement_name(spectrum), build_measurement(spectrum))
+
+
+def export_cache_root():
+    """Directory of cached exports, or None if EXPORT_CACHE_ROOT is not set."""
+    root = getattr(settings, 'EXPORT_CACHE_ROOT', None)
+    if not root:
+        return None
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    return root
+
+
+def export_cache_key(spectrum):
+    """Changes whenever the exported file would change; only needs the summary columns of the spectrum."""
+    uploader = spectrum.uploaded_by.username if spectrum.uploaded_by_id else ''
+    payload = '\0'.join((
+        str(EXPORT_VERSION), str(spectrum.pk), spectrum.updated_at.isoformat(), spectrum.material.name, uploader,
+    ))
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def _discard_cached_exports(root, pk, keep=None):
+    for path in root.glob(f"{pk}-*.thz"):
+        if path.name != keep:
+            path.unlink(missing_ok=True)
+
+
+def _cache_path(root, spectrum):
+    return root / f"{spectrum.pk}-{export_cache_key(spectrum)}.thz"
+
+
+def cached_spectrum_export(spectrum):
+    """
+    Path of the cached dotTHz export of a spectrum, writing it first if needed.
+    Returns None if the export cache is disabled.
+    """
+    root = export_cache_root()
+    if root is None:
+        return None
+    path = _cache_path(root, spectrum)
+    name = path.name
+    if path.exists():
+        return path
+
+    fd, partial = tempfile.mkstemp(dir=root, suffix='.part')
+    os.close(fd)
+    try:
+        write_spectra(partial, [spectrum])
+        os.replace(partial, path)
+    except BaseException:
+        Path(partial).unlink(missing_ok=True)
+        raise
+    _discard_cached_exports(root, spectrum.pk, keep=name)
+    return path
+
+
+def iter_spectra(queryset, batch_size=EXPORT_BATCH_SIZE, with_arrays=True):
+    """
+    Iterate over the spectra of a queryset in id order, reading `batch_size` rows per query
+    (with their raw arrays unless `with_arrays` is False).
+    """
+    queryset = queryset.select_related('material', 'uploaded_by').order_by('pk')
+    if with_arrays:
+        queryset = queryset.with_arrays(*RAW_ARRAY_FIELDS)
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return
+        yield from batch
+        last_pk = batch[-1].pk
+
+
+def write_multi_measurement_export(queryset, target):
+    """Write all spectra of a queryset as measurements of one dotTHz file."""
+    write_spectra(target, iter_spectra(queryset))
+
+
+class _ZipStream(io.RawIOBase):
+    """Unseekable sink for zipfile; the written bytes are taken out with `pop` and sent to the client."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip_export(queryset, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Generator of the bytes of a zip archive with one dotTHz file per spectrum of the queryset.
+    Files come from the export cache where possible; the arrays of the other spectra of a batch are read in one
+    query. At most one spectrum file is held in memory at a time.
+    """
+    stream = _ZipStream()
+    root = export_cache_root()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED) as archive:
+        batch = []
+        for spectrum in iter_spectra(queryset, batch_size=batch_size, with_arrays=False):
+            batch.append(spectrum)
+            if len(batch) < batch_size:
+                continue
+            yield from _write_zip_batch(archive, stream, root, batch)
+            batch = []
+        yield from _write_zip_batch(archive, stream, root, batch)
+    yield stream.pop()
+
+
+def _write_zip_batch(archive, stream, root, batch):
+    if root is not None:
+        load_arrays([spectrum for spectrum in batch if not _cache_path(root, spectrum).exists()], RAW_ARRAY_FIELDS)
+    else:
+        load_arrays(batch, RAW_ARRAY_FIELDS)
+    for spectrum in batch:
+        path = cached_spectrum_export(spectrum)
+        if path is not None:
+            source = open(path, 'rb')
+        else:
+            source = io.BytesIO()
+            write_spectra(source, [spectrum])
+            source.seek(0)
+        with source, archive.open(export_filename(spectrum), 'w') as member:
+            while chunk := source.read(CHUNK_SIZE):
+                member.write(chunk)
+                yield stream.pop()
+
+
+@receiver(post_delete, sender=Spectrum, dispatch_uid='spectra_discard_cached_exports')
+def discard_exports_of_deleted_spectrum(sender, instance, **kwargs):
+    root = export_cache_root()
+    if root is not None:
+        _discard_cached_exports(root, instance.pk)
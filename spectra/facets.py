@@ -0,0 +1,232 @@
+"""
+Facet counts of the spectrum list: how many of the spectra matching the current filters (SpectrumFilterForm) belong
+to each material, uploader, upload month and value of the metadata keys in FACET_METADATA_KEYS.
+
+Every facet is one grouped aggregate query over the filtered queryset (metadata values are counted on the indexed
+SpectrumMetadataEntry table). Results are kept in Django's cache for FACET_CACHE_TIMEOUT seconds; the cache key
+holds a generation that is renewed whenever a spectrum or material is saved or deleted and after bulk writes
+(invalidate_facet_counts), and the highest spectrum id, so uploads stored by another process (the `process_jobs`
+worker) are seen as well, even with per-process caches. Bulk changes made by management commands reach the
+counts of the web server through a cache shared between processes, or once the cached counts expire.
+
+All facets of a request together get FACET_TIME_BUDGET seconds. Queries still running then are interrupted (SQLite
+progress handler, PostgreSQL statement_timeout) and their facets are None, with `complete` false, so the list itself
+is never held up by its facets. Incomplete results are cached as well; the next request with the same filters
+only computes the missing facets, with a budget of its own.
+"""
+import copy
+import datetime
+import hashlib
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Case, Count, IntegerField, Max, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Material, Spectrum, SpectrumMetadataEntry
+
+# Values listed per facet: the most frequent ones, and the most recent months
+FACET_SIZE = 10
+DEFAULT_METADATA_KEYS = ('instrument', 'institution', 'mode')
+GENERATION_KEY = 'spectrum-facets:generation'
+# Virtual machine instructions between two deadline checks of SQLite
+SQLITE_PROGRESS_STEPS = 10000
+
+
+def facet_metadata_keys():
+    return tuple(getattr(settings, 'FACET_METADATA_KEYS', DEFAULT_METADATA_KEYS))
+
+
+def _entry(value, label, count, **params):
+    """One facet value; `params` are the SpectrumFilterForm parameters that select it."""
+    return {'value': value, 'label': label, 'count': count, 'params': params}
+
+
+def _material_facet(queryset):
+    # Grouped by the foreign key alone, an index scan; names are read for the listed materials only
+    rows = list(queryset.values_list('material_id').annotate(count=Count('pk')).order_by('-count', 'material_id')
+                [:FACET_SIZE])
+    names = dict(Material.objects.filter(pk__in=[pk for pk, _ in rows]).values_list('pk', 'name'))
+    return [_entry(pk, names.get(pk, ''), count, material=pk) for pk, count in rows]
+
+
+def _uploader_facet(queryset):
+    # Spectra of deleted users count as uploader 0 and are left out. Grouping by the expression rather than the
+    # column also keeps SQLite from walking the uploader index, which reads the filtered rows one by one.
+    rows = [
+        (pk, count) for pk, count in queryset.annotate(uploader=Coalesce('uploaded_by_id', Value(0)))
+        .values_list('uploader').annotate(count=Count('pk')).order_by('-count', 'uploader')[:FACET_SIZE + 1] if pk
+    ][:FACET_SIZE]
+    names = dict(User.objects.filter(pk__in=[pk for pk, _ in rows]).values_list('pk', 'username'))
+    return [_entry(pk, names.get(pk, ''), count, uploader=pk) for pk, count in rows]
+
+
+def _month_facet(queryset):
+    """
+    The FACET_SIZE months (in the current time zone) up to the latest upload. Rows are assigned to months by
+    comparing their timestamp with the month boundaries, as the database's date functions (TruncMonth) are
+    evaluated row by row in Python on SQLite and take seconds for 100k spectra.
+    """
+    latest = queryset.aggregate(latest=Max('upload_timestamp'))['latest']
+    if latest is None:
+        return []
+    latest = timezone.localtime(latest)
+    starts = []  # First day of each month, latest first
+    year, month = latest.year, latest.month
+    for _ in range(FACET_SIZE):
+        starts.append(datetime.date(year, month, 1))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    boundaries = [timezone.make_aware(datetime.datetime.combine(start, datetime.time())) for start in starts]
+
+    rows = dict(
+        queryset.filter(upload_timestamp__gte=boundaries[-1])
+        .annotate(month=Case(*[When(upload_timestamp__gte=boundary, then=Value(index))
+                               for index, boundary in enumerate(boundaries)], output_field=IntegerField()))
+        .values_list('month').annotate(count=Count('pk')).order_by()
+    )
+    facet = []
+    for index, start in enumerate(starts):
+        if rows.get(index):
+            end = (starts[index - 1] if index else (start + datetime.timedelta(days=31)).replace(day=1))
+            facet.append(_entry(
+                start.strftime('%Y-%m'), start.strftime('%B %Y'), rows[index],
+                upload_date_from_or_exact=start.isoformat(),
+                upload_date_to=(end - datetime.timedelta(days=1)).isoformat(),
+            ))
+    return facet
+
+
+def _metadata_facets(queryset, keys, filtered):
+    """
+    The most frequent values of each metadata key, from one query over the entries of all keys, which reads the
+    filtered spectra once instead of once per key. Meant for keys with few distinct values.
+    """
+    entries = SpectrumMetadataEntry.objects.filter(key__in=keys).exclude(value_text='')
+    if filtered:
+        entries = entries.filter(spectrum_id__in=queryset.values('pk'))
+    facets = {key: [] for key in keys}
+    for key, value, count in entries.values_list('key', 'value_text').annotate(count=Count('pk')).order_by(
+            'key', '-count', 'value_text'):
+        if len(facets[key]) < FACET_SIZE:
+            facets[key].append(_entry(value, value, count, meta_key=key, meta_value=value, meta_match='exact'))
+    return facets
+
+
+@contextmanager
+def _time_limit(using, seconds):
+    """Interrupt the queries of the block once `seconds` have passed; they raise a DatabaseError."""
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        connection.ensure_connection()
+        deadline = time.monotonic() + seconds
+        connection.connection.set_progress_handler(lambda: time.monotonic() > deadline, SQLITE_PROGRESS_STEPS)
+        try:
+            yield
+        finally:
+            connection.connection.set_progress_handler(None, 0)
+    elif connection.vendor == 'postgresql':
+        # In a savepoint: a cancelled query rolls back to it, which also restores the previous timeout
+        with transaction.atomic(using=using):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT current_setting('statement_timeout')")
+                previous = cursor.fetchone()[0]
+                cursor.execute("SELECT set_config('statement_timeout', %s, true)", [str(max(1, int(seconds * 1000)))])
+            yield
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT set_config('statement_timeout', %s, true)", [previous])
+    else:
+        yield
+
+
+def _generation():
+    # A timestamp rather than a counter, so a generation evicted from the cache is never reused
+    return cache.get_or_set(GENERATION_KEY, time.time_ns, timeout=None)
+
+
+def _cache_key(form):
+    parameters = form.cleaned_data if form.is_valid() else {}
+    state = repr(sorted((name, value) for name, value in parameters.items() if value not in (None, '')))
+    latest = Spectrum.objects.aggregate(latest=Max('pk'))['latest']
+    return f'spectrum-facets:{_generation()}:{latest}:{hashlib.sha256(state.encode()).hexdigest()}'
+
+
+def facet_counts(form, queryset):
+    """
+    Facet counts of `queryset`, the spectra filtered with `form` (a SpectrumFilterForm):
+    {"complete": bool, "facets": {"material": [...], "uploaded_by": [...], "upload_month": [...],
+    "metadata": {key: [...]}}}. Each facet lists values as {"value", "label", "count", "params"}, where `params`
+    are the filter parameters that select the value; facets that ran out of time (all metadata keys together) are
+    None.
+    """
+    key = _cache_key(form)
+    names = ('material', 'uploaded_by', 'upload_month', 'metadata')
+    result = cache.get(key) or {'complete': False, 'facets': dict.fromkeys(names)}
+    if result['complete']:
+        return result
+
+    queryset = queryset.order_by()
+    # Without filters the metadata values are counted on their index alone
+    filtered = bool(queryset.query.where)
+    facets = {
+        'material': lambda: _material_facet(queryset),
+        'uploaded_by': lambda: _uploader_facet(queryset),
+        'upload_month': lambda: _month_facet(queryset),
+        'metadata': lambda: _metadata_facets(queryset, facet_metadata_keys(), filtered),
+    }
+    # Only the facets a previous request ran out of time for are computed
+    deadline = time.monotonic() + getattr(settings, 'FACET_TIME_BUDGET', 0.5)
+    for name in names:
+        remaining = deadline - time.monotonic()
+        if result['facets'][name] is not None or remaining <= 0:
+            continue
+        try:
+            with _time_limit(queryset.db, remaining):
+                result['facets'][name] = facets[name]()
+        except DatabaseError:
+            pass
+    result['complete'] = all(values is not None for values in result['facets'].values())
+
+    cache.set(key, result, timeout=getattr(settings, 'FACET_CACHE_TIMEOUT', 600))
+    return result
+
+
+def with_queries(result, query_params):
+    """
+    A copy of a facet_counts result where every value also has the `query` string of the list filtered by it:
+    the current `query_params` (a QueryDict) with the value's parameters replacing their own.
+    """
+    result = copy.deepcopy(result)
+    facets = [result['facets'][name] for name in ('material', 'uploaded_by', 'upload_month')]
+    facets += list((result['facets']['metadata'] or {}).values())
+    for facet in facets:
+        for entry in facet or ():
+            params = query_params.copy()
+            params.pop('cursor', None)
+            for name, value in entry['params'].items():
+                params[name] = value
+            entry['query'] = params.urlencode()
+    return result
+
+
+def invalidate_facet_counts():
+    """
+    Renew the generation once the current transaction is committed; cached counts of earlier generations are never
+    read again and expire. Bulk writes (bulk_create, bulk_update, queryset updates, side tables) send no signals
+    and call this themselves.
+    """
+    transaction.on_commit(lambda: cache.set(GENERATION_KEY, time.time_ns(), timeout=None))
+
+
+@receiver(post_save, sender=Spectrum)
+@receiver(post_delete, sender=Spectrum)
+@receiver(post_save, sender=Material)
+@receiver(post_delete, sender=Material)
+def renew_facet_generation(sender, **kwargs):
+    invalidate_facet_counts()
@@ -0,0 +1,118 @@
+import json
+import struct
+
+import numpy as np
+from django.core import checks
+from django.db import models
+
+# Blob layout: 4 byte magic, 2 byte dtype code, 1 byte ndim, 1 byte padding,
+# followed by ndim little-endian uint64 dimensions and the raw array data.
+# The header is a multiple of 8 bytes, so float64 data stays aligned for np.frombuffer.
+ARRAY_MAGIC = b'NPA1'
+_HEADER = struct.Struct('<4s2sBx')
+_DIM = struct.Struct('<Q')
+
+SUPPORTED_DTYPES = {
+    'f8': np.dtype('<f8'),
+    'f4': np.dtype('<f4'),
+}
+
+
+def pack_array(values, dtype='f8'):
+    """Serialize a 1-d or n-d sequence of floats into the binary array blob format."""
+    np_dtype = SUPPORTED_DTYPES[dtype]
+    array = np.ascontiguousarray(values, dtype=np_dtype)
+    header = _HEADER.pack(ARRAY_MAGIC, dtype.encode('ascii'), array.ndim)
+    dims = b''.join(_DIM.pack(dim) for dim in array.shape)
+    return header + dims + array.tobytes()
+
+
+def unpack_array(blob):
+    """
+    Decode a binary array blob into a read-only NumPy array without copying the payload.
+    Legacy rows that still hold a JSON list (e.g. before `convert_spectrum_arrays` was run)
+    are decoded with json.loads instead.
+    """
+    if isinstance(blob, str):
+        return np.asarray(json.loads(blob), dtype=np.float64)
+    if not is_packed_array(blob):
+        return np.asarray(json.loads(bytes(blob)), dtype=np.float64)
+
+    _, dtype_code, ndim = _HEADER.unpack_from(blob, 0)
+    np_dtype = SUPPORTED_DTYPES[dtype_code.decode('ascii')]
+    offset = _HEADER.size
+    shape = []
+    for _ in range(ndim):
+        shape.append(_DIM.unpack_from(blob, offset)[0])
+        offset += _DIM.size
+    return np.frombuffer(blob, dtype=np_dtype, offset=offset).reshape(shape)
+
+
+def is_packed_array(blob):
+    """True if a raw database value is already stored in the binary array format."""
+    if not isinstance(blob, (bytes, bytearray, memoryview)):
+        return False
+    return memoryview(blob)[:len(ARRAY_MAGIC)] == ARRAY_MAGIC
+
+
+class NumpyArrayField(models.BinaryField):
+    """
+    Stores a float array as a little-endian binary blob with a dtype and shape header.
+    Values are returned as (read-only) NumPy arrays backed directly by the fetched bytes.
+    """
+    description = "Packed float array"
+
+    def __init__(self, *args, dtype='f8', **kwargs):
+        self.dtype = dtype
+        kwargs.setdefault('default', empty_array)
+        super().__init__(*args, **kwargs)
+
+    def check(self, **kwargs):
+        errors = super().check(**kwargs)
+        if self.dtype not in SUPPORTED_DTYPES:
+            errors.append(checks.Error(
+                f"Unsupported dtype '{self.dtype}', expected one of: {', '.join(SUPPORTED_DTYPES)}.",
+                obj=self,
+                id='spectra.E001',
+            ))
+        return errors
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.dtype != 'f8':
+            kwargs['dtype'] = self.dtype
+        if kwargs.get('default') is empty_array:
+            del kwargs['default']
+        return name, path, args, kwargs
+
+    def get_default(self):
+        # BinaryField compares the default against "", which is ambiguous for arrays.
+        return self._get_default()
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return unpack_array(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, np.ndarray):
+            return value
+        if isinstance(value, (bytes, bytearray, memoryview, str)):
+            return unpack_array(value)
+        return np.asarray(value, dtype=SUPPORTED_DTYPES[self.dtype])
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is None:
+            return None
+        if not is_packed_array(value):
+            value = pack_array(value, self.dtype)
+        return connection.Database.Binary(value)
+
+    def value_to_string(self, obj):
+        # Used by the serialization framework (dumpdata/loaddata); stay JSON friendly.
+        value = self.value_from_object(obj)
+        return json.dumps(value.tolist() if value is not None else None)
+
+
+def empty_array():
+    return np.empty(0, dtype=np.float64)
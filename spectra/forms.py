@@ -1,26 +1,48 @@
 # spectra/forms.py
+import datetime
 import json
 from django import forms
 from django.core.files.base import ContentFile
-from thzpy.timedomain import common_window
-from thzpy.transferfunctions import uniform_slab
 import re
 from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils import timezone
 
-from .models import Spectrum, Material
-import pydotthz
-# Removed: from pydotthz.core import Empty
-import numpy as np
-from dotenv import dotenv_values
-from chemspipy import ChemSpider
+from .models import Spectrum, SpectrumMetadataEntry, SpectrumPeak, Material
+from .chemspider import find_csid, get_structure_image
+from .processing import (
+    MAX_RESAMPLE_POINTS, build_plot_previews, find_absorption_peaks, parse_thz_file, summarize_spectrum,
+)
+from .search import search_spectra
+from .similarity import CURVES, METRICS
 
-env_values = dotenv_values("spectra/backend.env")
-RSC_API_KEY = env_values['RSC_API_KEY']
+
+def _start_of_day(date):
+    """Midnight of a date in the current time zone."""
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time()))
+
+
+# Summary columns of Spectrum with a range filter (`<column>_from`, `<column>_to`) in SpectrumFilterForm
+SUMMARY_RANGE_FILTERS = ('n_points', 'max_absorption', 'mean_refractive_index', 'time_window')
+# Sort orders of SpectrumFilterForm (`sort`) by summary columns
+SUMMARY_SORT_LABELS = {
+    'frequency_min': "Lowest frequency",
+    'frequency_max': "Highest frequency",
+    'n_points': "Number of points",
+    'max_absorption': "Max. absorption",
+    'mean_refractive_index': "Mean refractive index",
+    'time_window': "Time window",
+}
 
 
 class SpectrumFilterForm(forms.Form):
+    q = forms.CharField(label="Search", required=False,
+                        help_text="Material name and description, notes and metadata; best matches first.")
     name = forms.CharField(label="Material Name", required=False)
     uploaded_by = forms.CharField(label="Uploaded By", required=False)
+    # Exact selections of the facets (see spectra/facets.py), by id
+    material = forms.IntegerField(required=False, widget=forms.HiddenInput)
+    uploader = forms.IntegerField(required=False, widget=forms.HiddenInput)
     upload_date_from_or_exact = forms.DateField(
         required=False,
         label="Uploaded on/after",
@@ -30,6 +52,204 @@ class SpectrumFilterForm(forms.Form):
                                      widget=forms.DateInput(attrs={'type': 'date'}))
     meta_key = forms.CharField(label="Metadata Key", required=False)
     meta_value = forms.CharField(label="Metadata Value", required=False)
+    meta_match = forms.ChoiceField(label="Metadata Value Match", required=False,
+                                   choices=[('exact', 'Equals'), ('prefix', 'Starts with')])
+    meta_min = forms.FloatField(label="Metadata Value from", required=False,
+                                help_text="Numeric values, also with a unit (e.g. \"77 K\").")
+    meta_max = forms.FloatField(label="Metadata Value to", required=False)
+    peak_fmin = forms.FloatField(label="Absorption peak from (THz)", required=False, min_value=0)
+    peak_fmax = forms.FloatField(label="Absorption peak to (THz)", required=False, min_value=0)
+    peak_min_prominence = forms.FloatField(label="Min. peak prominence (cm⁻¹)", required=False, min_value=0)
+    coverage_from = forms.FloatField(label="Covers from (THz)", required=False, min_value=0,
+                                     help_text="Spectra whose frequency range reaches down to this frequency.")
+    coverage_to = forms.FloatField(label="Covers up to (THz)", required=False, min_value=0,
+                                   help_text="Spectra whose frequency range reaches up to this frequency.")
+    n_points_from = forms.IntegerField(label="Points from", required=False, min_value=0)
+    n_points_to = forms.IntegerField(label="Points to", required=False, min_value=0)
+    max_absorption_from = forms.FloatField(label="Max. absorption from (cm⁻¹)", required=False)
+    max_absorption_to = forms.FloatField(label="Max. absorption to (cm⁻¹)", required=False)
+    mean_refractive_index_from = forms.FloatField(label="Mean refractive index from", required=False)
+    mean_refractive_index_to = forms.FloatField(label="Mean refractive index to", required=False)
+    time_window_from = forms.FloatField(label="Time window from (ps)", required=False, min_value=0)
+    time_window_to = forms.FloatField(label="Time window to (ps)", required=False, min_value=0)
+    sort = forms.ChoiceField(
+        label="Sort by", required=False,
+        choices=[('', "Newest first")] + [
+            (f'{prefix}{column}', f"{label} ({direction})")
+            for column, label in SUMMARY_SORT_LABELS.items()
+            for prefix, direction in (('', 'ascending'), ('-', 'descending'))
+        ],
+        help_text="Spectra without the value are left out.",
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        for column in SUMMARY_RANGE_FILTERS:
+            low, high = cleaned_data.get(f'{column}_from'), cleaned_data.get(f'{column}_to')
+            if low is not None and high is not None and low > high:
+                raise ValidationError(
+                    f"The lower limit of {column.replace('_', ' ')} must not be larger than the upper one."
+                )
+        coverage_from, coverage_to = cleaned_data.get('coverage_from'), cleaned_data.get('coverage_to')
+        if coverage_from is not None and coverage_to is not None and coverage_from > coverage_to:
+            raise ValidationError("The lower covered frequency must not be larger than the upper one.")
+        peak_fmin, peak_fmax = cleaned_data.get('peak_fmin'), cleaned_data.get('peak_fmax')
+        if peak_fmin is not None and peak_fmax is not None and peak_fmin > peak_fmax:
+            raise ValidationError("The lower peak frequency must not be larger than the upper one.")
+        meta_min, meta_max = cleaned_data.get('meta_min'), cleaned_data.get('meta_max')
+        if meta_min is not None and meta_max is not None and meta_min > meta_max:
+            raise ValidationError("The lower metadata value must not be larger than the upper one.")
+        if not cleaned_data.get('meta_key') and (cleaned_data.get('meta_value') or meta_min is not None
+                                                 or meta_max is not None):
+            raise ValidationError("Metadata values can only be filtered together with a metadata key.")
+        return cleaned_data
+
+    def filter_queryset(self, queryset):
+        """Apply the filters to a Spectrum queryset. Returns the queryset unchanged if the form is not valid."""
+        if not self.is_valid():
+            return queryset
+        search = self.cleaned_data.get('q')
+        name = self.cleaned_data.get('name')
+        uploaded_by = self.cleaned_data.get('uploaded_by')
+        upload_date_from = self.cleaned_data.get('upload_date_from_or_exact')
+        upload_date_to = self.cleaned_data.get('upload_date_to')
+        meta_key = self.cleaned_data.get('meta_key')
+        meta_value = self.cleaned_data.get('meta_value')
+        meta_min = self.cleaned_data.get('meta_min')
+        meta_max = self.cleaned_data.get('meta_max')
+        peak_fmin = self.cleaned_data.get('peak_fmin')
+        peak_fmax = self.cleaned_data.get('peak_fmax')
+        peak_min_prominence = self.cleaned_data.get('peak_min_prominence')
+
+        if search:
+            found = search_spectra(queryset, search)
+            if found is None:
+                # No full-text index on this database
+                queryset = queryset.filter(
+                    Q(material__name__icontains=search) | Q(material__description__icontains=search)
+                    | Q(notes__icontains=search)
+                )
+            else:
+                # Best matches first (ties newest first), also for the API's cursor
+                queryset = found.order_by('search_rank', '-id')
+        if name:
+            queryset = queryset.filter(material__name__icontains=name)
+        if uploaded_by:
+            queryset = queryset.filter(uploaded_by__username__icontains=uploaded_by)
+        if self.cleaned_data.get('material') is not None:
+            queryset = queryset.filter(material_id=self.cleaned_data['material'])
+        if self.cleaned_data.get('uploader') is not None:
+            queryset = queryset.filter(uploaded_by_id=self.cleaned_data['uploader'])
+        # Ranges of the (indexed) timestamp from local midnight; a __date lookup converts every row on SQLite
+        if upload_date_from:
+            queryset = queryset.filter(upload_timestamp__gte=_start_of_day(upload_date_from))
+        if upload_date_to:
+            queryset = queryset.filter(upload_timestamp__lt=_start_of_day(upload_date_to + datetime.timedelta(days=1)))
+        if meta_key:
+            # Index lookups on the flattened metadata instead of parsing the JSON of every spectrum
+            entries = SpectrumMetadataEntry.objects.filter(key=meta_key)
+            if meta_value and self.cleaned_data.get('meta_match') == 'prefix':
+                # A range instead of LIKE, which cannot use the index on SQLite
+                entries = entries.filter(value_text__gte=meta_value, value_text__lt=meta_value + '\uffff')
+            elif meta_value:
+                entries = entries.filter(value_text=meta_value)
+            if meta_min is not None:
+                entries = entries.filter(value_num__gte=meta_min)
+            if meta_max is not None:
+                entries = entries.filter(value_num__lte=meta_max)
+            queryset = queryset.filter(pk__in=entries.values('spectrum_id'))
+        if peak_fmin is not None or peak_fmax is not None or peak_min_prominence is not None:
+            # Spectra with at least one peak in the window: a range scan on the peak index instead of the arrays
+            peaks = SpectrumPeak.objects.all()
+            if peak_fmin is not None:
+                peaks = peaks.filter(frequency__gte=peak_fmin)
+            if peak_fmax is not None:
+                peaks = peaks.filter(frequency__lte=peak_fmax)
+            if peak_min_prominence is not None:
+                peaks = peaks.filter(prominence__gte=peak_min_prominence)
+            queryset = queryset.filter(pk__in=peaks.values('spectrum_id'))
+        # Data properties come from the indexed summary columns, no array is read
+        for column in SUMMARY_RANGE_FILTERS:
+            low, high = self.cleaned_data.get(f'{column}_from'), self.cleaned_data.get(f'{column}_to')
+            if low is not None:
+                queryset = queryset.filter(**{f'{column}__gte': low})
+            if high is not None:
+                queryset = queryset.filter(**{f'{column}__lte': high})
+        if self.cleaned_data.get('coverage_from') is not None:
+            queryset = queryset.filter(frequency_min__lte=self.cleaned_data['coverage_from'])
+        if self.cleaned_data.get('coverage_to') is not None:
+            queryset = queryset.filter(frequency_max__gte=self.cleaned_data['coverage_to'])
+        ordering = self.ordering
+        if ordering:
+            # Takes precedence over the relevance order of `q`
+            queryset = queryset.filter(**{f'{ordering[0].lstrip("-")}__isnull': False}).order_by(*ordering)
+        return queryset
+
+    @property
+    def ordering(self):
+        """The order_by() arguments of the chosen `sort` (ties by id), or None for the default order."""
+        sort = self.cleaned_data.get('sort') if self.is_valid() else None
+        if not sort:
+            return None
+        return (sort, '-id' if sort.startswith('-') else 'id')
+
+
+class FrequencyRangeForm(forms.Form):
+    """Query parameters of the spectrum API that cut the processed arrays to a window and/or resample them."""
+    fmin = forms.FloatField(required=False, min_value=0, help_text="Lower frequency limit in THz.")
+    fmax = forms.FloatField(required=False, min_value=0, help_text="Upper frequency limit in THz.")
+    step = forms.FloatField(required=False, min_value=1e-6, help_text="Resample with this spacing in THz.")
+    n_points = forms.IntegerField(required=False, min_value=2, max_value=MAX_RESAMPLE_POINTS,
+                                  help_text="Resample to this number of evenly spaced points.")
+
+    def clean(self):
+        cleaned_data = super().clean()
+        fmin, fmax = cleaned_data.get('fmin'), cleaned_data.get('fmax')
+        if fmin is not None and fmax is not None and fmin > fmax:
+            raise ValidationError("fmin must not be larger than fmax.")
+        if cleaned_data.get('step') is not None and cleaned_data.get('n_points') is not None:
+            raise ValidationError("Only one of step and n_points can be given.")
+        return cleaned_data
+
+    @property
+    def parameters(self):
+        """The given parameters as keyword arguments of spectra.processing.resample_spectrum."""
+        return {name: value for name, value in self.cleaned_data.items() if value is not None}
+
+
+class SimilarityQueryForm(forms.Form):
+    """Options of similarity searches, see spectra/similarity.py."""
+    CURVE_CHOICES = [
+        ('both', 'Refractive index and absorption coefficient'),
+        ('refractive_index', 'Refractive index'),
+        ('absorption_coefficient', 'Absorption coefficient'),
+    ]
+
+    k = forms.IntegerField(required=False, min_value=1, max_value=100, help_text="Number of results (default 10).")
+    metric = forms.ChoiceField(required=False, choices=[(metric, metric) for metric in METRICS],
+                               help_text="cosine (default), correlation or l2.")
+    curves = forms.ChoiceField(required=False, choices=CURVE_CHOICES)
+    fmin = forms.FloatField(required=False, min_value=0, help_text="Lower limit of the compared band in THz.")
+    fmax = forms.FloatField(required=False, min_value=0, help_text="Upper limit of the compared band in THz.")
+
+    def clean(self):
+        cleaned_data = super().clean()
+        fmin, fmax = cleaned_data.get('fmin'), cleaned_data.get('fmax')
+        if fmin is not None and fmax is not None and fmin > fmax:
+            raise ValidationError("fmin must not be larger than fmax.")
+        return cleaned_data
+
+    @property
+    def options(self):
+        """Keyword arguments of spectra.similarity.search_similar."""
+        curves = self.cleaned_data.get('curves') or 'both'
+        return {
+            'k': self.cleaned_data.get('k') or 10,
+            'metric': self.cleaned_data.get('metric') or 'cosine',
+            'curves': tuple(CURVES) if curves == 'both' else (curves,),
+            'fmin': self.cleaned_data.get('fmin'),
+            'fmax': self.cleaned_data.get('fmax'),
+        }
 
 
 def validate_material_name(value):
@@ -51,6 +271,28 @@ class SpectrumUploadForm(forms.ModelForm):
         required=False,
         help_text="Upload a single file (.thz) containing both spectral data and metadata."
     )
+    sample_thickness = forms.FloatField(
+        label="Sample Thickness (mm)",
+        required=False,
+        min_value=0,
+        help_text="Only needed if the file's metadata does not contain 'Sample Thickness (mm)'."
+    )
+    all_measurements = forms.BooleanField(
+        label="All measurements",
+        required=False,
+        help_text="Create one spectrum per measurement in the file (e.g. temperature or thickness series) "
+                  "instead of only for the first one."
+    )
+    find_similar = forms.BooleanField(
+        label="Find similar spectra",
+        required=False,
+        help_text="Show the most similar spectra of the library once the file is processed."
+    )
+    link_duplicate = forms.BooleanField(
+        label="Link duplicates",
+        required=False,
+        help_text="If an identical file was uploaded before, link to the existing spectrum instead of storing a copy."
+    )
     data_file = forms.FileField(
         label="Spectral Data File (CSV - Alternative)",
         required=False,
@@ -66,7 +308,10 @@ class SpectrumUploadForm(forms.ModelForm):
 
     class Meta:
         model = Spectrum
-        fields = ['material_name', 'binary_data_file', 'data_file', 'metadata_json_text', 'notes']
+        fields = [
+            'material_name', 'binary_data_file', 'sample_thickness', 'all_measurements', 'find_similar', 'link_duplicate',
+            'data_file', 'metadata_json_text', 'notes',
+        ]
 
     def __init__(self, *args, **kwargs):
         kwargs.pop('sample_choices', None)
@@ -75,205 +320,10 @@ class SpectrumUploadForm(forms.ModelForm):
 
     def _parse_binary_file(self, b_file, material_name_from_form, sample_thickness=None):
         """
-        Parses .thz binary files.
-        Extracts full metadata (converting pydotthz's Empty type to None) and processed spectral data.
-        The 'description' in metadata is initialized with material_name_from_form and overwritten by file metadata if present.
-        Raises ValidationError if multiple sample/reference datasets are found or if thickness is missing/invalid.
+        Parses .thz binary files, see spectra.processing.parse_thz_file.
         This method is intended to be called by the VIEW, passing the material_name from the form.
         """
-        cs = ChemSpider(RSC_API_KEY)
-
-        try:
-            b_file.seek(0)
-            with pydotthz.DotthzFile(b_file) as f:
-                measurement_keys = list(f.get_measurements().keys())
-                if not measurement_keys:
-                    raise forms.ValidationError("No measurements found in the .thz file.")
-                measurement_key = measurement_keys[0]
-                measurement = f.get_measurement(measurement_key)
-
-                dataset_keys = list(measurement.datasets.keys())
-                sample_candidates = [k for k in dataset_keys if "sample" in k.lower() or "measurement" in k.lower()]
-                ref_candidates = [k for k in dataset_keys if "ref" in k.lower()]
-
-                if len(sample_candidates) > 1:
-                    raise forms.ValidationError(
-                        f"Multiple sample datasets found: {', '.join(sample_candidates)}. Please ensure the file contains only one sample dataset."
-                    )
-                if len(ref_candidates) > 1:
-                    raise forms.ValidationError(
-                        f"Multiple reference datasets found: {', '.join(ref_candidates)}. Please ensure the file contains only one reference dataset."
-                    )
-
-                sample_key = sample_candidates[0] if sample_candidates else None
-                ref_key = ref_candidates[0] if ref_candidates else None
-
-                if not sample_key:
-                    raise forms.ValidationError(
-                        f"No sample dataset found. Available datasets: {', '.join(dataset_keys)}"
-                    )
-                if not ref_key:
-                    raise forms.ValidationError(
-                        f"No reference dataset found. Available datasets: {', '.join(dataset_keys)}"
-                    )
-
-                # Extract and sanitize full metadata
-                dotthz_meta = measurement.meta_data
-                if material_name_from_form:
-                    metadata_dict = {"content": material_name_from_form}
-                else:
-                    metadata_dict = {}
-
-                # Standard fields from DotthzMetaData attributes
-                standard_fields_map = {
-                    "user": "", "email": "", "orcid": "", "institution": "",
-                    "description": "", "version": "1.00", "mode": "",
-                    "instrument": "", "time": "", "date": ""
-                }
-                for field_name, default_val in standard_fields_map.items():
-                    val = getattr(dotthz_meta, field_name, default_val)
-                    # Check for pydotthz's Empty type by class name
-                    metadata_dict[field_name] = None if val.__class__.__name__ == 'Empty' else val
-
-                # Custom metadata from dotthz_meta.md dictionary
-                if hasattr(dotthz_meta, 'md') and isinstance(dotthz_meta.md, dict):
-                    for key, value in dotthz_meta.md.items():
-                        # This will overwrite standard fields if keys conflict.
-                        # Check for pydotthz's Empty type by class name
-                        metadata_dict[key] = None if value.__class__.__name__ == 'Empty' else value
-
-                # Ensure 'md' itself is not an Empty object if it was accessed directly
-                if 'md' in metadata_dict and metadata_dict['md'].__class__.__name__ == 'Empty':
-                    metadata_dict['md'] = {}
-
-                # Thickness extraction and validation
-                thickness_float = None
-                # Use .get() on metadata_dict to safely access potentially missing keys
-                thickness_value_from_meta = metadata_dict.get("Sample Thickness (mm)")
-
-                if thickness_value_from_meta is not None:  # Will be None if key missing or value was Empty
-                    try:
-                        # Handle cases where thickness might be a numpy type
-                        thickness_float = float(
-                            thickness_value_from_meta.item() if hasattr(thickness_value_from_meta,
-                                                                        'item') else thickness_value_from_meta
-                        )
-                    except (ValueError, TypeError):
-                        # Invalid format in metadata, thickness_float remains None.
-                        pass
-                if metadata_dict.get("content") is not None:
-                    content = metadata_dict.get("content")
-                    try:
-                        search_results = cs.search(content)  # Use the variable 'content'
-                        if search_results and search_results and search_results.count > 0:
-                            first_hit = search_results[0]
-                            if hasattr(first_hit, 'csid'):
-                                metadata_dict['chemspider_csid'] = first_hit.csid
-                                # print(f"Found CSID for '{content}': {first_hit.csid}")
-                        # else:
-                        # print(f"No ChemSpider results for '{content}'.")
-                    except Exception as e:
-                        # print(f"ChemSpider search error for '{content}': {e}")
-                        pass  # Optionally log error
-                else:
-                    # Fallback to lactose if no description, or remove this block if not needed
-                    pass
-                    # try:
-                    #     lactose_results = cs.search("lactose")
-                    #     if lactose_results and lactose_results and lactose_results.count > 0:
-                    #         first_lactose_hit = lactose_results[0]
-                    #         if hasattr(first_lactose_hit, 'csid'):
-                    #             metadata_dict['chemspider_csid'] = first_lactose_hit.csid
-                    #             print(f"Using fallback CSID for lactose: {first_lactose_hit.csid}")
-                    #     else:
-                    #         print("No ChemSpider results for fallback 'lactose'.")
-                    # except Exception as e:
-                    #     # print(f"ChemSpider search error for fallback 'lactose': {e}")
-                    #     pass
-
-                if thickness_float is None and sample_thickness is not None:
-                    try:
-                        thickness_float = float(sample_thickness)
-                    except (ValueError, TypeError):
-                        raise forms.ValidationError(
-                            f"Provided sample thickness override '{sample_thickness}' is not a valid number."
-                        )
-
-                if thickness_float is None:
-                    error_message_detail = ""
-                    if "Sample Thickness (mm)" in metadata_dict:  # Check original presence before sanitization
-                        original_meta_thickness = getattr(dotthz_meta.md, 'Sample Thickness (mm)',
-                                                          getattr(dotthz_meta, 'Sample Thickness (mm)',
-                                                                  None))  # Check both md and direct
-                        if original_meta_thickness is not None and original_meta_thickness.__class__.__name__ == 'Empty':
-                            error_message_detail = "Metadata 'Sample Thickness (mm)' was present but empty. "
-                        elif thickness_value_from_meta is None and original_meta_thickness is not None:  # It was present but not convertible
-                            error_message_detail = f"Metadata 'Sample Thickness (mm)' ('{original_meta_thickness}') could not be converted to a number. "
-                        # If thickness_value_from_meta is None and original_meta_thickness was also None, it means it wasn't in metadata_dict
-
-                    if not error_message_detail and "Sample Thickness (mm)" not in metadata_dict:
-                        error_message_detail = "Metadata 'Sample Thickness (mm)' not found in file. "
-
-                    if sample_thickness is None:
-                        error_message_detail += "And no override thickness was provided."
-
-                    final_error_message = (f"{error_message_detail.strip()} "
-                                           "Please ensure a valid thickness is available either in the file's metadata "
-                                           "or as an override parameter.")
-                    raise forms.ValidationError(final_error_message)
-
-                # Process spectral data
-                processed_sample, processed_reference = common_window(
-                    [measurement.datasets[sample_key], measurement.datasets[ref_key]],
-                    half_width=15, win_func="adapted blackman"
-                )
-                buffer = uniform_slab(
-                    thickness_float, processed_sample, processed_reference,
-                    upsampling=3, min_frequency=0.2, max_frequency=5, all_optical_constants=True
-                )
-
-                expected_keys = ["frequency", "refractive_index", "absorption_coefficient"]
-                for key in expected_keys:
-                    if key not in buffer:
-                        raise forms.ValidationError(f"Calculated buffer data is missing key: '{key}'.")
-
-                spectral_data_dict = {
-                    'frequency': list(buffer["frequency"]),
-                    'refractive_index': list(np.real(buffer["refractive_index"])),
-                    'absorption_coefficient': list(buffer["absorption_coefficient"])
-                }
-
-                spectral_data_dict['raw_sample_data_t'] = []
-                spectral_data_dict['raw_sample_data_p'] = []
-                spectral_data_dict['raw_reference_data_t'] = []
-                spectral_data_dict['raw_reference_data_p'] = []
-
-                raw_sample_obj = measurement.datasets[sample_key]
-                raw_reference_obj = measurement.datasets[ref_key]
-
-                sample_time = raw_sample_obj[:, 0]
-                sample_pulse = raw_sample_obj[:, 1]
-                reference_time = raw_reference_obj[:, 0]
-                reference_pulse = raw_reference_obj[:, 1]
-
-                spectral_data_dict['raw_sample_data_t'] = list(sample_time)
-                spectral_data_dict['raw_sample_data_p'] = list(sample_pulse)
-                spectral_data_dict['raw_reference_data_t'] = list(reference_time)
-                spectral_data_dict['raw_reference_data_p'] = list(reference_pulse)
-
-            return spectral_data_dict, metadata_dict
-        except KeyError as e:
-            raise forms.ValidationError(f"Error processing .thz file: Missing key: '{e.args[0]}'.")
-        except (IndexError, AttributeError) as e:
-            # import traceback # For debugging
-            # traceback.print_exc() # For debugging
-            raise forms.ValidationError(f"Error processing .thz file: Data structure error. Details: {e}")
-        except forms.ValidationError:  # Re-raise validation errors from this method
-            raise
-        except Exception as e:
-            # import traceback # For debugging
-            # traceback.print_exc() # For debugging
-            raise forms.ValidationError(f"Unexpected error processing .thz file: {type(e).__name__}: {e}")
+        return parse_thz_file(b_file, material_name_from_form, sample_thickness=sample_thickness)
 
     def clean(self):
         cleaned_data = super().clean()
@@ -284,7 +334,7 @@ class SpectrumUploadForm(forms.ModelForm):
         binary_file = cleaned_data.get('binary_data_file')
         data_file = cleaned_data.get('data_file')
 
-        if not binary_file and not data_file:
+        if not binary_file and not data_file and not getattr(self, 'staged_upload_from_view', None):
             if not (hasattr(self, 'parsed_spectral_data_from_view') and self.parsed_spectral_data_from_view):
                 self.add_error(None, "You must upload either a 'dotTHz file' or a 'Spectral Data File (CSV)'.")
 
@@ -301,42 +351,15 @@ class SpectrumUploadForm(forms.ModelForm):
 
     def save(self, commit=True):
         instance = super().save(commit=False)
-        cs_instance = ChemSpider(RSC_API_KEY)
 
         material_name_val = self.cleaned_data.get('material_name')
         final_metadata = getattr(self, 'final_metadata_from_view', {})
-
-        material_description_from_meta = final_metadata.get('description')
+        material_updated = False
 
         if material_name_val:
-            material, created = Material.objects.get_or_create(
-                name=material_name_val,
-                defaults={'description': material_description_from_meta or f'Material: {material_name_val}'}
-            )
+            material, material_updated = get_material_for_upload(material_name_val, final_metadata)
             instance.material = material
 
-            material_updated = False
-
-            if not created and material_description_from_meta and material.description != material_description_from_meta:
-                material.description = material_description_from_meta
-                material_updated = True
-
-            chemspider_csid = final_metadata.get('chemspider_csid')
-            # Check if image data is missing or if CSID changed (to allow updates)
-            if chemspider_csid:
-                try:
-                    image_bytes = cs_instance.get_image(chemspider_csid)
-                    if image_bytes:
-                        # Store bytes directly into BinaryField
-                        material.chemical_structure_image = image_bytes
-                        # Assuming the image from ChemSpider is PNG.
-                        # You might want to inspect image_bytes or get this info from API if possible.
-                        material.chemical_structure_image_content_type = 'image/png'
-                        material_updated = True
-                except Exception as e:
-                    print(f"Error fetching ChemSpider image for CSID {chemspider_csid}: {e}")
-                    pass  # Optionally log
-
             if material_updated:  # Save material if description or image changed
                 # The material instance needs to be saved before the spectrum instance if commit is True
                 # and material was updated. If commit is False, this will be handled by the caller.
@@ -345,29 +368,7 @@ class SpectrumUploadForm(forms.ModelForm):
                 elif not instance.pk:  # If spectrum is new, material needs saving if it was just created or updated
                     material.save()
 
-        parsed_spectral_data = getattr(self, 'parsed_spectral_data_from_view', None)
-        if parsed_spectral_data and isinstance(parsed_spectral_data, dict):
-            instance.spectral_data = parsed_spectral_data
-            instance.frequency_data = parsed_spectral_data.get("frequency", [])
-            instance.refractive_index_data = parsed_spectral_data.get("refractive_index", [])
-            instance.absorption_coefficient_data = parsed_spectral_data.get("absorption_coefficient", [])
-            instance.raw_sample_data_t = parsed_spectral_data.get("raw_sample_data_t", [])
-            instance.raw_sample_data_p = parsed_spectral_data.get("raw_sample_data_p", [])
-            instance.raw_reference_data_t = parsed_spectral_data.get("raw_reference_data_t", [])
-            instance.raw_reference_data_p = parsed_spectral_data.get("raw_reference_data_p", [])
-        else:
-            instance.spectral_data = {}
-            instance.frequency_data = []
-            instance.refractive_index_data = []
-            instance.absorption_coefficient_data = []
-
-        if final_metadata and isinstance(final_metadata, dict):
-            instance.metadata = final_metadata
-        else:
-            instance.metadata = {}
-
-        instance.refractive_index_data_available = bool(instance.refractive_index_data)
-        instance.absorption_coefficient_data_available = bool(instance.absorption_coefficient_data)
+        apply_parsed_data(instance, getattr(self, 'parsed_spectral_data_from_view', None), final_metadata)
 
         if commit:
             if material_updated and material.pk:
@@ -376,6 +377,163 @@ class SpectrumUploadForm(forms.ModelForm):
         return instance
 
 
+class ApiUploadForm(SpectrumUploadForm):
+    """SpectrumUploadForm of `api/upload/`: a .thz file only, plus optional metadata overrides."""
+    metadata = forms.JSONField(
+        required=False,
+        help_text="JSON object of metadata entries that replace (or add to) the values read from the file."
+    )
+
+    def clean_metadata(self):
+        metadata = self.cleaned_data.get('metadata')
+        if metadata is not None and not isinstance(metadata, dict):
+            raise ValidationError("Metadata must be a JSON object.")
+        return metadata or None
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('data_file'):
+            self.add_error('data_file', "The API only accepts .thz files (binary_data_file).")
+        elif not cleaned_data.get('binary_data_file'):
+            self.add_error('binary_data_file', "This field is required.")
+        return cleaned_data
+
+
+class MultipleFileInput(forms.ClearableFileInput):
+    allow_multiple_selected = True
+
+
+class MultipleFileField(forms.FileField):
+    """File field accepting several files, cleaned to a list of uploaded files."""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('widget', MultipleFileInput())
+        super().__init__(*args, **kwargs)
+
+    def clean(self, data, initial=None):
+        if isinstance(data, (list, tuple)):
+            return [super(MultipleFileField, self).clean(d, initial) for d in data]
+        return [super().clean(data, initial)]
+
+
+class BulkUploadForm(forms.Form):
+    files = MultipleFileField(
+        label="dotTHz files",
+        help_text="Select several .thz files, or a single .zip archive containing .thz files."
+    )
+    material_name = forms.CharField(
+        label="Material Name",
+        max_length=100,
+        required=False,
+        validators=[validate_material_name],
+        help_text="Optional. If empty, the material is taken from each file's metadata ('content') or file name."
+    )
+    sample_thickness = forms.FloatField(
+        label="Sample Thickness (mm)",
+        required=False,
+        min_value=0,
+        help_text="Only used for files whose metadata does not contain 'Sample Thickness (mm)'."
+    )
+    all_measurements = forms.BooleanField(
+        label="All measurements",
+        required=False,
+        help_text="Create one spectrum per measurement in the file (e.g. temperature or thickness series) "
+                  "instead of only for the first one."
+    )
+    link_duplicate = forms.BooleanField(
+        label="Link duplicates",
+        required=False,
+        help_text="Files that were uploaded before are linked to the existing spectrum instead of being stored again."
+    )
+    notes = forms.CharField(label="Notes", widget=forms.Textarea(attrs={'rows': 3}), required=False)
+
+
+def get_material_for_upload(material_name, final_metadata, backend=None):
+    """
+    Gets or creates the Material of an upload and applies the description and the ChemSpider structure image
+    of the file's 'content'. The CSID is stored in final_metadata['chemspider_csid'].
+    Lookups go through the cache in spectra/chemspider.py; a material that already has the image of its
+    CSID needs no lookup at all. Returns (material, updated); changes to the material are not saved.
+    """
+    material_description_from_meta = final_metadata.get('description')
+
+    material, created = Material.objects.get_or_create(
+        name=material_name,
+        defaults={'description': material_description_from_meta or f'Material: {material_name}'}
+    )
+    material_updated = False
+
+    if not created and material_description_from_meta and material.description != material_description_from_meta:
+        material.description = material_description_from_meta
+        material_updated = True
+
+    chemspider_csid = final_metadata.get('chemspider_csid')
+    content = final_metadata.get('content')
+    if not chemspider_csid and content:
+        if material.chemical_structure_image and material.chemspider_csid:
+            chemspider_csid = material.chemspider_csid
+        else:
+            chemspider_csid = find_csid(content, backend=backend)
+    if chemspider_csid:
+        final_metadata['chemspider_csid'] = chemspider_csid
+
+    # Only fetch the image if it is missing or the CSID changed (to allow updates)
+    if chemspider_csid and (not material.chemical_structure_image or material.chemspider_csid != chemspider_csid):
+        image_bytes = get_structure_image(chemspider_csid, backend=backend)
+        if image_bytes:
+            # Store bytes directly into BinaryField
+            material.chemical_structure_image = image_bytes
+            # Assuming the image from ChemSpider is PNG.
+            # You might want to inspect image_bytes or get this info from API if possible.
+            material.chemical_structure_image_content_type = 'image/png'
+            material.chemspider_csid = chemspider_csid
+            material_updated = True
+
+    return material, material_updated
+
+
+def apply_parsed_data(instance, parsed_spectral_data, final_metadata):
+    """Sets the arrays, metadata, availability flags and plot previews of a spectrum from parsed upload data."""
+    if parsed_spectral_data and isinstance(parsed_spectral_data, dict):
+        instance.spectral_data = parsed_spectral_data
+        instance.frequency_data = parsed_spectral_data.get("frequency", [])
+        instance.refractive_index_data = parsed_spectral_data.get("refractive_index", [])
+        instance.absorption_coefficient_data = parsed_spectral_data.get("absorption_coefficient", [])
+        instance.raw_sample_data_t = parsed_spectral_data.get("raw_sample_data_t", [])
+        instance.raw_sample_data_p = parsed_spectral_data.get("raw_sample_data_p", [])
+        instance.raw_reference_data_t = parsed_spectral_data.get("raw_reference_data_t", [])
+        instance.raw_reference_data_p = parsed_spectral_data.get("raw_reference_data_p", [])
+        instance.raw_data_hash = parsed_spectral_data.get("raw_data_hash", '')
+        instance.processing_hash = parsed_spectral_data.get("processing_hash", '')
+        instance.sample_thickness = parsed_spectral_data.get("sample_thickness")
+    else:
+        instance.spectral_data = {}
+        instance.frequency_data = []
+        instance.refractive_index_data = []
+        instance.absorption_coefficient_data = []
+
+    if final_metadata and isinstance(final_metadata, dict):
+        instance.metadata = final_metadata
+    else:
+        instance.metadata = {}
+
+    instance.refractive_index_data_available = len(instance.refractive_index_data) > 0
+    instance.absorption_coefficient_data_available = len(instance.absorption_coefficient_data) > 0
+    instance.plot_previews = build_plot_previews(
+        instance.frequency_data, instance.refractive_index_data, instance.absorption_coefficient_data
+    )
+    sample_time = parsed_spectral_data.get('raw_sample_data_t', []) if isinstance(parsed_spectral_data, dict) else []
+    for name, value in summarize_spectrum(
+        instance.frequency_data, instance.refractive_index_data, instance.absorption_coefficient_data, sample_time
+    ).items():
+        setattr(instance, name, value)
+    # Stored as SpectrumPeak rows when the spectrum is saved (see spectra.models.store_peaks)
+    peaks = parsed_spectral_data.get('peaks') if isinstance(parsed_spectral_data, dict) else None
+    if peaks is None:
+        peaks = find_absorption_peaks(instance.frequency_data, instance.absorption_coefficient_data)
+    instance.detected_peaks = peaks
+
+
 class MaterialForm(forms.ModelForm):
     class Meta:
         model = Material
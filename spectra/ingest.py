@@ -0,0 +1,267 @@
+"""
+Bulk ingest of many .thz files, used by the `bulk_ingest` management command and bulk upload jobs.
+
+Files are collected from directories, zip archives or plain paths, processed in parallel with
+`parse_thz_file` (or measurement by measurement with `process_measurement`) and the resulting spectra are
+inserted with bulk_create in batches.
+"""
+import os
+import re
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from django import forms
+from django.db import connection, transaction
+
+from .facets import invalidate_facet_counts
+from .forms import apply_parsed_data, get_material_for_upload, validate_material_name
+from .models import (
+    Spectrum, find_duplicate_spectrum, get_current_processing_profile, is_linkable_duplicate, store_metadata_entries,
+    store_peaks,
+)
+from .processing import parse_thz_file, process_measurement, read_thz_file
+from .processing_cache import get_processing_cache
+from .search import update_search_index
+from .similarity import update_similarity_index
+
+
+@dataclass
+class IngestResult:
+    """Outcome of ingesting a single file."""
+    source: str
+    spectrum_id: int = None
+    material_name: str = None
+    error: str = None
+    # Existing spectrum with identical raw traces; spectrum_id points to it as well if the file was linked
+    duplicate_of: int = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def as_dict(self):
+        return {
+            'source': self.source,
+            'spectrum_id': self.spectrum_id,
+            'material_name': self.material_name,
+            'error': self.error,
+            'duplicate_of': self.duplicate_of,
+        }
+
+
+@dataclass
+class IngestReport:
+    results: list = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def succeeded(self):
+        return sum(1 for result in self.results if result.ok)
+
+    @property
+    def failed(self):
+        return len(self.results) - self.succeeded
+
+    @property
+    def files_per_second(self):
+        return len(self.results) / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'elapsed_seconds': round(self.elapsed, 3),
+            'files': [result.as_dict() for result in self.results],
+        }
+
+
+def collect_thz_files(sources, extract_dir):
+    """
+    Expand directories (recursively), zip archives and single files into a list of (display name, path) pairs.
+    Zip members are extracted into `extract_dir`.
+    """
+    files = []
+    for source in sources:
+        source = Path(source)
+        if source.is_dir():
+            files.extend((str(path.relative_to(source)), str(path)) for path in sorted(source.rglob('*.thz')))
+        elif zipfile.is_zipfile(source):
+            with zipfile.ZipFile(source) as archive:
+                for index, info in enumerate(archive.infolist()):
+                    if info.is_dir() or not info.filename.lower().endswith('.thz'):
+                        continue
+                    # Never trust member paths, extract under a generated name
+                    target = Path(extract_dir) / f"{index}_{Path(info.filename).name}"
+                    with archive.open(info) as member, open(target, 'wb') as out:
+                        while chunk := member.read(1024 * 1024):
+                            out.write(chunk)
+                    files.append((info.filename, str(target)))
+        else:
+            files.append((source.name, str(source)))
+    return files
+
+
+def material_name_for_file(display_name, metadata_dict, material_name=None):
+    """Material name of an ingested file: the explicit name, the file's 'content' metadata or the file name."""
+    name = material_name or metadata_dict.get('content')
+    if not name:
+        name = re.sub(r'[^\w\-]+', '_', Path(display_name).stem).strip('_') or 'unknown'
+    return str(name)
+
+
+def ingest_files(files, uploaded_by=None, material_name=None, notes=None, sample_thickness=None,
+                 link_duplicates=False, all_measurements=False, metadata_overrides=None, profile=None, executor=None,
+                 workers=None, batch_size=100):
+    """
+    Process `files` ((display name, path) pairs, see collect_thz_files) in parallel and store one spectrum per file,
+    or with `all_measurements` one spectrum per measurement. Each file is read once in this process and its
+    measurements are processed in the pool; the spectra of one file are always inserted in the same transaction.
+    Files whose raw traces are already stored are reported as duplicates, and with `link_duplicates` they are
+    linked to the existing spectrum instead of being stored again.
+    Files are processed with the parameters of `profile` (default: the current ProcessingProfile).
+    `metadata_overrides` replace (or add to) the metadata read from every file.
+    Uses `executor` if given, otherwise a new process pool with `workers` processes.
+    Returns an IngestReport with a success/error entry for every file (or measurement).
+    """
+    started = time.perf_counter()
+    report = IngestReport()
+    materials = {}
+    pending = []
+    cache = get_processing_cache()
+    profile = profile or get_current_processing_profile()
+    workers = workers or os.cpu_count() or 1
+    # Bounds the number of files whose datasets are held in memory at the same time
+    max_in_flight = 4 * workers
+    in_flight = {}
+    # File index -> [number of outstanding measurements, (position, spectrum, result) ready to be stored]
+    open_files = {}
+    # Result -> (file index, measurement position), to report and store measurements in file order
+    order = {}
+
+    def flush():
+        # bulk_create only sets the ids of the new rows where the database returns them (not on MySQL)
+        bulk = connection.features.can_return_rows_from_bulk_insert
+        try:
+            with transaction.atomic():
+                if bulk:
+                    created = Spectrum.objects.bulk_create([spectrum for spectrum, _ in pending],
+                                                           batch_size=batch_size)
+                    store_peaks(created)
+                    store_metadata_entries(created)
+                else:
+                    # save() stores peaks and metadata entries itself, its post_save receivers update the indexes
+                    created = [spectrum for spectrum, _ in pending]
+                    for spectrum in created:
+                        spectrum.save()
+        except Exception as e:
+            for _, result in pending:
+                result.error = f"Could not store spectrum: {type(e).__name__}: {e}"
+        else:
+            for spectrum, (_, result) in zip(created, pending):
+                result.spectrum_id = spectrum.pk
+            if bulk:
+                # bulk_create sends no post_save signals
+                update_similarity_index(created)
+                update_search_index(created)
+                invalidate_facet_counts()
+        pending.clear()
+
+    def submit(index, display_name, path):
+        if not all_measurements:
+            future = executor.submit(parse_thz_file, path, material_name, sample_thickness=sample_thickness,
+                                     parameters=profile.parameters, cache=cache)
+            in_flight[future] = (index, 0, display_name, display_name, None)
+            open_files[index] = [1, []]
+            return
+        try:
+            measurements = read_thz_file(path, material_name, all_measurements=True)
+        except forms.ValidationError as e:
+            result = IngestResult(source=display_name, error=' '.join(e.messages))
+            report.results.append(result)
+            order[id(result)] = (index, 0)
+            return
+        open_files[index] = [len(measurements), []]
+        for position, measurement in enumerate(measurements):
+            future = executor.submit(process_measurement, measurement, sample_thickness=sample_thickness,
+                                     parameters=profile.parameters, cache=cache)
+            source = f"{display_name} [{measurement.name}]"
+            in_flight[future] = (index, position, display_name, source, measurement.name)
+
+    def collect(future):
+        index, position, display_name, source, measurement_name = in_flight.pop(future)
+        result = IngestResult(source=source)
+        report.results.append(result)
+        order[id(result)] = (index, position)
+        ready = open_files[index]
+        try:
+            spectral_data_dict, metadata_dict = future.result()
+            if measurement_name is not None:
+                metadata_dict['measurement'] = measurement_name
+            if metadata_overrides:
+                metadata_dict.update(metadata_overrides)
+
+            raw_hash = spectral_data_dict.get('raw_data_hash')
+            if raw_hash and any(spectrum.raw_data_hash == raw_hash for spectrum, _ in pending):
+                flush()  # Duplicates within this ingest are found in the database once the batch is stored
+            duplicate = find_duplicate_spectrum(raw_hash, spectral_data_dict.get('processing_hash'))
+            if duplicate is not None:
+                result.duplicate_of = duplicate.pk
+            if duplicate is not None and link_duplicates and is_linkable_duplicate(duplicate, spectral_data_dict):
+                result.spectrum_id = duplicate.pk
+                result.material_name = duplicate.material.name
+            else:
+                result.material_name = material_name_for_file(display_name, metadata_dict, material_name)
+                validate_material_name(result.material_name)
+                metadata_dict['content'] = result.material_name
+
+                # One lookup (and ChemSpider image fetch) per distinct material
+                if result.material_name not in materials:
+                    material, updated = get_material_for_upload(result.material_name, metadata_dict)
+                    if updated:
+                        material.save()
+                    materials[result.material_name] = material
+
+                spectrum = Spectrum(material=materials[result.material_name], uploaded_by=uploaded_by, notes=notes,
+                                    processing_profile=profile)
+                apply_parsed_data(spectrum, spectral_data_dict, metadata_dict)
+                ready[1].append((position, spectrum, result))
+        except forms.ValidationError as e:
+            result.error = ' '.join(e.messages)
+        except Exception as e:
+            result.error = f"{type(e).__name__}: {e}"
+
+        ready[0] -= 1
+        if ready[0] == 0:
+            # All measurements of the file are done, it can go into the next batch as a whole
+            pending.extend((spectrum, result) for _, spectrum, result in sorted(open_files.pop(index)[1],
+                                                                                key=lambda item: item[0]))
+            if len(pending) >= batch_size:
+                flush()
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        remaining_files = enumerate(files)
+        while True:
+            for index, (display_name, path) in remaining_files:
+                submit(index, display_name, path)
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                collect(future)
+        if pending:
+            flush()
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    report.elapsed = time.perf_counter() - started
+    report.results.sort(key=lambda result: order[id(result)])
+    return report
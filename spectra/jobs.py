@@ -0,0 +1,268 @@
+"""
+Database-backed job queue for .thz uploads.
+
+The web request stages the uploaded file and creates a ProcessingJob. The `process_jobs` management command
+claims pending jobs, runs `spectra.processing.parse_thz_file` in a process pool (it does not touch the
+database) and saves the resulting spectrum through SpectrumUploadForm, exactly like a synchronous upload would.
+"""
+import tempfile
+import zipfile
+from datetime import timedelta
+from pathlib import Path
+
+from django import forms
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .forms import SpectrumUploadForm
+from .ingest import collect_thz_files, ingest_files
+from .models import ProcessingJob, find_duplicate_spectrum, is_linkable_duplicate
+from .staging import StagedUpload, discard_staged, file_sha256, stage_upload
+
+
+UPLOAD_EXPIRED_MESSAGE = "The uploaded file is no longer available, please upload it again."
+# Default limit of pending or running jobs per user for API uploads (API_UPLOAD_MAX_QUEUED_JOBS)
+DEFAULT_MAX_QUEUED_JOBS = 50
+
+
+class IdempotencyConflict(Exception):
+    """An Idempotency-Key was used again for a different file."""
+
+    def __init__(self, job):
+        self.job = job
+        super().__init__(f"The idempotency key was already used for a different file (processing job {job.pk}).")
+
+
+def enqueue_upload(upload, user, material_name, notes=None, sample_thickness=None, link_duplicate=False,
+                   all_measurements=False, find_similar=False, metadata_overrides=None, idempotency_key=''):
+    """
+    Create a pending processing job for a .thz file.
+    `upload` is either an uploaded file, which is staged first, or an already staged upload (StagedUpload).
+    With an `idempotency_key`, a job created concurrently for the same user and key is returned instead of a new one
+    (see find_idempotent_job).
+    """
+    staged = upload if isinstance(upload, StagedUpload) else stage_upload(upload)
+    try:
+        with transaction.atomic():
+            return ProcessingJob.objects.create(
+                uploaded_by=user,
+                material_name=material_name,
+                notes=notes,
+                sample_thickness=sample_thickness,
+                link_duplicate=link_duplicate,
+                all_measurements=all_measurements,
+                find_similar=find_similar,
+                metadata_overrides=metadata_overrides or None,
+                idempotency_key=idempotency_key,
+                staging_key=staged.key,
+                content_sha256=staged.sha256,
+                original_filename=staged.name,
+            )
+    except IntegrityError:
+        if not idempotency_key:
+            raise
+        # Another request with the same key created its job first
+        discard_staged(staged.key)
+        job = ProcessingJob.objects.get(uploaded_by=user, idempotency_key=idempotency_key)
+        if job.content_sha256 != staged.sha256:
+            raise IdempotencyConflict(job)
+        return job
+
+
+def find_idempotent_job(user, idempotency_key, upload):
+    """
+    The job created earlier by `user` with `idempotency_key`, or None.
+    Retries thus neither stage nor process the file again; only its hash is computed, to make sure it is the same
+    file (raises IdempotencyConflict otherwise).
+    """
+    job = ProcessingJob.objects.filter(uploaded_by=user, idempotency_key=idempotency_key).first()
+    if job is not None and job.content_sha256 != file_sha256(upload):
+        raise IdempotencyConflict(job)
+    return job
+
+
+def queued_job_count(user):
+    """Number of pending or running jobs of a user."""
+    return ProcessingJob.objects.filter(
+        uploaded_by=user, status__in=(ProcessingJob.STATUS_PENDING, ProcessingJob.STATUS_RUNNING)
+    ).count()
+
+
+def max_queued_jobs():
+    return getattr(settings, 'API_UPLOAD_MAX_QUEUED_JOBS', DEFAULT_MAX_QUEUED_JOBS)
+
+
+def enqueue_bulk_upload(uploaded_files, user, material_name=None, notes=None, sample_thickness=None,
+                        link_duplicate=False, all_measurements=False):
+    """
+    Stage several .thz files, or a single zip archive of them, as one bulk processing job.
+    Separate files are bundled into an uncompressed zip archive, so every job has exactly one staged file.
+    """
+    if len(uploaded_files) == 1 and zipfile.is_zipfile(uploaded_files[0]):
+        staged = stage_upload(uploaded_files[0])
+        original_filename = staged.name
+    else:
+        with tempfile.TemporaryFile() as bundle:
+            with zipfile.ZipFile(bundle, 'w', compression=zipfile.ZIP_STORED) as archive:
+                used_names = set()
+                for index, uploaded_file in enumerate(uploaded_files):
+                    # Keep the original file names, they are shown in the report and may become material names
+                    name = Path(uploaded_file.name).name
+                    if name in used_names:
+                        name = f"{index}_{name}"
+                    used_names.add(name)
+                    with archive.open(name, 'w', force_zip64=True) as member:
+                        for chunk in uploaded_file.chunks():
+                            member.write(chunk)
+            staged = stage_upload(bundle, name='bulk_upload.zip')
+        original_filename = f"{len(uploaded_files)} files"
+
+    return ProcessingJob.objects.create(
+        kind=ProcessingJob.KIND_BULK,
+        uploaded_by=user,
+        material_name=material_name or '',
+        notes=notes,
+        sample_thickness=sample_thickness,
+        link_duplicate=link_duplicate,
+        all_measurements=all_measurements,
+        staging_key=staged.key,
+        content_sha256=staged.sha256,
+        original_filename=original_filename,
+    )
+
+
+def claim_next_job():
+    """
+    Mark the oldest pending job as running and return it, or None if the queue is empty.
+    The conditional update makes claiming safe with several worker processes.
+    """
+    while True:
+        job = ProcessingJob.objects.filter(status=ProcessingJob.STATUS_PENDING).order_by('created_at', 'pk').first()
+        if job is None:
+            return None
+        claimed = ProcessingJob.objects.filter(pk=job.pk, status=ProcessingJob.STATUS_PENDING).update(
+            status=ProcessingJob.STATUS_RUNNING, started_at=timezone.now()
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def requeue_stale_jobs(max_age):
+    """Put jobs that have been running for longer than `max_age` seconds (e.g. after a worker crash) back in the queue."""
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    return ProcessingJob.objects.filter(status=ProcessingJob.STATUS_RUNNING, started_at__lt=cutoff).update(
+        status=ProcessingJob.STATUS_PENDING, started_at=None
+    )
+
+
+def retry_job(job, sample_thickness=None):
+    """Queue a failed job again, optionally with a (new) sample thickness override."""
+    if sample_thickness is not None:
+        job.sample_thickness = sample_thickness
+    job.status = ProcessingJob.STATUS_PENDING
+    job.error = None
+    job.needs_thickness = False
+    job.started_at = None
+    job.finished_at = None
+    job.save()
+
+
+def complete_job(job, spectral_data_dict, metadata_dict, profile=None):
+    """
+    Save the spectrum for a processed job through SpectrumUploadForm and mark the job as done.
+    `profile` is the ProcessingProfile the data was processed with.
+    """
+    form = SpectrumUploadForm(data={'material_name': job.material_name, 'notes': job.notes or ''})
+    form.parsed_spectral_data_from_view = spectral_data_dict
+    form.final_metadata_from_view = {**metadata_dict, **(job.metadata_overrides or {})}
+    if not form.is_valid():
+        errors = '; '.join(message for messages in form.errors.values() for message in messages)
+        fail_job(job, forms.ValidationError(errors))
+        return None
+
+    duplicate = find_duplicate_spectrum(
+        spectral_data_dict.get('raw_data_hash'), spectral_data_dict.get('processing_hash')
+    )
+    with transaction.atomic():
+        if job.link_duplicate and is_linkable_duplicate(duplicate, spectral_data_dict):
+            spectrum = duplicate
+        else:
+            spectrum = form.save(commit=False)
+            spectrum.uploaded_by = job.uploaded_by
+            spectrum.processing_profile = profile
+            spectrum.save()
+
+        job.spectrum = spectrum
+        job.duplicate_of = duplicate
+        job.status = ProcessingJob.STATUS_DONE
+        job.error = None
+        job.finished_at = timezone.now()
+        job.save()
+
+    # The staged file is only kept around for retries of failed jobs
+    discard_job_upload(job)
+    return spectrum
+
+
+def discard_job_upload(job):
+    if job.staging_key:
+        discard_staged(job.staging_key)
+        job.staging_key = ''
+        job.save(update_fields=['staging_key'])
+
+
+def fail_job(job, error):
+    """Record a processing error on the job. Missing thickness errors let the user retry with an override."""
+    if isinstance(error, forms.ValidationError):
+        job.error = ' '.join(error.messages)
+        job.needs_thickness = any(e.code == 'missing_thickness' for e in error.error_list)
+    else:
+        job.error = f"An unexpected error occurred during file processing: {type(error).__name__}: {error}"
+        job.needs_thickness = False
+    job.status = ProcessingJob.STATUS_FAILED
+    job.finished_at = timezone.now()
+    job.save()
+
+
+def run_ingest_job(job, executor):
+    """
+    Ingest a bulk job, or a single file with all its measurements, with the worker's process pool.
+    The per-file (or per-measurement) report is stored on the job.
+    """
+    staged = job.staged_upload
+    if staged is None:
+        fail_job(job, forms.ValidationError(UPLOAD_EXPIRED_MESSAGE))
+        return None
+    try:
+        with tempfile.TemporaryDirectory() as extract_dir:
+            if job.kind == ProcessingJob.KIND_BULK:
+                files = collect_thz_files([staged.path], extract_dir)
+            else:
+                files = [(job.original_filename, staged.path)]
+            if not files:
+                raise forms.ValidationError("No .thz files found in the upload.")
+            report = ingest_files(
+                files,
+                uploaded_by=job.uploaded_by,
+                material_name=job.material_name or None,
+                notes=job.notes,
+                sample_thickness=job.sample_thickness,
+                link_duplicates=job.link_duplicate,
+                all_measurements=job.all_measurements,
+                metadata_overrides=job.metadata_overrides,
+                executor=executor,
+            )
+    except Exception as e:
+        fail_job(job, e)
+        return None
+
+    job.report = report.as_dict()
+    job.spectrum_id = next((result.spectrum_id for result in report.results if result.spectrum_id), None)
+    job.status = ProcessingJob.STATUS_DONE if report.succeeded else ProcessingJob.STATUS_FAILED
+    job.error = f"{report.failed} of {len(report.results)} could not be ingested." if report.failed else None
+    job.finished_at = timezone.now()
+    job.save()
+    discard_job_upload(job)
+    return report
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from spectra.facets import invalidate_facet_counts
+from spectra.models import Spectrum, SpectrumMetadataEntry, store_metadata_entries
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills the metadata table used by the metadata filters (see spectra.models.SpectrumMetadataEntry) from the "
+        "metadata of stored spectra. By default only spectra without entries are processed, so an interrupted run "
+        "can simply be started again. Saved spectra are kept in sync automatically."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="Rebuild the entries of all spectra, e.g. after metadata was changed with "
+                                 "queryset updates that bypass Spectrum.save.")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of spectra read and updated per transaction.")
+
+    def handle(self, *args, **options):
+        queryset = Spectrum.objects.exclude(metadata__isnull=True)
+        if not options['all']:
+            queryset = queryset.exclude(pk__in=SpectrumMetadataEntry.objects.values('spectrum_id'))
+        total = queryset.count()
+        self.stdout.write(f"{total} spectra to index the metadata of.")
+
+        batch_size = options['batch_size']
+        done = 0
+        started = time.perf_counter()
+        last_pk = 0
+        while True:
+            # Keyset pagination over the metadata column only
+            batch = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'metadata')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            store_metadata_entries([Spectrum(pk=pk, metadata=metadata) for pk, metadata in batch])
+            invalidate_facet_counts()
+            done += len(batch)
+            rate = done / (time.perf_counter() - started)
+            self.stdout.write(f"{done}/{total} spectra, {rate:.1f} spectra/s, last id {last_pk}")
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f"Indexed the metadata of {done} spectra in {elapsed:.1f} s."))
@@ -0,0 +1,59 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from spectra.facets import invalidate_facet_counts
+from spectra.models import Spectrum, SpectrumPeak, store_peaks
+from spectra.processing import find_absorption_peaks
+
+
+class Command(BaseCommand):
+    help = (
+        "Detects the absorption peaks of stored spectra and writes them to the peak table used by the peak filter "
+        "(see spectra.processing.find_absorption_peaks). By default only spectra without stored peaks are "
+        "processed, so an interrupted run can simply be started again. New uploads get their peaks automatically."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="Recompute the peaks of all spectra, e.g. after changing the detection thresholds.")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of spectra read and updated per transaction.")
+
+    def handle(self, *args, **options):
+        queryset = Spectrum.objects.filter(absorption_coefficient_data_available=True)
+        if not options['all']:
+            queryset = queryset.exclude(pk__in=SpectrumPeak.objects.values('spectrum_id'))
+        total = queryset.count()
+        self.stdout.write(f"{total} spectra to detect peaks for.")
+
+        batch_size = options['batch_size']
+        done = peaks = 0
+        started = time.perf_counter()
+        last_pk = 0
+        while True:
+            # Keyset pagination over the processed arrays only
+            batch = list(
+                queryset.filter(pk__gt=last_pk).order_by('pk')
+                .values_list('pk', 'frequency_data', 'absorption_coefficient_data')[:batch_size]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            spectra = []
+            for pk, frequency, absorption in batch:
+                spectrum = Spectrum(pk=pk)
+                spectrum.detected_peaks = find_absorption_peaks(frequency, absorption)
+                peaks += len(spectrum.detected_peaks['frequency'])
+                spectra.append(spectrum)
+            store_peaks(spectra)
+            invalidate_facet_counts()
+
+            done += len(batch)
+            rate = done / (time.perf_counter() - started)
+            self.stdout.write(f"{done}/{total} spectra, {peaks} peaks, {rate:.1f} spectra/s, last id {last_pk}")
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored {peaks} peaks of {done} spectra in {elapsed:.1f} s."
+        ))
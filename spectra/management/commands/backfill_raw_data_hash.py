@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from spectra.models import Spectrum, RAW_ARRAY_FIELDS
+from spectra.processing_cache import raw_data_hash
+
+
+class Command(BaseCommand):
+    help = (
+        "Computes the raw data hash (used for duplicate detection) of spectra stored before it was introduced. "
+        "Spectra without raw traces are skipped. The processing hash cannot be reconstructed, so older spectra "
+        "are reported as duplicates but never linked to."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help="Number of spectra loaded and updated at a time.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        queryset = Spectrum.objects.filter(raw_data_hash='').with_arrays(*RAW_ARRAY_FIELDS).order_by('pk')
+
+        updated = 0
+        batch = []
+        for spectrum in queryset.iterator(chunk_size=batch_size):
+            if not len(spectrum.raw_sample_data_t) or not len(spectrum.raw_reference_data_t):
+                continue
+            spectrum.raw_data_hash = raw_data_hash(
+                spectrum.raw_sample_data_t, spectrum.raw_sample_data_p,
+                spectrum.raw_reference_data_t, spectrum.raw_reference_data_p,
+            )
+            batch.append(spectrum)
+            if len(batch) >= batch_size:
+                Spectrum.objects.bulk_update(batch, ['raw_data_hash'])
+                updated += len(batch)
+                batch = []
+        if batch:
+            Spectrum.objects.bulk_update(batch, ['raw_data_hash'])
+            updated += len(batch)
+        self.stdout.write(self.style.SUCCESS(f"Computed the raw data hash of {updated} spectra."))
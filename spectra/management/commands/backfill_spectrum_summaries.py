@@ -0,0 +1,58 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from spectra.facets import invalidate_facet_counts
+from spectra.models import Spectrum
+from spectra.processing import summarize_spectrum
+
+
+class Command(BaseCommand):
+    help = (
+        "Computes the summary columns of stored spectra (frequency coverage, number of points, maximum absorption, "
+        "mean refractive index, time window; see spectra.processing.summarize_spectrum) used by the range filters "
+        "and sort orders of the spectrum list. By default only spectra without a summary are processed, so an "
+        "interrupted run can simply be started again. New uploads get their summary automatically."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="Recompute the summary of all spectra, e.g. after arrays were changed with "
+                                 "queryset updates.")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of spectra read and updated per transaction.")
+
+    def handle(self, *args, **options):
+        queryset = Spectrum.objects.all()
+        if not options['all']:
+            queryset = queryset.filter(n_points=0)
+        total = queryset.count()
+        self.stdout.write(f"{total} spectra to summarize.")
+
+        batch_size = options['batch_size']
+        done = 0
+        started = time.perf_counter()
+        last_pk = 0
+        while True:
+            # Keyset pagination over the arrays the summary is computed from only
+            batch = list(
+                queryset.filter(pk__gt=last_pk).order_by('pk')
+                .values_list('pk', 'frequency_data', 'refractive_index_data', 'absorption_coefficient_data',
+                             'raw_sample_data_t')[:batch_size]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            # One UPDATE per spectrum: bulk_update's CASE over the whole batch is several times slower here
+            with transaction.atomic():
+                for pk, *arrays in batch:
+                    Spectrum.objects.filter(pk=pk).update(**summarize_spectrum(*arrays))
+            invalidate_facet_counts()
+
+            done += len(batch)
+            rate = done / (time.perf_counter() - started)
+            self.stdout.write(f"{done}/{total} spectra, {rate:.1f} spectra/s, last id {last_pk}")
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f"Summarized {done} spectra in {elapsed:.1f} s."))
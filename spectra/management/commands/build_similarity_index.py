@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from spectra.similarity import BUILD_BATCH_SIZE, build_similarity_index, similarity_index_root
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the spectral similarity index from the database (see spectra/similarity.py), e.g. after changing "
+        "SIMILARITY_GRID or to drop the rows of deleted spectra. New and reprocessed spectra are added to the index "
+        "automatically."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BUILD_BATCH_SIZE,
+                            help="Number of spectra read per query.")
+
+    def handle(self, *args, **options):
+        root = similarity_index_root()
+        if root is None:
+            self.stdout.write("SIMILARITY_INDEX_ROOT is not set, the index is kept in memory by each process; "
+                              "building it once to check the data.")
+        started = time.perf_counter()
+        index = build_similarity_index(batch_size=options['batch_size'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {len(index)} spectra on {len(index.grid)} grid points in {elapsed:.1f} s"
+            f"{f' ({root})' if root else ''}."
+        ))
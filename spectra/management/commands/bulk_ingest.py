@@ -0,0 +1,81 @@
+import json
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from spectra.ingest import collect_thz_files, ingest_files
+
+
+class Command(BaseCommand):
+    help = (
+        "Ingests many .thz files at once. Paths may be .thz files, directories (searched recursively) or zip "
+        "archives. Files are processed in parallel and stored in batches; a per-file report is printed at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help=".thz files, directories or zip archives to ingest.")
+        parser.add_argument('--user', help="Username recorded as the uploader of the new spectra.")
+        parser.add_argument('--material',
+                            help="Material name for all files (default: the file's 'content' metadata or file name).")
+        parser.add_argument('--thickness', type=float, default=None,
+                            help="Sample thickness (mm) for files whose metadata does not contain one.")
+        parser.add_argument('--notes', default=None, help="Notes stored on every new spectrum.")
+        parser.add_argument('--all-measurements', action='store_true',
+                            help="Create one spectrum per measurement of each file instead of only for the first one.")
+        parser.add_argument('--link-duplicates', action='store_true',
+                            help="Link files that were already ingested to the existing spectrum instead of "
+                                 "storing them again.")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Number of processing processes (default: the CPU count).")
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Number of spectra inserted per transaction.")
+        parser.add_argument('--json', action='store_true', help="Print the report as JSON.")
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            try:
+                user = get_user_model().objects.get(username=options['user'])
+            except get_user_model().DoesNotExist:
+                raise CommandError(f"User '{options['user']}' does not exist.")
+
+        with tempfile.TemporaryDirectory() as extract_dir:
+            files = collect_thz_files(options['paths'], extract_dir)
+            if not files:
+                raise CommandError("No .thz files found.")
+            self.stdout.write(f"Ingesting {len(files)} file(s)...")
+
+            # Pool processes must not inherit open database connections
+            connections.close_all()
+            report = ingest_files(
+                files,
+                uploaded_by=user,
+                material_name=options['material'],
+                notes=options['notes'],
+                sample_thickness=options['thickness'],
+                link_duplicates=options['link_duplicates'],
+                all_measurements=options['all_measurements'],
+                workers=options['workers'],
+                batch_size=options['batch_size'],
+            )
+
+        if options['json']:
+            self.stdout.write(json.dumps(report.as_dict(), indent=2))
+            return
+
+        for result in report.results:
+            if result.ok and result.duplicate_of == result.spectrum_id:
+                self.stdout.write(f"  LINK  {result.source} -> existing spectrum {result.spectrum_id}")
+            elif result.ok:
+                duplicate = f", duplicate of {result.duplicate_of}" if result.duplicate_of else ""
+                self.stdout.write(
+                    f"  OK    {result.source} -> spectrum {result.spectrum_id} ({result.material_name}{duplicate})"
+                )
+            else:
+                self.stdout.write(self.style.WARNING(f"  FAIL  {result.source}: {result.error}"))
+        self.stdout.write(self.style.SUCCESS(
+            f"{report.succeeded} ingested, {report.failed} failed in {report.elapsed:.1f} s "
+            f"({report.files_per_second:.2f} spectra/s)."
+        ))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from spectra.models import ProcessingJob
+from spectra.staging import cleanup_staged_uploads, staged_upload_ttl
+
+
+class Command(BaseCommand):
+    help = (
+        "Removes staged uploads that are older than STAGED_UPLOAD_TTL (or --max-age). Files of pending or running "
+        "processing jobs are kept; failed jobs whose file was removed can no longer be retried. "
+        "Run this periodically, e.g. from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=None,
+                            help="Remove staged files older than this many seconds (default: STAGED_UPLOAD_TTL).")
+
+    def handle(self, *args, **options):
+        max_age = options['max_age'] if options['max_age'] is not None else staged_upload_ttl()
+        active = ProcessingJob.objects.filter(
+            status__in=[ProcessingJob.STATUS_PENDING, ProcessingJob.STATUS_RUNNING]
+        ).exclude(staging_key='').values_list('staging_key', flat=True)
+
+        removed = cleanup_staged_uploads(max_age, keep=active)
+        if removed:
+            ProcessingJob.objects.filter(staging_key__in=removed).update(staging_key='')
+        self.stdout.write(f"Removed {len(removed)} staged upload(s) older than {max_age} s.")
@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from spectra.fields import is_packed_array, unpack_array
+from spectra.models import Spectrum, ARRAY_FIELDS
+
+
+class Command(BaseCommand):
+    help = (
+        "Rewrites spectrum arrays that are still stored as JSON lists into the packed binary format. "
+        "Run this once after applying the migration that turns the array columns into NumpyArrayFields. "
+        "Rows are processed in primary key order and batches commit independently, so the command can be "
+        "interrupted and re-run safely."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help="Number of spectra read and rewritten per transaction.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only count the rows that still need to be converted.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+
+        quote = connection.ops.quote_name
+        columns = [Spectrum._meta.get_field(name).column for name in ARRAY_FIELDS]
+        pk_column = Spectrum._meta.pk.column
+        # Raw SQL, because the ORM would already decode the values and hide whether a row is legacy JSON.
+        sql = "SELECT {pk}, {cols} FROM {table} WHERE {pk} > %s ORDER BY {pk} LIMIT %s".format(
+            pk=quote(pk_column),
+            cols=', '.join(quote(c) for c in columns),
+            table=quote(Spectrum._meta.db_table),
+        )
+
+        last_pk = 0
+        scanned = 0
+        converted = 0
+        while True:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [last_pk, batch_size])
+                rows = cursor.fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for pk, *values in rows:
+                legacy = {
+                    name: unpack_array(value)
+                    for name, value in zip(ARRAY_FIELDS, values)
+                    if value is not None and not is_packed_array(value)
+                }
+                if legacy:
+                    updates.append((pk, legacy))
+
+            if updates and not dry_run:
+                with transaction.atomic():
+                    for pk, fields in updates:
+                        Spectrum.objects.filter(pk=pk).update(**fields)
+
+            scanned += len(rows)
+            converted += len(updates)
+            last_pk = rows[-1][0]
+            self.stdout.write(f"Scanned {scanned} spectra, {converted} with JSON arrays (last id {last_pk}).")
+
+        verb = "need conversion" if dry_run else "converted"
+        self.stdout.write(self.style.SUCCESS(f"Done: {converted} of {scanned} spectra {verb}."))
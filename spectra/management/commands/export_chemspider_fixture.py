@@ -0,0 +1,29 @@
+import base64
+import json
+
+from django.core.management.base import BaseCommand
+
+from spectra.models import ChemSpiderLookup
+
+
+class Command(BaseCommand):
+    help = (
+        "Writes the cached ChemSpider lookups to a JSON fixture for FixtureChemSpiderBackend, so a deployment "
+        "without network access (or a test setup) answers the same lookups as this one."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="Path of the JSON file to write.")
+
+    def handle(self, *args, **options):
+        names = {}
+        images = {}
+        for entry in ChemSpiderLookup.objects.order_by('kind', 'key'):
+            if entry.kind == ChemSpiderLookup.KIND_NAME:
+                names[entry.key] = entry.csid if entry.found else None
+            elif entry.found and entry.image:
+                images[entry.key] = base64.b64encode(bytes(entry.image)).decode('ascii')
+
+        with open(options['output'], 'w') as f:
+            json.dump({'names': names, 'images': images}, f, indent=1)
+        self.stdout.write(f"Wrote {len(names)} name(s) and {len(images)} image(s) to {options['output']}.")
@@ -0,0 +1,108 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django import forms
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from spectra.jobs import (
+    UPLOAD_EXPIRED_MESSAGE, claim_next_job, complete_job, fail_job, requeue_stale_jobs, run_ingest_job,
+)
+from spectra.models import ProcessingJob, get_current_processing_profile
+from spectra.processing import parse_thz_file
+from spectra.processing_cache import get_processing_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the upload processing worker. Pending processing jobs are claimed from the database and their "
+        ".thz files are processed in a local process pool; no external broker is needed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Number of processing processes (default: PROCESSING_WORKERS or the CPU count).")
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help="Seconds to wait between checks for new jobs.")
+        parser.add_argument('--stale-after', type=int, default=3600,
+                            help="Requeue jobs that have been running for longer than this many seconds on start.")
+        parser.add_argument('--once', action='store_true',
+                            help="Process the jobs that are currently pending and exit.")
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or getattr(settings, 'PROCESSING_WORKERS', None) or os.cpu_count() or 1
+        poll_interval = options['poll_interval']
+
+        requeued = requeue_stale_jobs(options['stale_after'])
+        if requeued:
+            self.stdout.write(f"Requeued {requeued} stale job(s).")
+
+        # Pool processes must not inherit open database connections
+        connections.close_all()
+        self.stdout.write(f"Processing worker started with {workers} process(es).")
+
+        cache = get_processing_cache()
+        running = {}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while True:
+                while len(running) < workers:
+                    job = claim_next_job()
+                    if job is None:
+                        break
+                    if job.kind == ProcessingJob.KIND_BULK or job.all_measurements:
+                        # Bulk and multi-measurement jobs fan out over the same pool and block until all are stored
+                        self.stdout.write(
+                            f"Started {job.get_kind_display().lower()} job {job.pk} ({job.original_filename})."
+                        )
+                        report = run_ingest_job(job, pool)
+                        if report is None:
+                            self.stdout.write(self.style.WARNING(f"Job {job.pk} failed: {job.error}"))
+                        else:
+                            self.stdout.write(self.style.SUCCESS(
+                                f"Job {job.pk} done: {report.succeeded} ingested, {report.failed} failed "
+                                f"({report.files_per_second:.2f} spectra/s)."
+                            ))
+                        continue
+                    staged = job.staged_upload
+                    if staged is None:
+                        fail_job(job, forms.ValidationError(UPLOAD_EXPIRED_MESSAGE))
+                        self.stdout.write(self.style.WARNING(f"Job {job.pk} failed: {job.error}"))
+                        continue
+                    # Looked up for every job, so a new profile is used without restarting the worker
+                    profile = get_current_processing_profile()
+                    future = pool.submit(parse_thz_file, staged.path, job.material_name,
+                                         sample_thickness=job.sample_thickness, parameters=profile.parameters,
+                                         cache=cache)
+                    running[future] = (job, profile)
+                    self.stdout.write(f"Started job {job.pk} ({job.original_filename}).")
+
+                if not running:
+                    if options['once']:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+
+                done, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, profile = running.pop(future)
+                    self._finish(job, profile, future)
+
+    def _finish(self, job, profile, future):
+        try:
+            spectral_data_dict, metadata_dict = future.result()
+        except Exception as e:
+            fail_job(job, e)
+            self.stdout.write(self.style.WARNING(f"Job {job.pk} failed: {job.error}"))
+            return
+
+        try:
+            spectrum = complete_job(job, spectral_data_dict, metadata_dict, profile=profile)
+        except Exception as e:
+            fail_job(job, e)
+            spectrum = None
+        if spectrum is None:
+            self.stdout.write(self.style.WARNING(f"Job {job.pk} failed: {job.error}"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Job {job.pk} done: spectrum {spectrum.pk}."))
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from spectra.facets import invalidate_facet_counts
+from spectra.search import rebuild_search_index, search_backend
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the full-text search index (see spectra/search.py) from the database, e.g. after upgrading an "
+        "existing database or changing SEARCH_METADATA_FIELDS. Saved and deleted spectra are indexed "
+        "automatically."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of spectra read per query.")
+
+    def handle(self, *args, **options):
+        if search_backend() is None:
+            raise CommandError("The database has no full-text search support (SQLite or PostgreSQL are needed); "
+                               "search falls back to substring filters.")
+        started = time.perf_counter()
+        count = rebuild_search_index(batch_size=options['batch_size'])
+        invalidate_facet_counts()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} spectra in {elapsed:.1f} s."))
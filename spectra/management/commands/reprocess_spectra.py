@@ -0,0 +1,171 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from django import forms
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from spectra.facets import invalidate_facet_counts
+from spectra.forms import apply_parsed_data
+from spectra.models import (
+    PROCESSED_ARRAY_FIELDS, RAW_ARRAY_FIELDS, ProcessingProfile, Spectrum, get_current_processing_profile, store_peaks,
+)
+from spectra.processing import SUMMARY_FIELDS, ThzMeasurement, process_measurement
+from spectra.processing_cache import get_processing_cache
+from spectra.similarity import update_similarity_index
+
+# Columns written back for every recomputed spectrum; the raw traces and metadata stay untouched
+UPDATED_FIELDS = PROCESSED_ARRAY_FIELDS + SUMMARY_FIELDS + (
+    'refractive_index_data_available',
+    'absorption_coefficient_data_available',
+    'plot_previews',
+    'processing_hash',
+    'processing_profile',
+    'sample_thickness',
+    'updated_at',
+)
+
+
+def spectrum_thickness(spectrum):
+    """The thickness a spectrum was processed with, falling back to its metadata for older spectra."""
+    if spectrum.sample_thickness is not None:
+        return spectrum.sample_thickness
+    try:
+        return float((spectrum.metadata or {}).get('Sample Thickness (mm)'))
+    except (TypeError, ValueError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the processed arrays of stored spectra from their raw traces with a processing profile "
+        "(default: the current one) in a process pool. Spectra are updated in batches, each in its own "
+        "transaction; spectra already on the target profile are skipped, so an interrupted run can simply be "
+        "started again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', type=int, default=None,
+                            help="Version of the processing profile to apply (default: the latest).")
+        parser.add_argument('--material', action='append', default=[],
+                            help="Only reprocess spectra of this material (may be given several times).")
+        parser.add_argument('--from-profile', default=None,
+                            help="Only reprocess spectra processed with this profile version, or 'none' for "
+                                 "spectra without a profile.")
+        parser.add_argument('--thickness', type=float, default=None,
+                            help="Sample thickness (mm) for spectra that have none stored.")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Number of processing processes (default: the CPU count).")
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Number of spectra loaded and updated per transaction.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only print how many spectra would be reprocessed.")
+
+    def handle(self, *args, **options):
+        if options['profile'] is None:
+            profile = get_current_processing_profile()
+        else:
+            try:
+                profile = ProcessingProfile.objects.get(version=options['profile'])
+            except ProcessingProfile.DoesNotExist:
+                raise CommandError(f"Processing profile v{options['profile']} does not exist.")
+
+        queryset = Spectrum.objects.exclude(processing_profile=profile)
+        if options['material']:
+            queryset = queryset.filter(material__name__in=options['material'])
+        if options['from_profile'] is not None:
+            if options['from_profile'].lower() == 'none':
+                queryset = queryset.filter(processing_profile__isnull=True)
+            else:
+                try:
+                    queryset = queryset.filter(processing_profile__version=int(options['from_profile']))
+                except ValueError:
+                    raise CommandError("--from-profile must be a profile version or 'none'.")
+
+        total = queryset.count()
+        self.stdout.write(f"{total} spectra to reprocess with {profile}.")
+        if options['dry_run'] or not total:
+            return
+
+        workers = options['workers'] or os.cpu_count() or 1
+        batch_size = options['batch_size']
+        cache = get_processing_cache()
+        counts = {'updated': 0, 'skipped': 0, 'failed': 0}
+        started = time.perf_counter()
+        last_pk = 0
+
+        # Pool processes must not inherit open database connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while True:
+                # Keyset pagination: updated spectra drop out of the queryset, failed ones are passed over
+                batch = list(
+                    queryset.filter(pk__gt=last_pk).with_arrays(*RAW_ARRAY_FIELDS).order_by('pk')[:batch_size]
+                )
+                if not batch:
+                    break
+                last_pk = batch[-1].pk
+                self._process_batch(batch, profile, pool, cache, options['thickness'], counts)
+
+                done = sum(counts.values())
+                rate = done / (time.perf_counter() - started)
+                self.stdout.write(
+                    f"{done}/{total} spectra ({counts['updated']} updated, {counts['skipped']} skipped, "
+                    f"{counts['failed']} failed), {rate:.1f} spectra/s, last id {last_pk}"
+                )
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Reprocessed {counts['updated']} spectra with {profile} in {elapsed:.1f} s "
+            f"({counts['updated'] / elapsed if elapsed else 0.0:.1f} spectra/s); "
+            f"{counts['skipped']} skipped, {counts['failed']} failed."
+        ))
+
+    def _process_batch(self, batch, profile, pool, cache, default_thickness, counts):
+        futures = {}
+        for spectrum in batch:
+            thickness = spectrum_thickness(spectrum)
+            if thickness is None:
+                thickness = default_thickness
+            if thickness is None or not len(spectrum.raw_sample_data_t) or not len(spectrum.raw_reference_data_t):
+                self.stdout.write(self.style.WARNING(
+                    f"  SKIP  spectrum {spectrum.pk}: {'no sample thickness' if thickness is None else 'no raw traces'}"
+                ))
+                counts['skipped'] += 1
+                continue
+            measurement = ThzMeasurement(
+                name='',
+                sample=np.column_stack([spectrum.raw_sample_data_t, spectrum.raw_sample_data_p]),
+                reference=np.column_stack([spectrum.raw_reference_data_t, spectrum.raw_reference_data_p]),
+                metadata={},
+                thickness=thickness,
+            )
+            futures[spectrum.pk] = pool.submit(
+                process_measurement, measurement, parameters=profile.parameters, cache=cache
+            )
+
+        updated = []
+        for spectrum in batch:
+            future = futures.get(spectrum.pk)
+            if future is None:
+                continue
+            try:
+                spectral_data_dict, _ = future.result()
+            except forms.ValidationError as e:
+                self.stdout.write(self.style.WARNING(f"  FAIL  spectrum {spectrum.pk}: {' '.join(e.messages)}"))
+                counts['failed'] += 1
+                continue
+            apply_parsed_data(spectrum, spectral_data_dict, spectrum.metadata)
+            spectrum.processing_profile = profile
+            spectrum.updated_at = timezone.now()  # bulk_update bypasses Spectrum.save
+            updated.append(spectrum)
+
+        with transaction.atomic():
+            Spectrum.objects.bulk_update(updated, UPDATED_FIELDS)
+            store_peaks(updated)
+        update_similarity_index(updated)
+        invalidate_facet_counts()
+        counts['updated'] += len(updated)
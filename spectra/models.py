@@ -1,23 +1,145 @@
 # spectra/models.py
-from django.db import models
+import json
+import math
+import re
+
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils import timezone
 
+from .fields import NumpyArrayField
+from .processing import DEFAULT_PROCESSING_PARAMETERS, PEAK_FIELDS
+from .staging import get_staged
+
+PROCESSED_ARRAY_FIELDS = (
+    'frequency_data',
+    'refractive_index_data',
+    'absorption_coefficient_data',
+)
+RAW_ARRAY_FIELDS = (
+    'raw_sample_data_t',
+    'raw_sample_data_p',
+    'raw_reference_data_t',
+    'raw_reference_data_p',
+)
+ARRAY_FIELDS = PROCESSED_ARRAY_FIELDS + RAW_ARRAY_FIELDS
+# Columns that are only read for a single spectrum at a time and are deferred in querysets by default
+DEFERRED_FIELDS = ARRAY_FIELDS + ('plot_previews',)
+
+# Longest key and text value stored in SpectrumMetadataEntry
+METADATA_TEXT_LENGTH = 255
+# A number, optionally followed by a unit: "77", "77 K", "1.5e-3 mm"
+_NUMERIC_VALUE = re.compile(r'\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*[^\d\s]*\s*')
+
 
 class Material(models.Model):
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True, null=True)
     chemical_structure_image = models.BinaryField(blank=True, null=True)
     chemical_structure_image_content_type = models.CharField(max_length=50, blank=True, null=True)
+    # ChemSpider record the structure image was taken from, see spectra/chemspider.py
+    chemspider_csid = models.IntegerField(blank=True, null=True)
 
     def __str__(self):
         return self.name
 
 
+class ChemSpiderLookup(models.Model):
+    """
+    Persistent cache of ChemSpider results: the CSID found for a compound name, or the structure image of a CSID.
+    Lookups without a result are cached as well (found=False) and expire after CHEMSPIDER_NEGATIVE_TTL.
+    """
+    KIND_NAME = 'name'
+    KIND_IMAGE = 'image'
+    KIND_CHOICES = [
+        (KIND_NAME, 'Name search'),
+        (KIND_IMAGE, 'Structure image'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    # Normalised compound name for name searches, the CSID for images
+    key = models.CharField(max_length=255)
+    found = models.BooleanField(default=False)
+    csid = models.IntegerField(blank=True, null=True)
+    image = models.BinaryField(blank=True, null=True)
+    fetched_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'key'], name='unique_chemspider_lookup'),
+        ]
+
+    def __str__(self):
+        return f"ChemSpider {self.kind} lookup for '{self.key}' ({'found' if self.found else 'not found'})"
+
+
+class ProcessingProfile(models.Model):
+    """
+    A versioned set of processing parameters (see spectra.processing.DEFAULT_PROCESSING_PARAMETERS).
+    New uploads are processed with the latest version; profiles are never changed once spectra use them,
+    a new version is created instead and existing spectra are recomputed with `manage.py reprocess_spectra`.
+    """
+    version = models.PositiveIntegerField(unique=True)
+    parameters = models.JSONField(default=dict, blank=True)
+    description = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-version']
+
+    def clean(self):
+        if not isinstance(self.parameters, dict):
+            raise ValidationError({'parameters': "Parameters must be a JSON object."})
+        unknown = set(self.parameters) - set(DEFAULT_PROCESSING_PARAMETERS)
+        if unknown:
+            raise ValidationError({'parameters': f"Unknown processing parameters: {', '.join(sorted(unknown))}."})
+
+    def save(self, *args, **kwargs):
+        # Store the complete parameter set, so later changes of the defaults do not alter existing profiles
+        self.parameters = dict(DEFAULT_PROCESSING_PARAMETERS, **(self.parameters or {}))
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"Processing profile v{self.version}"
+
+
+def get_current_processing_profile():
+    """The latest processing profile; version 1 with the default parameters is created if there is none."""
+    profile = ProcessingProfile.objects.order_by('-version').first()
+    if profile is None:
+        profile, _ = ProcessingProfile.objects.get_or_create(
+            version=1, defaults={'description': "Default processing parameters"}
+        )
+    return profile
+
+
+class SpectrumQuerySet(models.QuerySet):
+    def with_arrays(self, *fields):
+        """
+        Load array columns (or `plot_previews`) together with the rows instead of on first access.
+        Loads all arrays if no field names are given.
+        """
+        still_deferred = [name for name in DEFERRED_FIELDS if name not in (fields or ARRAY_FIELDS)]
+        return self.defer(None).defer(*still_deferred)
+
+
+class SpectrumManager(models.Manager.from_queryset(SpectrumQuerySet)):
+    """
+    Defers the array columns by default, so listing spectra only reads the summary columns.
+    Use `with_arrays()` where the arrays are needed for every row.
+    """
+
+    def get_queryset(self):
+        return super().get_queryset().defer(*DEFERRED_FIELDS)
+
+
 class Spectrum(models.Model):
     material = models.ForeignKey(Material, on_delete=models.CASCADE, related_name='spectra')
     uploaded_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
-    upload_timestamp = models.DateTimeField(default=timezone.now)
+    upload_timestamp = models.DateTimeField(default=timezone.now, db_index=True)
+    # Bumped on every save, invalidates cached exports (see spectra/export.py)
+    updated_at = models.DateTimeField(default=timezone.now)
 
     metadata = models.JSONField(
         blank=True, null=True,
@@ -25,20 +147,306 @@ class Spectrum(models.Model):
     )
     notes = models.TextField(blank=True, null=True)
 
-    frequency_data = models.JSONField(default=list)
-    refractive_index_data = models.JSONField(default=list)
-    absorption_coefficient_data = models.JSONField(default=list)
-    raw_sample_data_t = models.JSONField(default=list)
-    raw_sample_data_p = models.JSONField(default=list)
-    raw_reference_data_t = models.JSONField(default=list)
-    raw_reference_data_p = models.JSONField(default=list)
+    # Packed little-endian float64 blobs, decoded to NumPy arrays on load (see spectra/fields.py)
+    frequency_data = NumpyArrayField()
+    refractive_index_data = NumpyArrayField()
+    absorption_coefficient_data = NumpyArrayField()
+    raw_sample_data_t = NumpyArrayField()
+    raw_sample_data_p = NumpyArrayField()
+    raw_reference_data_t = NumpyArrayField()
+    raw_reference_data_p = NumpyArrayField()
+
+    # Decimated copies of the processed curves for plotting, see spectra.processing.build_plot_previews
+    plot_previews = models.JSONField(blank=True, null=True)
 
     refractive_index_data_available = models.BooleanField(default=False)
     absorption_coefficient_data_available = models.BooleanField(default=False)
 
+    # SHA-256 of the raw traces (duplicate detection) and of traces + thickness + processing parameters,
+    # see spectra/processing_cache.py
+    raw_data_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    processing_hash = models.CharField(max_length=64, blank=True)
+    # Parameters and thickness the processed arrays were computed with, needed to recompute them from the raw traces
+    processing_profile = models.ForeignKey(
+        ProcessingProfile, on_delete=models.PROTECT, null=True, blank=True, related_name='spectra'
+    )
+    sample_thickness = models.FloatField(blank=True, null=True, help_text="Sample thickness in mm.")
+
+    # Summary statistics of the arrays, set with them (see spectra.processing.summarize_spectrum); indexed together
+    # with the id (Meta.indexes) for the range filters and sort orders of SpectrumFilterForm
+    frequency_min = models.FloatField(blank=True, null=True, help_text="Lowest frequency in THz.")
+    frequency_max = models.FloatField(blank=True, null=True, help_text="Highest frequency in THz.")
+    n_points = models.PositiveIntegerField(default=0, help_text="Number of frequency points.")
+    max_absorption = models.FloatField(blank=True, null=True, help_text="Maximum absorption coefficient in cm⁻¹.")
+    mean_refractive_index = models.FloatField(blank=True, null=True)
+    time_window = models.FloatField(blank=True, null=True, help_text="Length of the sample time trace in ps.")
+
+    objects = SpectrumManager()
+
     class Meta:
         verbose_name_plural = "Spectra"
         ordering = ['-upload_timestamp']
+        indexes = [
+            # (column, id): sorted pages continue after the (value, id) pair of their cursor with a range scan,
+            # also among spectra with equal values (spectra.pagination.SpectrumSortedPagination)
+            models.Index(fields=['frequency_min', 'id'], name='spectrum_frequency_min_id'),
+            models.Index(fields=['frequency_max', 'id'], name='spectrum_frequency_max_id'),
+            models.Index(fields=['n_points', 'id'], name='spectrum_n_points_id'),
+            models.Index(fields=['max_absorption', 'id'], name='spectrum_max_absorption_id'),
+            models.Index(fields=['mean_refractive_index', 'id'], name='spectrum_mean_refr_index_id'),
+            models.Index(fields=['time_window', 'id'], name='spectrum_time_window_id'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.updated_at = timezone.now()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'updated_at'}
+        super().save(*args, **kwargs)
+        store_peaks([self])
+        if kwargs.get('update_fields') is None or 'metadata' in kwargs['update_fields']:
+            store_metadata_entries([self])
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        # Accessing one deferred array loads the rest of its group (processed or raw) in the same query,
+        # instead of one query per array.
+        if fields is not None:
+            fields = set(fields)
+            deferred = self.get_deferred_fields()
+            for group in (PROCESSED_ARRAY_FIELDS, RAW_ARRAY_FIELDS):
+                if fields.intersection(group):
+                    fields.update(deferred.intersection(group))
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+
+    def __str__(self):
+        return f"Spectrum for {self.material.name} ({self.upload_timestamp.strftime('%Y-%m-%d')})"
+
+
+class SpectrumPeak(models.Model):
+    """
+    An absorption peak of a spectrum (see spectra.processing.find_absorption_peaks), so spectra can be searched by
+    absorption lines without reading their arrays. Written by `store_peaks` whenever the processed arrays change.
+    """
+    spectrum = models.ForeignKey(Spectrum, on_delete=models.CASCADE, related_name='peaks')
+    frequency = models.FloatField(help_text="Peak position in THz.")
+    height = models.FloatField(help_text="Absorption coefficient at the peak in cm⁻¹.")
+    width = models.FloatField(help_text="Full width at half prominence in THz.")
+    prominence = models.FloatField(help_text="Height above the higher of the two surrounding minima in cm⁻¹.")
+
+    class Meta:
+        ordering = ['spectrum', 'frequency']
+        indexes = [
+            # Range queries on the position, with the prominence filter answered from the index
+            models.Index(fields=['frequency', 'prominence'], name='spectrum_peak_freq_prom'),
+        ]
+
+    def __str__(self):
+        return f"Peak at {self.frequency:.3f} THz of spectrum {self.spectrum_id}"
+
+
+def store_peaks(spectra):
+    """
+    Replace the stored peaks of saved spectra with their `detected_peaks` (set by spectra.forms.apply_parsed_data).
+    Spectra without detected peaks are left alone.
+    """
+    spectra = [spectrum for spectrum in spectra if getattr(spectrum, 'detected_peaks', None) is not None]
+    if not spectra:
+        return
+    rows = [
+        SpectrumPeak(spectrum=spectrum, frequency=frequency, height=height, width=width, prominence=prominence)
+        for spectrum in spectra
+        for frequency, height, width, prominence in zip(*(spectrum.detected_peaks[name] for name in PEAK_FIELDS))
+    ]
+    with transaction.atomic():
+        SpectrumPeak.objects.filter(spectrum__in=[spectrum.pk for spectrum in spectra]).delete()
+        SpectrumPeak.objects.bulk_create(rows)
+    for spectrum in spectra:
+        spectrum.detected_peaks = None
+
+
+class SpectrumMetadataEntry(models.Model):
+    """
+    One flattened metadata value of a spectrum, so spectra can be filtered by metadata with index lookups instead
+    of parsing the JSON of every row. Kept in sync with Spectrum.metadata by `store_metadata_entries`.
+    """
+    spectrum = models.ForeignKey(Spectrum, on_delete=models.CASCADE, related_name='metadata_entries')
+    # Nested keys are joined with '.', see flatten_metadata
+    key = models.CharField(max_length=METADATA_TEXT_LENGTH)
+    # The value as text (JSON for numbers and booleans), cut to METADATA_TEXT_LENGTH characters
+    value_text = models.CharField(max_length=METADATA_TEXT_LENGTH)
+    # The value as a number if it is one, also for text like "77 K"
+    value_num = models.FloatField(blank=True, null=True)
+
+    class Meta:
+        verbose_name_plural = "Spectrum metadata entries"
+        indexes = [
+            # Equality and prefix (as a range) lookups, and numeric ranges, each for one key. The spectrum is part of
+            # the text index so filters and facet counts (spectra/facets.py) never read the table rows.
+            models.Index(fields=['key', 'value_text', 'spectrum'], name='spectrum_meta_key_text'),
+            models.Index(fields=['key', 'value_num'], name='spectrum_meta_key_num'),
+        ]
+
+    def __str__(self):
+        return f"{self.key} = {self.value_text} (spectrum {self.spectrum_id})"
+
+
+def flatten_metadata(metadata, prefix=''):
+    """
+    (key, value) pairs of the scalar values of a metadata dict. Keys of nested dicts are joined with '.', every
+    scalar item of a list becomes a pair of its own, and None values are left out.
+    """
+    for key, value in (metadata or {}).items():
+        key = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from flatten_metadata(value, prefix=f"{key}.")
+        elif isinstance(value, (list, tuple)):
+            yield from ((key, item) for item in value if item is not None and not isinstance(item, (dict, list, tuple)))
+        elif value is not None:
+            yield key, value
+
+
+def metadata_value_number(value):
+    """The numeric value of a metadata value (a number, or text like "77" or "77 K"), or None."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        number = float(value)
+    elif isinstance(value, str) and (match := _NUMERIC_VALUE.fullmatch(value)):
+        number = float(match.group(1))
+    else:
+        return None
+    return number if math.isfinite(number) else None
+
+
+def metadata_entries(spectrum):
+    """Unsaved SpectrumMetadataEntry rows of the metadata of a spectrum."""
+    return [
+        SpectrumMetadataEntry(
+            spectrum_id=spectrum.pk,
+            key=key[:METADATA_TEXT_LENGTH],
+            value_text=(value if isinstance(value, str) else json.dumps(value, default=str))[:METADATA_TEXT_LENGTH],
+            value_num=metadata_value_number(value),
+        )
+        for key, value in flatten_metadata(spectrum.metadata)
+    ]
+
+
+def store_metadata_entries(spectra):
+    """Replace the metadata entries of saved spectra with the flattened values of their `metadata`."""
+    if not spectra:
+        return
+    rows = [entry for spectrum in spectra for entry in metadata_entries(spectrum)]
+    with transaction.atomic():
+        SpectrumMetadataEntry.objects.filter(spectrum__in=[spectrum.pk for spectrum in spectra]).delete()
+        SpectrumMetadataEntry.objects.bulk_create(rows, batch_size=1000)
+
+
+def load_arrays(spectra, fields=ARRAY_FIELDS):
+    """Read array columns of several already fetched spectra in one query."""
+    by_pk = {spectrum.pk: spectrum for spectrum in spectra}
+    if not by_pk:
+        return
+    for pk, *arrays in Spectrum.objects.filter(pk__in=by_pk).values_list('pk', *fields):
+        for field_name, values in zip(fields, arrays):
+            setattr(by_pk[pk], field_name, values)
+
+
+class ProcessingJob(models.Model):
+    """
+    A staged .thz upload waiting for (or done with) processing by the `process_jobs` worker.
+    The web request only stores the file and creates the job; see spectra/jobs.py.
+    """
+    KIND_SINGLE = 'single'
+    KIND_BULK = 'bulk'
+    KIND_CHOICES = [
+        (KIND_SINGLE, 'Single file'),
+        (KIND_BULK, 'Bulk upload'),
+    ]
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default=KIND_SINGLE)
+    uploaded_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='processing_jobs')
+    # Bulk jobs may leave this empty to take the name from each file's metadata or file name
+    material_name = models.CharField(max_length=100, blank=True)
+    notes = models.TextField(blank=True, null=True)
+    sample_thickness = models.FloatField(
+        blank=True, null=True,
+        help_text="Override for the sample thickness in mm, if the file's metadata does not provide it."
+    )
+    # Key of the uploaded file in the staged-upload store (spectra/staging.py), cleared once it is discarded
+    staging_key = models.CharField(max_length=32, blank=True)
+    content_sha256 = models.CharField(max_length=64, blank=True)
+    original_filename = models.CharField(max_length=255, blank=True)
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    error = models.TextField(blank=True, null=True)
+    needs_thickness = models.BooleanField(default=False)
+    spectrum = models.ForeignKey(Spectrum, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    # Create one spectrum per measurement of the file instead of only for the first one
+    all_measurements = models.BooleanField(default=False)
+    # Show the most similar library spectra on the job page once the spectrum is stored
+    find_similar = models.BooleanField(default=False)
+    # Link to an existing spectrum with identical raw traces and processing instead of storing a copy
+    link_duplicate = models.BooleanField(default=False)
+    duplicate_of = models.ForeignKey(Spectrum, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    # Per-file results of bulk jobs, see spectra.ingest.IngestReport
+    report = models.JSONField(blank=True, null=True)
+    # Metadata entries that replace (or add to) the values read from the file
+    metadata_overrides = models.JSONField(blank=True, null=True)
+    # Idempotency-Key of the API request that created the job; a retry with the same key returns this job
+    idempotency_key = models.CharField(max_length=255, blank=True)
+
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['created_at']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['uploaded_by', 'idempotency_key'], condition=~models.Q(idempotency_key=''),
+                name='unique_processing_job_idempotency_key',
+            ),
+        ]
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+
+    @property
+    def staged_upload(self):
+        """The staged file of this job, or None if it has been processed or expired."""
+        return get_staged(self.staging_key)
 
     def __str__(self):
-        return f"Spectrum for {self.material.name} ({self.upload_timestamp.strftime('%Y-%m-%d')})"
\ No newline at end of file
+        return f"Processing job {self.pk} for {self.material_name or self.original_filename} ({self.status})"
+
+
+def find_duplicate_spectrum(raw_data_hash, processing_hash=None):
+    """
+    The oldest spectrum with the same raw traces, preferring one that was also processed the same way.
+    Returns None if there is none.
+    """
+    if not raw_data_hash:
+        return None
+    candidates = Spectrum.objects.filter(raw_data_hash=raw_data_hash).order_by('pk')
+    if processing_hash:
+        same_processing = candidates.filter(processing_hash=processing_hash).first()
+        if same_processing is not None:
+            return same_processing
+    return candidates.first()
+
+
+def is_linkable_duplicate(duplicate, spectral_data_dict):
+    """Only spectra processed exactly the same way (thickness, parameters) can stand in for a new upload."""
+    return duplicate is not None and bool(duplicate.processing_hash) and \
+        duplicate.processing_hash == spectral_data_dict.get('processing_hash')
@@ -0,0 +1,90 @@
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+
+
+class SpectrumCursorPagination(CursorPagination):
+    """
+    Cursor pagination of the spectrum API by id: every page is one index range scan, however deep it is
+    and however large the table grows. The next/previous links are also sent in a `Link` header, for clients of
+    the columnar formats (spectra/renderers.py) that only get the rows in the body.
+    """
+    ordering = '-id'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        links = []
+        if response.data.get('next'):
+            links.append(f'<{response.data["next"]}>; rel="next"')
+        if response.data.get('previous'):
+            links.append(f'<{response.data["previous"]}>; rel="prev"')
+        if links:
+            response['Link'] = ', '.join(links)
+        return response
+
+
+class SpectrumSortedPagination(SpectrumCursorPagination):
+    """
+    Cursor pagination of spectra sorted by a column with ties, `ordering` being (column, tie-breaker): a summary
+    column and id (`?sort=`, see SpectrumFilterForm.ordering) or the rank of full-text search results and id. The
+    cursor holds the values of both, and a page continues after (or before) that pair: a range scan on the
+    (column, id) index, however many spectra share a value. DRF's cursor holds the first column only and pages
+    through ties by offset.
+    """
+
+    def __init__(self, ordering):
+        self.ordering = tuple(ordering)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        reverse, position = (self.cursor.reverse, self.cursor.position) if self.cursor else (False, None)
+
+        ordering = self.ordering
+        if reverse:
+            ordering = tuple(name[1:] if name.startswith('-') else f'-{name}' for name in ordering)
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self._following(ordering, position))
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        following = (self._get_position_from_instance(results[-1], self.ordering)
+                     if len(results) > len(self.page) else None)
+
+        # Positions are unique, so the cursors of DRF's get_next_link/get_previous_link never need an offset
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.next_position = position is not None, position
+            self.has_previous, self.previous_position = following is not None, following
+        else:
+            self.has_next, self.next_position = following is not None, following
+            self.has_previous, self.previous_position = position is not None, position
+        self.display_page_controls = self.has_previous or self.has_next
+        return self.page
+
+    def _following(self, ordering, position):
+        """The rows after `position` in `ordering`: (a, b) > (x, y), with a bound on `a` alone for the index."""
+        try:
+            values = json.loads(position)
+        except ValueError:
+            values = None
+        # Sort columns and ids are numbers
+        if not isinstance(values, list) or len(values) != 2 or not all(
+                isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+            raise NotFound(self.invalid_cursor_message)
+        (first, second), (first_value, second_value) = ordering, values
+        first_lookup, second_lookup = ('lt' if name.startswith('-') else 'gt' for name in (first, second))
+        first, second = first.lstrip('-'), second.lstrip('-')
+        return (Q(**{f'{first}__{first_lookup}e': first_value})
+                & (Q(**{f'{first}__{first_lookup}': first_value})
+                   | Q(**{first: first_value, f'{second}__{second_lookup}': second_value})))
+
+    def _get_position_from_instance(self, instance, ordering):
+        return json.dumps([getattr(instance, name.lstrip('-')) for name in ordering])
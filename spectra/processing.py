@@ -0,0 +1,548 @@
+import functools
+from dataclasses import dataclass
+
+import numpy as np
+import pydotthz
+from django import forms
+from thzpy.timedomain import common_window
+from thzpy.transferfunctions import uniform_slab
+
+from .processing_cache import processing_key, raw_data_hash
+
+# Parameters of common_window and uniform_slab; they are part of the processing cache key
+DEFAULT_PROCESSING_PARAMETERS = {
+    'half_width': 15,
+    'win_func': 'adapted blackman',
+    'upsampling': 3,
+    'min_frequency': 0.2,
+    'max_frequency': 5,
+}
+PROCESSED_KEYS = ('frequency', 'refractive_index', 'absorption_coefficient')
+
+# Target point counts of the plot previews stored with every spectrum
+PREVIEW_WIDTHS = (500, 1000, 2000)
+DEFAULT_PREVIEW_WIDTH = 1000
+
+# Upper limit of the number of points of resampled spectra (see resample_spectrum)
+MAX_RESAMPLE_POINTS = 100_000
+
+# Absorption peaks (see find_absorption_peaks): peaks less prominent than this fraction of the range of the curve,
+# or than PEAK_NOISE_FACTOR times its point-to-point noise, are dropped, and at most MAX_PEAKS of the most prominent
+# are kept per spectrum
+PEAK_MIN_RELATIVE_PROMINENCE = 0.05
+PEAK_NOISE_FACTOR = 5
+MAX_PEAKS = 50
+PEAK_FIELDS = ('frequency', 'height', 'width', 'prominence')
+
+# Summary statistics stored as indexed columns of every spectrum (see summarize_spectrum)
+SUMMARY_FIELDS = (
+    'frequency_min', 'frequency_max', 'n_points', 'max_absorption', 'mean_refractive_index', 'time_window',
+)
+
+PREVIEW_CURVES = {
+    'refractive_index': 'refractive_index_data',
+    'absorption_coefficient': 'absorption_coefficient_data',
+}
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+    Returns the indices of `n_out` points that preserve the visual shape of the curve (x must be sorted).
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # First and last point are always kept, the rest is split into n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+    # Averages of every bucket, used as the third triangle corner for the previous bucket
+    sums_x = np.add.reduceat(x[1:n - 1], edges[:-1] - 1)
+    sums_y = np.add.reduceat(y[1:n - 1], edges[:-1] - 1)
+    counts = np.diff(edges)
+    avg_x = np.append(sums_x / counts, x[-1])
+    avg_y = np.append(sums_y / counts, y[-1])
+
+    indices = np.empty(n_out, dtype=np.intp)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for bucket in range(n_out - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        bx = x[start:stop]
+        by = y[start:stop]
+        cx = avg_x[bucket + 1]
+        cy = avg_y[bucket + 1]
+        area = np.abs((x[a] - cx) * (by - y[a]) - (x[a] - bx) * (cy - y[a]))
+        a = start + int(np.argmax(area))
+        indices[bucket + 1] = a
+    return indices
+
+
+def decimate_curve(x, y, n_out):
+    """Shape-preserving downsampling of a curve to at most `n_out` points, dropping non-finite values."""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    finite = np.isfinite(x) & np.isfinite(y)
+    if not finite.all():
+        x = x[finite]
+        y = y[finite]
+    indices = lttb_indices(x, y, n_out)
+    return x[indices], y[indices]
+
+
+def build_plot_previews(frequency, refractive_index, absorption_coefficient, widths=PREVIEW_WIDTHS):
+    """
+    Computes the decimated plot previews stored in `Spectrum.plot_previews`.
+    Layout: {"<width>": {"refractive_index": {"x": [...], "y": [...]}, "absorption_coefficient": {...}}}
+    """
+    curves = {
+        'refractive_index': refractive_index,
+        'absorption_coefficient': absorption_coefficient,
+    }
+    previews = {}
+    for width in widths:
+        previews[str(width)] = {}
+        for name, values in curves.items():
+            if len(frequency) == 0 or len(values) != len(frequency):
+                continue
+            x, y = decimate_curve(frequency, values, width)
+            previews[str(width)][name] = {'x': x.tolist(), 'y': y.tolist()}
+    return previews
+
+
+def summarize_spectrum(frequency, refractive_index, absorption_coefficient, sample_time):
+    """
+    Computes the summary columns of a spectrum (SUMMARY_FIELDS), so lists can be filtered and sorted by them without
+    decoding any arrays: frequency coverage (THz), number of frequency points, maximum absorption coefficient
+    (cm⁻¹), mean refractive index and length of the sample time trace (ps). Values of empty curves are None.
+    """
+    def finite(values):
+        values = np.asarray(values, dtype=np.float64)
+        return values[np.isfinite(values)]
+
+    frequency, refractive_index, absorption_coefficient, sample_time = (
+        finite(values) for values in (frequency, refractive_index, absorption_coefficient, sample_time)
+    )
+    return {
+        'frequency_min': float(frequency.min()) if len(frequency) else None,
+        'frequency_max': float(frequency.max()) if len(frequency) else None,
+        'n_points': len(frequency),
+        'max_absorption': float(absorption_coefficient.max()) if len(absorption_coefficient) else None,
+        'mean_refractive_index': float(refractive_index.mean()) if len(refractive_index) else None,
+        'time_window': float(sample_time.max() - sample_time.min()) if len(sample_time) else None,
+    }
+
+
+def slice_frequency_range(frequency, fmin=None, fmax=None):
+    """Index slice of the (ascending) frequency axis covering [fmin, fmax]."""
+    start = 0 if fmin is None else int(np.searchsorted(frequency, fmin, side='left'))
+    stop = len(frequency) if fmax is None else int(np.searchsorted(frequency, fmax, side='right'))
+    return slice(start, stop)
+
+
+def resample_spectrum(frequency, curves, fmin=None, fmax=None, step=None, n_points=None):
+    """
+    Cut curves sampled on the ascending `frequency` axis to [fmin, fmax] (THz) and, with `step` (THz) or `n_points`,
+    resample them by linear interpolation onto a regular grid. `curves` maps names to arrays; arrays that do not
+    match the frequency axis come back empty. Returns (frequency, {name: values}).
+    Raises ValueError if the grid would have more than MAX_RESAMPLE_POINTS points.
+    """
+    frequency = np.asarray(frequency)
+    matching = {name: np.asarray(values) for name, values in curves.items() if len(values) == len(frequency)}
+    empty = {name: np.empty(0) for name in curves if name not in matching}
+
+    if (step is None and n_points is None) or len(frequency) < 2:
+        window = slice_frequency_range(frequency, fmin, fmax)
+        return frequency[window], {**{name: values[window] for name, values in matching.items()}, **empty}
+
+    low = frequency[0] if fmin is None else max(fmin, frequency[0])
+    high = frequency[-1] if fmax is None else min(fmax, frequency[-1])
+    if low > high:
+        grid = np.empty(0)
+    elif n_points is not None:
+        grid = np.linspace(low, high, n_points)
+    else:
+        count = int(np.floor((high - low) / step + 1e-9)) + 1
+        if count > MAX_RESAMPLE_POINTS:
+            raise ValueError(f"A step of {step} THz would give more than {MAX_RESAMPLE_POINTS} points.")
+        grid = low + step * np.arange(count)
+    # Interpolating on the full curves uses the neighbours outside the window for the edge points
+    return grid, {**{name: np.interp(grid, frequency, values) for name, values in matching.items()}, **empty}
+
+
+def _sparse_table(values, reduce, fill):
+    """table[k, i] = reduce(values[i:i + 2**k]) for every k with 2**k <= len(values), padded with `fill`."""
+    levels = [values]
+    width = 1
+    while 2 * width <= len(values):
+        previous = levels[-1]
+        levels.append(reduce(previous[:len(previous) - width], previous[width:]))
+        width *= 2
+    table = np.full((len(levels), len(values)), fill, dtype=values.dtype)
+    for k, level in enumerate(levels):
+        table[k, :len(level)] = level
+    return table
+
+
+def _range_reduce(table, reduce, start, stop):
+    """reduce(values[start:stop + 1]) for arrays of (inclusive) index ranges, in O(1) per range."""
+    k = np.log2(stop - start + 1).astype(np.intp)
+    return reduce(table[k, start], table[k, stop - (1 << k) + 1])
+
+
+def _walk(table, positions, bounds, direction, accept):
+    """
+    Move every position towards its bound (inclusive; direction -1 is left, +1 right) as long as `accept` holds
+    for all values passed, by binary lifting over a sparse table. `accept` gets one table value per position.
+    """
+    positions = positions.copy()
+    for k in range(len(table) - 1, -1, -1):
+        size = 1 << k
+        if direction < 0:
+            start = positions - size
+            possible = start >= bounds
+        else:
+            start = positions + 1
+            possible = positions + size <= bounds
+        move = possible & accept(table[k, np.where(possible, start, 0)])
+        positions[move] += direction * size
+    return positions
+
+
+def _crossing(frequency, values, inside, outside, level):
+    """Frequency where the curve crosses `level` between the neighbouring points `inside` and `outside`."""
+    v_in, v_out = values[inside], values[outside]
+    fraction = (v_in - level) / (v_in - v_out)
+    return frequency[inside] + fraction * (frequency[outside] - frequency[inside])
+
+
+def find_absorption_peaks(frequency, values, min_relative_prominence=PEAK_MIN_RELATIVE_PROMINENCE,
+                          noise_factor=PEAK_NOISE_FACTOR, max_peaks=MAX_PEAKS):
+    """
+    Peaks (local maxima) of a curve on the ascending `frequency` axis with their height, prominence and full width
+    at half prominence (THz), as defined by scipy.signal.find_peaks and peak_widths(rel_height=0.5).
+    Computed for all peaks at once with sparse tables of the running minima/maxima, O(n log n).
+    Peaks less prominent than `min_relative_prominence` times the range of the curve or `noise_factor` times its
+    noise (the scaled median absolute difference of neighbouring points) are dropped, and only the `max_peaks`
+    most prominent ones are kept. Returns {name: array} (see PEAK_FIELDS), sorted by frequency.
+    """
+    frequency = np.asarray(frequency, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    empty = {name: np.empty(0) for name in PEAK_FIELDS}
+    if len(values) != len(frequency):
+        return empty
+    finite = np.isfinite(frequency) & np.isfinite(values)
+    frequency, values = frequency[finite], values[finite]
+    n = len(values)
+    if n < 3:
+        return empty
+
+    # Local maxima (the first point of plateaus)
+    inner = values[1:-1]
+    peaks = np.flatnonzero((inner > values[:-2]) & (inner >= values[2:])) + 1
+    if not len(peaks):
+        return empty
+    heights = values[peaks]
+    maxima = _sparse_table(values, np.maximum, -np.inf)
+    minima = _sparse_table(values, np.minimum, np.inf)
+
+    # The bases are the lowest points on either side before the curve rises above the peak
+    left = _walk(maxima, peaks, 0, -1, lambda block: block <= heights)
+    right = _walk(maxima, peaks, n - 1, 1, lambda block: block <= heights)
+    prominences = heights - np.maximum(_range_reduce(minima, np.minimum, left, peaks),
+                                       _range_reduce(minima, np.minimum, peaks, right))
+
+    noise = 1.4826 * np.median(np.abs(np.diff(values))) / np.sqrt(2)
+    threshold = max(min_relative_prominence * (values.max() - values.min()), noise_factor * noise, 1e-300)
+    keep = np.flatnonzero(prominences >= threshold)
+    keep = np.sort(keep[np.argsort(-prominences[keep], kind='stable')[:max_peaks]])
+    peaks, heights, prominences, left, right = peaks[keep], heights[keep], prominences[keep], left[keep], right[keep]
+
+    # Width at half prominence; both crossings lie inside the bases, which are below the reference height
+    reference = heights - prominences / 2
+    left_inside = _walk(minima, peaks, left, -1, lambda block: block >= reference)
+    right_inside = _walk(minima, peaks, right, 1, lambda block: block >= reference)
+    widths = (_crossing(frequency, values, right_inside, right_inside + 1, reference)
+              - _crossing(frequency, values, left_inside, left_inside - 1, reference))
+
+    return {
+        'frequency': frequency[peaks],
+        'height': heights,
+        'width': widths,
+        'prominence': prominences,
+    }
+
+
+@dataclass
+class ThzMeasurement:
+    """One measurement of a .thz file: raw (time, pulse) datasets and sanitized metadata."""
+    name: str
+    sample: np.ndarray
+    reference: np.ndarray
+    metadata: dict
+    thickness: float = None
+    # Why the thickness could not be taken from the metadata, used in the error message
+    thickness_error: str = ""
+
+
+def _wrap_errors(func):
+    """Turns every exception of a .thz parsing step into a ValidationError with a user facing message."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except KeyError as e:
+            raise forms.ValidationError(f"Error processing .thz file: Missing key: '{e.args[0]}'.")
+        except (IndexError, AttributeError) as e:
+            raise forms.ValidationError(f"Error processing .thz file: Data structure error. Details: {e}")
+        except forms.ValidationError:  # Re-raise validation errors from this method
+            raise
+        except Exception as e:
+            raise forms.ValidationError(f"Unexpected error processing .thz file: {type(e).__name__}: {e}")
+
+    return wrapper
+
+
+def _is_sample_key(key):
+    return "sample" in key.lower() or "measurement" in key.lower()
+
+
+def _is_reference_key(key):
+    return "ref" in key.lower()
+
+
+def _dataset_keys(measurement, require_reference=True):
+    """Sample and reference dataset names of a measurement. The reference may be missing if not required."""
+    dataset_keys = list(measurement.datasets.keys())
+    sample_candidates = [k for k in dataset_keys if _is_sample_key(k)]
+    ref_candidates = [k for k in dataset_keys if _is_reference_key(k)]
+
+    if len(sample_candidates) > 1:
+        raise forms.ValidationError(
+            f"Multiple sample datasets found: {', '.join(sample_candidates)}. Please ensure the file contains only one sample dataset."
+        )
+    if len(ref_candidates) > 1:
+        raise forms.ValidationError(
+            f"Multiple reference datasets found: {', '.join(ref_candidates)}. Please ensure the file contains only one reference dataset."
+        )
+
+    sample_key = sample_candidates[0] if sample_candidates else None
+    ref_key = ref_candidates[0] if ref_candidates else None
+
+    if not sample_key:
+        raise forms.ValidationError(
+            f"No sample dataset found. Available datasets: {', '.join(dataset_keys)}"
+        )
+    if not ref_key and require_reference:
+        raise forms.ValidationError(
+            f"No reference dataset found. Available datasets: {', '.join(dataset_keys)}"
+        )
+    return sample_key, ref_key
+
+
+def _read_metadata(dotthz_meta, material_name_from_form):
+    """Sanitized metadata dict of a measurement and its thickness (or the reason it is missing)."""
+    if material_name_from_form:
+        metadata_dict = {"content": material_name_from_form}
+    else:
+        metadata_dict = {}
+
+    # Standard fields from DotthzMetaData attributes
+    standard_fields_map = {
+        "user": "", "email": "", "orcid": "", "institution": "",
+        "description": "", "version": "1.00", "mode": "",
+        "instrument": "", "time": "", "date": ""
+    }
+    for field_name, default_val in standard_fields_map.items():
+        val = getattr(dotthz_meta, field_name, default_val)
+        # Check for pydotthz's Empty type by class name
+        metadata_dict[field_name] = None if val.__class__.__name__ == 'Empty' else val
+
+    # Custom metadata from dotthz_meta.md dictionary
+    if hasattr(dotthz_meta, 'md') and isinstance(dotthz_meta.md, dict):
+        for key, value in dotthz_meta.md.items():
+            # This will overwrite standard fields if keys conflict.
+            # Check for pydotthz's Empty type by class name
+            metadata_dict[key] = None if value.__class__.__name__ == 'Empty' else value
+
+    # Ensure 'md' itself is not an Empty object if it was accessed directly
+    if 'md' in metadata_dict and metadata_dict['md'].__class__.__name__ == 'Empty':
+        metadata_dict['md'] = {}
+
+    # Thickness extraction and validation
+    thickness_float = None
+    # Use .get() on metadata_dict to safely access potentially missing keys
+    thickness_value_from_meta = metadata_dict.get("Sample Thickness (mm)")
+
+    if thickness_value_from_meta is not None:  # Will be None if key missing or value was Empty
+        try:
+            # Handle cases where thickness might be a numpy type
+            thickness_float = float(
+                thickness_value_from_meta.item() if hasattr(thickness_value_from_meta,
+                                                            'item') else thickness_value_from_meta
+            )
+        except (ValueError, TypeError):
+            # Invalid format in metadata, thickness_float remains None.
+            pass
+    # The ChemSpider lookup of the file's 'content' happens when the spectrum is saved (spectra/chemspider.py),
+    # so that it is cached and this function stays free of network and database access.
+
+    error_message_detail = ""
+    if thickness_float is None:
+        if "Sample Thickness (mm)" in metadata_dict:  # Check original presence before sanitization
+            original_meta_thickness = getattr(dotthz_meta.md, 'Sample Thickness (mm)',
+                                              getattr(dotthz_meta, 'Sample Thickness (mm)',
+                                                      None))  # Check both md and direct
+            if original_meta_thickness is not None and original_meta_thickness.__class__.__name__ == 'Empty':
+                error_message_detail = "Metadata 'Sample Thickness (mm)' was present but empty. "
+            elif thickness_value_from_meta is None and original_meta_thickness is not None:  # It was present but not convertible
+                error_message_detail = f"Metadata 'Sample Thickness (mm)' ('{original_meta_thickness}') could not be converted to a number. "
+            # If thickness_value_from_meta is None and original_meta_thickness was also None, it means it wasn't in metadata_dict
+
+        if not error_message_detail and "Sample Thickness (mm)" not in metadata_dict:
+            error_message_detail = "Metadata 'Sample Thickness (mm)' not found in file. "
+
+    return metadata_dict, thickness_float, error_message_detail
+
+
+@_wrap_errors
+def read_thz_file(b_file, material_name_from_form, all_measurements=False):
+    """
+    Reads a .thz file (a path or a file-like object) once and returns its measurements as ThzMeasurement objects.
+    Only the first measurement is returned unless `all_measurements` is set. In that case measurements without a
+    reference dataset are paired with the file's reference if it has exactly one, and measurements that only
+    contain a reference are skipped.
+    The datasets are the arrays pydotthz read from the file, they are not copied.
+    """
+    if hasattr(b_file, 'seek'):
+        b_file.seek(0)
+    with pydotthz.DotthzFile(b_file) as f:
+        measurements = f.get_measurements()
+        if not measurements:
+            raise forms.ValidationError("No measurements found in the .thz file.")
+
+        if not all_measurements:
+            name = next(iter(measurements))
+            selected = [(name, measurements[name], *_dataset_keys(measurements[name]))]
+        else:
+            shared_references = [
+                measurement.datasets[key]
+                for measurement in measurements.values() for key in measurement.datasets if _is_reference_key(key)
+            ]
+            selected = []
+            for name, measurement in measurements.items():
+                if not any(_is_sample_key(key) for key in measurement.datasets):
+                    continue
+                sample_key, ref_key = _dataset_keys(measurement, require_reference=len(shared_references) != 1)
+                selected.append((name, measurement, sample_key, ref_key))
+            if not selected:
+                raise forms.ValidationError("No measurement with a sample dataset found in the .thz file.")
+
+        result = []
+        for name, measurement, sample_key, ref_key in selected:
+            metadata_dict, thickness, thickness_error = _read_metadata(measurement.meta_data, material_name_from_form)
+            result.append(ThzMeasurement(
+                name=name,
+                sample=measurement.datasets[sample_key],
+                reference=measurement.datasets[ref_key] if ref_key else shared_references[0],
+                metadata=metadata_dict,
+                thickness=thickness,
+                thickness_error=thickness_error,
+            ))
+        return result
+
+
+@_wrap_errors
+def process_measurement(measurement, sample_thickness=None, parameters=None, cache=None):
+    """
+    Computes the optical constants of a ThzMeasurement. Returns (spectral_data_dict, metadata_dict).
+    `sample_thickness` is used if the measurement's metadata has no thickness. `parameters` override
+    DEFAULT_PROCESSING_PARAMETERS. Results are looked up in and stored to `cache`
+    (a spectra.processing_cache.ProcessingCache) if given; 'raw_data_hash', 'processing_hash' and the
+    'sample_thickness' that was used are returned with the spectral data.
+    Only depends on its arguments, so it can run in a worker process.
+    """
+    parameters = dict(DEFAULT_PROCESSING_PARAMETERS, **(parameters or {}))
+    thickness_float = measurement.thickness
+
+    if thickness_float is None and sample_thickness is not None:
+        try:
+            thickness_float = float(sample_thickness)
+        except (ValueError, TypeError):
+            raise forms.ValidationError(
+                f"Provided sample thickness override '{sample_thickness}' is not a valid number."
+            )
+
+    if thickness_float is None:
+        error_message_detail = measurement.thickness_error
+        if sample_thickness is None:
+            error_message_detail += "And no override thickness was provided."
+
+        final_error_message = (f"{error_message_detail.strip()} "
+                               "Please ensure a valid thickness is available either in the file's metadata "
+                               "or as an override parameter.")
+        raise forms.ValidationError(final_error_message, code='missing_thickness')
+
+    raw_sample_obj = measurement.sample
+    raw_reference_obj = measurement.reference
+
+    sample_time = raw_sample_obj[:, 0]
+    sample_pulse = raw_sample_obj[:, 1]
+    reference_time = raw_reference_obj[:, 0]
+    reference_pulse = raw_reference_obj[:, 1]
+
+    raw_hash = raw_data_hash(sample_time, sample_pulse, reference_time, reference_pulse)
+    processing_hash = processing_key(raw_hash, thickness_float, parameters)
+
+    spectral_data_dict = cache.get(processing_hash) if cache is not None else None
+    if spectral_data_dict is None or any(key not in spectral_data_dict for key in PROCESSED_KEYS):
+        # Process spectral data
+        processed_sample, processed_reference = common_window(
+            [raw_sample_obj, raw_reference_obj],
+            half_width=parameters['half_width'], win_func=parameters['win_func']
+        )
+        buffer = uniform_slab(
+            thickness_float, processed_sample, processed_reference,
+            upsampling=parameters['upsampling'], min_frequency=parameters['min_frequency'],
+            max_frequency=parameters['max_frequency'], all_optical_constants=True
+        )
+
+        for key in PROCESSED_KEYS:
+            if key not in buffer:
+                raise forms.ValidationError(f"Calculated buffer data is missing key: '{key}'.")
+
+        spectral_data_dict = {
+            'frequency': np.asarray(buffer["frequency"], dtype=np.float64),
+            'refractive_index': np.real(buffer["refractive_index"]).astype(np.float64),
+            'absorption_coefficient': np.asarray(buffer["absorption_coefficient"], dtype=np.float64)
+        }
+        if cache is not None:
+            cache.put(processing_hash, spectral_data_dict)
+
+    spectral_data_dict['peaks'] = find_absorption_peaks(
+        spectral_data_dict['frequency'], spectral_data_dict['absorption_coefficient']
+    )
+    spectral_data_dict['raw_sample_data_t'] = sample_time
+    spectral_data_dict['raw_sample_data_p'] = sample_pulse
+    spectral_data_dict['raw_reference_data_t'] = reference_time
+    spectral_data_dict['raw_reference_data_p'] = reference_pulse
+    spectral_data_dict['raw_data_hash'] = raw_hash
+    spectral_data_dict['processing_hash'] = processing_hash
+    spectral_data_dict['sample_thickness'] = thickness_float
+
+    return spectral_data_dict, dict(measurement.metadata)
+
+
+def parse_thz_file(b_file, material_name_from_form, sample_thickness=None, parameters=None, cache=None):
+    """
+    Parses the first measurement of a .thz binary file (a path or a file-like object).
+    Extracts full metadata (converting pydotthz's Empty type to None) and processed spectral data.
+    The 'description' in metadata is initialized with material_name_from_form and overwritten by file metadata if present.
+    Raises ValidationError if multiple sample/reference datasets are found or if thickness is missing/invalid.
+    See process_measurement for `parameters` and `cache`.
+    Only depends on its arguments, so it can run in a worker process (see spectra/jobs.py).
+    """
+    measurement = read_thz_file(b_file, material_name_from_form)[0]
+    return process_measurement(measurement, sample_thickness=sample_thickness, parameters=parameters, cache=cache)
@@ -0,0 +1,118 @@
+"""
+Content-addressed cache of .thz processing results on local disk.
+
+Entries are keyed by `processing_key`: the hash of the raw sample/reference traces, the sample thickness and the
+processing parameters, so re-uploads of a file (or retries of a job) skip common_window and uniform_slab.
+Every entry is a small .npz file; hits refresh the file's mtime and the least recently used entries are evicted
+once the cache grows beyond its size limit. Several worker processes can share one cache directory.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+
+# Bump to invalidate all cached results, e.g. after changes to the processing itself
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def raw_data_hash(sample_t, sample_p, reference_t, reference_p):
+    """SHA-256 of the raw traces, identical for a parsed file and the arrays stored on its spectrum."""
+    digest = hashlib.sha256()
+    for values in (sample_t, sample_p, reference_t, reference_p):
+        values = np.ascontiguousarray(values, dtype='<f8')
+        digest.update(len(values).to_bytes(8, 'little'))
+        digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+def processing_key(raw_hash, thickness, parameters):
+    """Identifies a processing result: the same raw traces processed with the same thickness and parameters."""
+    payload = json.dumps(
+        {'version': CACHE_VERSION, 'raw': raw_hash, 'thickness': float(thickness).hex(), 'parameters': parameters},
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ProcessingCache:
+    """Size-bounded LRU cache of processing results (dicts of NumPy arrays). Picklable for process pools."""
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = str(root)
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return Path(self.root) / f"{key}.npz"
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path)  # Mark as recently used
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+        return arrays
+
+    def put(self, key, arrays):
+        Path(self.root).mkdir(parents=True, exist_ok=True)
+        fd, partial = tempfile.mkstemp(dir=self.root, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **{name: np.asarray(values) for name, values in arrays.items()})
+            os.replace(partial, self._path(key))
+        except BaseException:
+            Path(partial).unlink(missing_ok=True)
+            raise
+        self.evict()
+
+    def entries(self):
+        """(mtime, size, path) of all entries, least recently used first."""
+        entries = []
+        try:
+            scan = os.scandir(self.root)
+        except FileNotFoundError:
+            return entries
+        with scan:
+            for entry in scan:
+                if not entry.name.endswith('.npz'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits into max_bytes. Returns the number removed."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            Path(path).unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        for _, _, path in self.entries():
+            Path(path).unlink(missing_ok=True)
+
+
+def get_processing_cache():
+    """The cache configured by PROCESSING_CACHE_ROOT / PROCESSING_CACHE_MAX_BYTES, or None if it is disabled."""
+    root = getattr(settings, 'PROCESSING_CACHE_ROOT', None)
+    max_bytes = getattr(settings, 'PROCESSING_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)
+    if not root or not max_bytes:
+        return None
+    return ProcessingCache(root, max_bytes)
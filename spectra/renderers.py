@@ -0,0 +1,198 @@
+"""
+Binary API renderers for analysis clients.
+
+MessagePackRenderer keeps the structure of the JSON response, with every array as a binary string of
+little-endian float64 values (decode with `np.frombuffer(value, '<f8')`).
+
+The columnar renderers (NumPy .npz, Apache Arrow IPC stream, Parquet) turn the response into a table with one row
+per spectrum. Array fields become columns as well:
+- Arrow/Parquet use a fixed-size list column when all arrays of a field have the same length, otherwise a list column.
+- .npz stores a 2D array in the first case. Otherwise it stores the concatenated values plus `<field>__offsets`,
+  so row i is `values[offsets[i]:offsets[i + 1]]`.
+
+Nested values (metadata) are stored as JSON strings. The other keys of a list response besides the rows and the
+next/previous links (`facets` of the spectrum list, `missing` of the batch endpoint) are kept as JSON as well: in
+the schema metadata of Arrow and Parquet, and as `<key>__json` entries (0-d strings) in .npz.
+
+The views pass `raw_arrays=True` in the serializer context for all of these renderers, so arrays arrive as NumPy
+arrays instead of lists and are copied only once into the output, without any float formatting.
+"""
+import io
+import json
+
+import msgpack
+import numpy as np
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+from rest_framework.renderers import BaseRenderer
+
+
+def _rows(data):
+    """The serialized rows of a single object, a list, or a paginated response."""
+    if isinstance(data, dict) and isinstance(data.get('results'), list):
+        return data['results']
+    if isinstance(data, dict):
+        return [data]
+    return list(data or [])
+
+
+def _extras(data):
+    """{key: JSON} of the keys of a list response that are neither rows nor pagination links."""
+    if not isinstance(data, dict) or not isinstance(data.get('results'), list):
+        return {}
+    return {key: json.dumps(value) for key, value in data.items() if key not in ('results', 'next', 'previous')}
+
+
+def _is_array(value):
+    return isinstance(value, (np.ndarray, list, tuple))
+
+
+def _column_names(rows):
+    names = []
+    for row in rows:
+        for name in row:
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def _split_columns(rows):
+    """{name: [values]} of the scalar columns and of the array columns (as float64 arrays)."""
+    scalars, arrays = {}, {}
+    for name in _column_names(rows):
+        values = [row.get(name) for row in rows]
+        if any(_is_array(value) for value in values):
+            arrays[name] = [np.asarray(value if value is not None else (), dtype=np.float64) for value in values]
+        else:
+            scalars[name] = [
+                json.dumps(value) if isinstance(value, dict) else value for value in values
+            ]
+    return scalars, arrays
+
+
+def _fixed_length(values):
+    lengths = {len(value) for value in values}
+    return lengths.pop() if len(lengths) == 1 else None
+
+
+def _offsets(values):
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in values], out=offsets[1:])
+    return offsets
+
+
+def _flat(values):
+    return np.concatenate(values) if values else np.empty(0, dtype=np.float64)
+
+
+def _msgpack_default(value):
+    if isinstance(value, np.ndarray):
+        return np.ascontiguousarray(value, dtype='<f8').tobytes()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot serialize {type(value).__name__} as MessagePack.")
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    # Tells the views to hand NumPy arrays to the renderer instead of lists (see SpectrumSerializer)
+    raw_arrays = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=_msgpack_default, use_bin_type=True)
+
+
+class ColumnarRenderer(BaseRenderer):
+    raw_arrays = True
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        response = (renderer_context or {}).get('response')
+        if response is not None and response.status_code >= 400:
+            # Errors stay JSON, whatever format was asked for
+            response['Content-Type'] = 'application/json'
+            return json.dumps(data).encode()
+        return self.render_rows(_rows(data), _extras(data))
+
+    def render_rows(self, rows, extras):
+        raise NotImplementedError
+
+
+class NpzRenderer(ColumnarRenderer):
+    media_type = 'application/x-npz'
+    format = 'npz'
+
+    def render_rows(self, rows, extras):
+        scalars, arrays = _split_columns(rows)
+        columns = {}
+        for name, values in scalars.items():
+            present = [value for value in values if value is not None]
+            if present and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present):
+                if len(present) == len(values):
+                    columns[name] = np.asarray(values)
+                else:
+                    # Missing numbers become NaN
+                    columns[name] = np.asarray([np.nan if value is None else value for value in values])
+            elif all(isinstance(value, bool) for value in values):
+                columns[name] = np.asarray(values, dtype=bool)
+            else:
+                # Fixed-width unicode instead of object arrays, so the file loads with allow_pickle=False
+                columns[name] = np.asarray(['' if value is None else str(value) for value in values], dtype=str)
+        for name, values in arrays.items():
+            length = _fixed_length(values)
+            if length is not None:
+                columns[name] = np.stack(values) if values else np.empty((0, 0))
+            else:
+                columns[name] = _flat(values)
+                columns[f'{name}__offsets'] = _offsets(values)
+        for key, value in extras.items():
+            columns[f'{key}__json'] = np.asarray(value)
+        buffer = io.BytesIO()
+        np.savez(buffer, **columns)
+        return buffer.getvalue()
+
+
+def arrow_table(rows, extras=None):
+    """pyarrow.Table with one row per serialized spectrum, `extras` ({key: JSON}) as schema metadata."""
+    scalars, arrays = _split_columns(rows)
+    columns = {name: pyarrow.array(values) for name, values in scalars.items()}
+    for name, values in arrays.items():
+        flat = pyarrow.array(_flat(values), type=pyarrow.float64())
+        length = _fixed_length(values)
+        if length:
+            columns[name] = pyarrow.FixedSizeListArray.from_arrays(flat, length)
+        else:
+            columns[name] = pyarrow.ListArray.from_arrays(pyarrow.array(_offsets(values), type=pyarrow.int32()), flat)
+    return pyarrow.table(columns, metadata=extras or None)
+
+
+class ArrowRenderer(ColumnarRenderer):
+    media_type = 'application/vnd.apache.arrow.stream'
+    format = 'arrow'
+
+    def render_rows(self, rows, extras):
+        table = arrow_table(rows, extras)
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+
+class ParquetRenderer(ColumnarRenderer):
+    media_type = 'application/vnd.apache.parquet'
+    format = 'parquet'
+
+    def render_rows(self, rows, extras):
+        sink = pyarrow.BufferOutputStream()
+        pyarrow.parquet.write_table(arrow_table(rows, extras), sink)
+        return sink.getvalue().to_pybytes()
+
+
+BINARY_RENDERERS = [MessagePackRenderer, NpzRenderer, ArrowRenderer, ParquetRenderer]
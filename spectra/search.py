@@ -0,0 +1,314 @@
+"""
+Full-text search over spectra: material name and description, notes and the metadata fields listed in
+SEARCH_METADATA_FIELDS.
+
+Every spectrum has one search document with these four columns, weighted in that order when results are ranked.
+On SQLite the documents live in an FTS5 table (ranked with bm25), on PostgreSQL in a table with a GIN-indexed
+tsvector (ranked with ts_rank); the tables are created by `migrate` and filled with
+`manage.py rebuild_search_index`. Other databases have no index and search falls back to substring filters.
+
+Text is normalized in Python before it is indexed or searched (lower case, without diacritics, split into runs
+of letters and digits), so both backends see the same terms. Every query term matches as a prefix ("lact" finds
+"lactose"), all terms must match. If nothing is found, the terms that are not the prefix of any indexed term are
+treated as typos: the closest indexed terms with the same first letter (difflib) are searched for as well.
+
+Documents are updated when spectra or materials are saved and removed when spectra are deleted; bulk inserts
+call update_search_index themselves.
+"""
+import difflib
+import logging
+import re
+import unicodedata
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connection, connections, transaction
+from django.db.models import Value
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+
+from .models import Material, Spectrum
+
+logger = logging.getLogger(__name__)
+
+SEARCH_TABLE = 'spectra_search'
+DEFAULT_METADATA_FIELDS = ('content', 'description', 'instrument', 'institution', 'mode', 'measurement')
+# Only the first terms of a query are used
+MAX_QUERY_TERMS = 8
+# Typo tolerance: shortest corrected term, number of alternatives and difflib similarity cutoff
+TYPO_MIN_LENGTH = 4
+TYPO_ALTERNATIVES = 3
+TYPO_CUTOFF = 0.75
+# Spectrum fields whose changes are indexed (the material is followed through its own post_save)
+INDEXED_FIELDS = {'material', 'notes', 'metadata'}
+BATCH_SIZE = 500
+
+_TERM = re.compile(r'[^\W_]+')
+
+
+def search_terms(text):
+    """Lower-case terms of a text without diacritics, as they are indexed."""
+    text = unicodedata.normalize('NFKD', str(text).lower())
+    return _TERM.findall(''.join(char for char in text if not unicodedata.combining(char)))
+
+
+def search_metadata_fields():
+    return tuple(getattr(settings, 'SEARCH_METADATA_FIELDS', DEFAULT_METADATA_FIELDS))
+
+
+def search_document(material_name, material_description, notes, metadata):
+    """The normalized text of the four columns of a spectrum's search document."""
+    metadata = metadata if isinstance(metadata, dict) else {}
+    metadata_text = ' '.join(
+        str(metadata[key]) for key in search_metadata_fields() if metadata.get(key) not in (None, '')
+    )
+    return tuple(
+        ' '.join(search_terms(text)) for text in (material_name, material_description or '', notes or '', metadata_text)
+    )
+
+
+class SqliteSearch:
+    """FTS5 table keyed by the spectrum id (rowid), with a vocabulary table for typo tolerance."""
+
+    def create(self, cursor):
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+            "material, description, notes, metadata, tokenize = 'unicode61', prefix = '2 3')"
+        )
+        cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE}_vocab USING fts5vocab({SEARCH_TABLE}, row)")
+
+    def remove(self, cursor, pks):
+        cursor.executemany(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [(pk,) for pk in pks])
+
+    def insert(self, cursor, documents):
+        cursor.executemany(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, material, description, notes, metadata) VALUES (%s, %s, %s, %s, %s)",
+            documents,
+        )
+
+    def clear(self, cursor):
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+
+    def optimize(self, cursor):
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')")
+
+    def query(self, groups):
+        return ' AND '.join(
+            '(' + ' OR '.join(f'"{term}"*' if prefix else f'"{term}"' for term, prefix in alternatives) + ')'
+            for alternatives in groups
+        )
+
+    def exists(self, cursor, query):
+        cursor.execute(f"SELECT 1 FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s LIMIT 1", [query])
+        return cursor.fetchone() is not None
+
+    def filter(self, queryset, query):
+        # The join condition is an ORM filter, so it follows the alias of the spectrum table in subqueries.
+        # bm25 is negative, lower is better.
+        return queryset.extra(tables=[SEARCH_TABLE], where=[f"{SEARCH_TABLE} MATCH %s"], params=[query]).filter(
+            pk=RawSQL(f"{SEARCH_TABLE}.rowid", ())
+        ).annotate(search_rank=RawSQL(f"bm25({SEARCH_TABLE}, 10.0, 4.0, 2.0, 1.0)", ()))
+
+    def has_prefix(self, cursor, term):
+        cursor.execute(
+            f"SELECT 1 FROM {SEARCH_TABLE}_vocab WHERE term >= %s AND term < %s LIMIT 1", [term, term + '\uffff']
+        )
+        return cursor.fetchone() is not None
+
+    def terms(self, cursor, first):
+        cursor.execute(f"SELECT term FROM {SEARCH_TABLE}_vocab WHERE term >= %s AND term < %s", [first, first + '\uffff'])
+        return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresSearch:
+    """Table of weighted tsvectors (config 'simple', the text is already normalized) with a GIN index."""
+
+    def create(self, cursor):
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ("
+            f"spectrum_id bigint PRIMARY KEY REFERENCES {Spectrum._meta.db_table} (id) ON DELETE CASCADE, "
+            "document tsvector NOT NULL)"
+        )
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document ON {SEARCH_TABLE} USING GIN (document)")
+
+    def remove(self, cursor, pks):
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE spectrum_id = ANY(%s)", [list(pks)])
+
+    def insert(self, cursor, documents):
+        cursor.executemany(
+            f"INSERT INTO {SEARCH_TABLE} (spectrum_id, document) VALUES (%s, "
+            "setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B') || "
+            "setweight(to_tsvector('simple', %s), 'C') || setweight(to_tsvector('simple', %s), 'D')) "
+            "ON CONFLICT (spectrum_id) DO UPDATE SET document = EXCLUDED.document",
+            documents,
+        )
+
+    def clear(self, cursor):
+        cursor.execute(f"TRUNCATE {SEARCH_TABLE}")
+
+    def optimize(self, cursor):
+        cursor.execute(f"ANALYZE {SEARCH_TABLE}")
+
+    def query(self, groups):
+        return ' & '.join(
+            '(' + ' | '.join(f"{term}:*" if prefix else term for term, prefix in alternatives) + ')'
+            for alternatives in groups
+        )
+
+    def exists(self, cursor, query):
+        cursor.execute(f"SELECT 1 FROM {SEARCH_TABLE} WHERE document @@ to_tsquery('simple', %s) LIMIT 1", [query])
+        return cursor.fetchone() is not None
+
+    def filter(self, queryset, query):
+        # Negated so that lower is better, as with bm25
+        return queryset.extra(
+            tables=[SEARCH_TABLE], where=[f"{SEARCH_TABLE}.document @@ to_tsquery('simple', %s)"], params=[query]
+        ).filter(
+            pk=RawSQL(f"{SEARCH_TABLE}.spectrum_id", ())
+        ).annotate(search_rank=RawSQL(f"-ts_rank({SEARCH_TABLE}.document, to_tsquery('simple', %s))", [query]))
+
+    def has_prefix(self, cursor, term):
+        return self.exists(cursor, f"{term}:*")
+
+    def terms(self, cursor, first):
+        # ts_stat reads all documents, but is only needed for queries that found nothing
+        cursor.execute(
+            f"SELECT word FROM ts_stat('SELECT document FROM {SEARCH_TABLE}') WHERE word >= %s AND word < %s",
+            [first, first + '\uffff'],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+SEARCH_BACKENDS = {
+    'sqlite': SqliteSearch,
+    'postgresql': PostgresSearch,
+}
+
+
+def search_backend(using=DEFAULT_DB_ALIAS):
+    """The full-text backend of a database connection, or None if it has none."""
+    backend = SEARCH_BACKENDS.get(connections[using].vendor)
+    return backend() if backend is not None else None
+
+
+def _close_terms(cursor, backend, term):
+    """Indexed terms close to a term that matches nothing, assuming its first letter is right."""
+    if len(term) < TYPO_MIN_LENGTH:
+        return []
+    candidates = [
+        candidate for candidate in backend.terms(cursor, term[0])
+        if abs(len(candidate) - len(term)) <= 2
+    ]
+    return difflib.get_close_matches(term, candidates, n=TYPO_ALTERNATIVES, cutoff=TYPO_CUTOFF)
+
+
+def search_spectra(queryset, query):
+    """
+    The spectra of a queryset that match a full-text query, annotated with their `search_rank` (lower is better).
+    The search table is joined in the same query, so the other filters, counts and exports see every match, and
+    ranks are only sorted where the queryset is ordered by them. Returns None if the database has no full-text
+    index; callers fall back to substring filters then.
+    """
+    backend = search_backend(queryset.db)
+    if backend is None:
+        return None
+    terms = list(dict.fromkeys(search_terms(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return queryset.annotate(search_rank=Value(0.0)).none()
+    try:
+        with transaction.atomic(using=queryset.db), connections[queryset.db].cursor() as cursor:
+            groups = [[(term, True)] for term in terms]
+            if not backend.exists(cursor, backend.query(groups)):
+                # Nothing found: add the indexed terms closest to the terms that match nothing
+                for alternatives in groups:
+                    term = alternatives[0][0]
+                    if not backend.has_prefix(cursor, term):
+                        alternatives += [(close_term, False) for close_term in _close_terms(cursor, backend, term)]
+            return backend.filter(queryset, backend.query(groups))
+    except DatabaseError as e:
+        logger.warning("Full-text search failed, falling back to substring search: %s: %s", type(e).__name__, e)
+        return None
+
+
+def _documents(pks):
+    rows = Spectrum.objects.filter(pk__in=pks).values_list(
+        'pk', 'material__name', 'material__description', 'notes', 'metadata'
+    )
+    return [(pk, *search_document(*fields)) for pk, *fields in rows]
+
+
+def update_search_index(spectra):
+    """
+    Index (or re-index) saved spectra, given as instances or ids. Spectra that no longer exist are removed.
+    Failures are only reported, storing spectra must not depend on the index.
+    """
+    backend = search_backend()
+    pks = [getattr(spectrum, 'pk', spectrum) for spectrum in spectra]
+    pks = [pk for pk in pks if pk is not None]
+    if backend is None or not pks:
+        return
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            for start in range(0, len(pks), BATCH_SIZE):
+                batch = pks[start:start + BATCH_SIZE]
+                backend.remove(cursor, batch)
+                backend.insert(cursor, _documents(batch))
+    except DatabaseError as e:
+        logger.warning("Could not update the search index: %s: %s", type(e).__name__, e)
+
+
+def rebuild_search_index(batch_size=BATCH_SIZE):
+    """Create the search table if needed and index all spectra. Returns the number of indexed spectra."""
+    backend = search_backend()
+    if backend is None:
+        return 0
+    count = 0
+    last_pk = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        backend.create(cursor)
+        backend.clear(cursor)
+        while True:
+            pks = list(Spectrum.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            backend.insert(cursor, _documents(pks))
+            count += len(pks)
+        backend.optimize(cursor)
+    return count
+
+
+@receiver(post_migrate, dispatch_uid='spectra_create_search_index')
+def create_search_index(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    if sender.name != 'spectra':
+        return
+    backend = search_backend(using)
+    if backend is not None:
+        with connections[using].cursor() as cursor:
+            backend.create(cursor)
+
+
+@receiver(post_save, sender=Spectrum, dispatch_uid='spectra_update_search_index')
+def index_saved_spectrum(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not INDEXED_FIELDS.intersection(update_fields):
+        return
+    transaction.on_commit(lambda: update_search_index([instance.pk]))
+
+
+@receiver(post_save, sender=Material, dispatch_uid='spectra_update_search_index_of_material')
+def index_spectra_of_saved_material(sender, instance, created=False, **kwargs):
+    if created:
+        return
+    transaction.on_commit(lambda: update_search_index(list(instance.spectra.values_list('pk', flat=True))))
+
+
+@receiver(post_delete, sender=Spectrum, dispatch_uid='spectra_remove_from_search_index')
+def remove_deleted_spectrum_from_search_index(sender, instance, **kwargs):
+    backend = search_backend()
+    if backend is None:
+        return
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            backend.remove(cursor, [instance.pk])
+    except DatabaseError as e:
+        logger.warning("Could not update the search index: %s: %s", type(e).__name__, e)
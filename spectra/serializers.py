@@ -1,5 +1,21 @@
+from django.urls import reverse
 from rest_framework import serializers
-from .models import Spectrum, Material  # Assuming Material model is in the same app
+from .models import ProcessingJob, Spectrum, Material  # Assuming Material model is in the same app
+from .processing import PEAK_FIELDS
+
+
+class NumpyArrayField(serializers.Field):
+    """Read-only representation of a packed array column (see spectra/fields.py) as a list of floats."""
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        # Binary renderers (spectra/renderers.py) take the arrays as they are
+        if self.context.get('raw_arrays'):
+            return value
+        return value.tolist()
 
 
 class SpectrumSerializer(serializers.ModelSerializer):
@@ -8,6 +24,7 @@ class SpectrumSerializer(serializers.ModelSerializer):
     # and use it here, or use a SlugRelatedField if you want to use a slug for material identification.
     material_name = serializers.CharField(source='material.name', read_only=True)
     uploaded_by_username = serializers.CharField(source='uploaded_by.username', read_only=True)
+    processing_profile_version = serializers.IntegerField(source='processing_profile.version', read_only=True)
 
     # URL for the detail view of the spectrum
     # Ensure your API URL for spectrum detail is named 'api_spectrum_detail'
@@ -18,10 +35,31 @@ class SpectrumSerializer(serializers.ModelSerializer):
         lookup_field='pk'
     )
 
+    # Stored absorption peaks as {"frequency": [...], "height": [...], "width": [...], "prominence": [...]},
+    # ordered by frequency; columns instead of a list of objects so the columnar formats can hold them
+    peaks = serializers.SerializerMethodField()
+
     # Custom field for the download URL
     # Ensure your API URL for download is named 'api_download_spectrum_file'
     download_url = serializers.SerializerMethodField()
 
+    frequency_data = NumpyArrayField()
+    refractive_index_data = NumpyArrayField()
+    absorption_coefficient_data = NumpyArrayField()
+    raw_sample_data_t = NumpyArrayField()
+    raw_sample_data_p = NumpyArrayField()
+    raw_reference_data_t = NumpyArrayField()
+    raw_reference_data_p = NumpyArrayField()
+
+    def __init__(self, *args, fields=None, exclude=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Sparse fieldsets: keep only `fields` (if given), then drop `exclude`
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+        for name in exclude or ():
+            self.fields.pop(name, None)
+
     class Meta:
         model = Spectrum
         fields = [
@@ -31,6 +69,15 @@ class SpectrumSerializer(serializers.ModelSerializer):
             'upload_timestamp',
             'uploaded_by_username',  # From related User model
             'metadata',  # Assuming this is a JSONField or similar
+            'sample_thickness',
+            'processing_profile_version',
+            'frequency_min',
+            'frequency_max',
+            'n_points',
+            'max_absorption',
+            'mean_refractive_index',
+            'time_window',
+            'peaks',
             'frequency_data',
             'refractive_index_data',
             'absorption_coefficient_data',
@@ -53,13 +100,15 @@ class SpectrumSerializer(serializers.ModelSerializer):
             'absorption_coefficient_data',
         ]
 
+    def get_peaks(self, obj):
+        # Uses the prefetched peaks of list views
+        peaks = list(obj.peaks.all())
+        return {name: [getattr(peak, name) for peak in peaks] for name in PEAK_FIELDS}
+
     def get_download_url(self, obj):
         request = self.context.get('request')
         if request is not None:
-            # Ensure your API URL for download is named 'api_download_spectrum_file'
-            return request.build_absolute_uri(
-                serializers.reverse('spectra:api_download_spectrum_file', kwargs={'pk': obj.pk}, request=request)
-            )
+            return request.build_absolute_uri(reverse('spectra:download_spectrum_file', kwargs={'pk': obj.pk}))
         return None
 
     # If you want to handle material creation/linking by name during upload via API:
@@ -87,3 +136,36 @@ class SpectrumSerializer(serializers.ModelSerializer):
     #         instance.material = material
     #
     #     return super().update(instance, validated_data)
+
+
+class ProcessingJobSerializer(serializers.ModelSerializer):
+    url = serializers.HyperlinkedIdentityField(view_name='spectra:api_processing_job', lookup_field='pk')
+    spectrum_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ProcessingJob
+        fields = [
+            'id',
+            'kind',
+            'all_measurements',
+            'status',
+            'material_name',
+            'original_filename',
+            'error',
+            'needs_thickness',
+            'spectrum',
+            'spectrum_url',
+            'duplicate_of',
+            'report',
+            'created_at',
+            'started_at',
+            'finished_at',
+            'url',
+        ]
+        read_only_fields = fields
+
+    def get_spectrum_url(self, obj):
+        request = self.context.get('request')
+        if obj.spectrum_id is None or request is None:
+            return None
+        return request.build_absolute_uri(reverse('spectra:api_spectrum_detail', kwargs={'pk': obj.spectrum_id}))
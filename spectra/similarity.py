@@ -0,0 +1,464 @@
+"""
+Spectral similarity search: which stored spectra look like a given measurement?
+
+Every spectrum's refractive index and absorption coefficient are resampled onto a common frequency grid
+(SIMILARITY_GRID: fmin, fmax in THz and number of points) and kept as rows of a float32 matrix per curve. Grid
+points outside a spectrum's frequency range are stored as zeros, together with the range of valid columns of the
+row, so a query only compares the band both spectra cover. Queries score all rows with a few matrix-vector
+products (cosine similarity, Pearson correlation or RMS difference relative to the query) and return the top k.
+
+With SIMILARITY_INDEX_ROOT set, the index lives on disk as raw arrays that are memory-mapped by every process:
+new and reprocessed spectra are written into it as they are stored and deleted spectra are masked, under a file
+lock. A missing or outdated index (e.g. after changing the grid) is rebuilt from the database on the next query,
+or with `manage.py build_similarity_index`, which also drops the rows of deleted spectra. Without a root, every
+process keeps the index in memory and rebuilds it when the spectra in the database have changed.
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import PROCESSED_ARRAY_FIELDS, Spectrum, load_arrays
+
+logger = logging.getLogger(__name__)
+
+# Bump when the file layout changes, outdated indexes are rebuilt
+INDEX_VERSION = 1
+DEFAULT_GRID = (0.1, 4.0, 391)
+# Indexed curves and the Spectrum fields they are read from
+CURVES = {
+    'refractive_index': 'refractive_index_data',
+    'absorption_coefficient': 'absorption_coefficient_data',
+}
+METRICS = ('cosine', 'correlation', 'l2')
+# Rows covering less than this fraction of the compared band are not scored
+MIN_OVERLAP = 0.5
+# Rows scored at a time, bounds the temporary memory of a query
+QUERY_BLOCK_ROWS = 16384
+BUILD_BATCH_SIZE = 1000
+
+
+def similarity_grid():
+    fmin, fmax, n_points = getattr(settings, 'SIMILARITY_GRID', DEFAULT_GRID)
+    return np.linspace(fmin, fmax, int(n_points))
+
+
+def similarity_index_root():
+    """Directory of the on-disk index, or None if the index is only kept in memory."""
+    root = getattr(settings, 'SIMILARITY_INDEX_ROOT', None)
+    return Path(root) if root else None
+
+
+def resample_curve(grid, frequency, values):
+    """
+    (row, lo, hi): `values` sampled on `frequency`, interpolated onto the grid points within its frequency range
+    (columns lo:hi) and zero elsewhere. lo == hi if the curve is missing.
+    """
+    row = np.zeros(len(grid), dtype=np.float32)
+    frequency = np.asarray(frequency, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if len(frequency) < 2 or len(values) != len(frequency):
+        return row, 0, 0
+    lo = int(np.searchsorted(grid, frequency[0], 'left'))
+    hi = int(np.searchsorted(grid, frequency[-1], 'right'))
+    if hi > lo:
+        row[lo:hi] = np.nan_to_num(np.interp(grid[lo:hi], frequency, values), nan=0.0, posinf=0.0, neginf=0.0)
+    return row, lo, max(hi, lo)
+
+
+def curve_rows(grid, frequency, curves):
+    """{curve: (row, lo, hi)} of a spectrum; `curves` maps curve names (see CURVES) to arrays on `frequency`."""
+    return {name: resample_curve(grid, frequency, curves.get(name, ())) for name in CURVES}
+
+
+def spectrum_rows(grid, spectrum):
+    return curve_rows(grid, spectrum.frequency_data,
+                      {name: getattr(spectrum, field_name) for name, field_name in CURVES.items()})
+
+
+def _curve_scores(values, bounds, query, band, metric):
+    """Scores of all rows of one curve against the query row over the columns band[0]:band[1]; NaN = not comparable."""
+    b0, b1 = band
+    width = b1 - b0
+    q = np.asarray(query[b0:b1], dtype=np.float64)
+    # Prefix sums give the query's sums over the part of the band each row covers
+    q_sum = np.concatenate(([0.0], np.cumsum(q)))
+    q_squares = np.concatenate(([0.0], np.cumsum(q * q)))
+    scores = np.full(len(values), np.nan)
+
+    # float32 products are twice as fast; correlation subtracts large sums and needs float64
+    dtype = np.float64 if metric == 'correlation' else np.float32
+    q_block = q.astype(dtype)
+
+    for start in range(0, len(values), QUERY_BLOCK_ROWS):
+        stop = min(start + QUERY_BLOCK_ROWS, len(values))
+        block = np.asarray(values[start:stop, b0:b1], dtype=dtype)
+        lo = np.clip(bounds[start:stop, 0], b0, b1) - b0
+        hi = np.maximum(np.clip(bounds[start:stop, 1], b0, b1) - b0, lo)
+        n = (hi - lo).astype(np.float64)
+        sqq = q_squares[hi] - q_squares[lo]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if metric == 'l2':
+                # Squared differences over the band, minus the part of the query outside the row's range
+                difference = block - q_block
+                squares = np.einsum('ij,ij->i', difference, difference).astype(np.float64)
+                squares -= q_squares[-1] - sqq
+                result = np.sqrt(np.maximum(squares, 0.0) / sqq)
+            else:
+                sxq = (block @ q_block).astype(np.float64)
+                sxx = np.einsum('ij,ij->i', block, block).astype(np.float64)
+                if metric == 'cosine':
+                    result = sxq / np.sqrt(sxx * sqq)
+                else:
+                    sx = block.sum(axis=1)
+                    sq = q_sum[hi] - q_sum[lo]
+                    result = (n * sxq - sx * sq) / np.sqrt((n * sxx - sx * sx) * (n * sqq - sq * sq))
+        result[n < MIN_OVERLAP * width] = np.nan
+        scores[start:stop] = np.where(np.isfinite(result), result, np.nan)
+    return scores
+
+
+class SimilarityIndex:
+    """
+    Resampled curves of the indexed spectra: `ids` (N,), and per curve a (N, len(grid)) float32 matrix and the
+    (N, 2) column ranges the rows cover. The arrays may be memory-mapped.
+    """
+
+    def __init__(self, grid, ids, curves):
+        self.grid = grid
+        self.ids = ids
+        self.curves = curves  # {name: (values, bounds)}
+        self._rows = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, pk):
+        """Row index of a spectrum, or None if it is not indexed."""
+        if self._rows is None:
+            self._rows = {int(pk): row for row, pk in enumerate(self.ids)}
+        return self._rows.get(int(pk))
+
+    def spectrum_rows(self, pk):
+        """{curve: (row, lo, hi)} of an indexed spectrum (as from `curve_rows`), or None."""
+        row = self.row(pk)
+        if row is None:
+            return None
+        return {name: (np.array(values[row]), *map(int, bounds[row])) for name, (values, bounds) in self.curves.items()}
+
+    def band(self, query_rows, curves, fmin=None, fmax=None):
+        """Columns lo:hi that are compared: the requested band within the frequency range of the query."""
+        lo = 0 if fmin is None else int(np.searchsorted(self.grid, fmin, 'left'))
+        hi = len(self.grid) if fmax is None else int(np.searchsorted(self.grid, fmax, 'right'))
+        for name in curves:
+            _, query_lo, query_hi = query_rows[name]
+            lo, hi = max(lo, query_lo), min(hi, query_hi)
+        return lo, max(hi, lo)
+
+    def query(self, query_rows, k=10, metric='cosine', curves=tuple(CURVES), fmin=None, fmax=None, exclude=()):
+        """
+        The k indexed spectra most similar to the query (`query_rows` as returned by `curve_rows`), as
+        [(spectrum id, score)], best first. Scores of several curves are averaged. Cosine and correlation scores are
+        higher for more similar spectra; l2 is the RMS difference relative to the RMS of the query, lower is better.
+        Raises ValueError if the query has too few points in the band.
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric '{metric}'.")
+        band = self.band(query_rows, curves, fmin, fmax)
+        if band[1] - band[0] < 2:
+            raise ValueError("The query spectrum has less than two points in the compared frequency band.")
+        if not len(self.ids):
+            return []
+
+        scores = np.zeros(len(self.ids))
+        for name in curves:
+            values, bounds = self.curves[name]
+            scores += _curve_scores(values, bounds, query_rows[name][0], band, metric)
+        scores /= len(curves)
+        if metric == 'l2':
+            scores = -scores  # Rank by similarity, highest first
+        if len(exclude):
+            scores[np.isin(self.ids, list(exclude))] = np.nan
+
+        candidates = np.flatnonzero(~np.isnan(scores))
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        sign = -1 if metric == 'l2' else 1
+        return [(int(self.ids[row]), float(sign * scores[row])) for row in candidates]
+
+    def band_frequencies(self, band):
+        lo, hi = band
+        return (float(self.grid[lo]), float(self.grid[hi - 1])) if hi > lo else (None, None)
+
+
+# On-disk layout: header.json, ids.bin (int64), <curve>.bin (float32 rows), <curve>_bounds.bin (int32 pairs)
+
+def _files(root):
+    return ['ids.bin'] + [f'{name}{suffix}.bin' for name in CURVES for suffix in ('', '_bounds')]
+
+
+@contextmanager
+def _locked(root, exclusive=False):
+    root.mkdir(parents=True, exist_ok=True)
+    with open(root / '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _grid_spec(grid):
+    return [float(grid[0]), float(grid[-1]), len(grid)]
+
+
+def _read_header(root, grid):
+    """The index header, or None if there is no index or it was built for another grid or layout."""
+    try:
+        header = json.loads((root / 'header.json').read_text())
+    except (OSError, ValueError):
+        return None
+    if header.get('version') != INDEX_VERSION or header.get('grid') != _grid_spec(grid):
+        return None
+    return header
+
+
+def _write_header(root, grid, count, generation):
+    partial = root / 'header.json.part'
+    partial.write_text(json.dumps(
+        {'version': INDEX_VERSION, 'grid': _grid_spec(grid), 'count': count, 'generation': generation}
+    ))
+    os.replace(partial, root / 'header.json')
+
+
+def _open(root, grid, count, mode='r'):
+    def memmap(name, dtype, shape):
+        if not count:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(root / name, dtype=dtype, mode=mode, shape=shape)
+
+    curves = {
+        name: (memmap(f'{name}.bin', np.float32, (count, len(grid))), memmap(f'{name}_bounds.bin', np.int32, (count, 2)))
+        for name in CURVES
+    }
+    return SimilarityIndex(grid, memmap('ids.bin', np.int64, (count,)), curves)
+
+
+def _iter_spectrum_rows(grid, batch_size=BUILD_BATCH_SIZE):
+    """(ids, [curve_rows]) of all spectra in id order, reading `batch_size` spectra per query."""
+    last_pk = 0
+    while True:
+        batch = list(
+            Spectrum.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', *PROCESSED_ARRAY_FIELDS)[:batch_size]
+        )
+        if not batch:
+            return
+        last_pk = batch[-1][0]
+        rows = []
+        for _, frequency, refractive_index, absorption_coefficient in batch:
+            rows.append(curve_rows(grid, frequency, {
+                'refractive_index': refractive_index, 'absorption_coefficient': absorption_coefficient,
+            }))
+        yield np.array([pk for pk, *_ in batch], dtype=np.int64), rows
+
+
+def _stack(rows, name):
+    values = np.stack([curve[name][0] for curve in rows])
+    bounds = np.array([curve[name][1:] for curve in rows], dtype=np.int32).reshape(-1, 2)
+    return values, bounds
+
+
+def build_similarity_index(batch_size=BUILD_BATCH_SIZE):
+    """
+    Build the index of all spectra from the database. With SIMILARITY_INDEX_ROOT, the arrays are written to disk
+    batch by batch (memory use does not depend on the number of spectra) and replace the previous index.
+    Returns the new SimilarityIndex.
+    """
+    grid = similarity_grid()
+    root = similarity_index_root()
+    if root is None:
+        ids, parts = [], {name: ([], []) for name in CURVES}
+        for batch_ids, rows in _iter_spectrum_rows(grid, batch_size):
+            ids.append(batch_ids)
+            for name in CURVES:
+                values, bounds = _stack(rows, name)
+                parts[name][0].append(values)
+                parts[name][1].append(bounds)
+        if not ids:
+            return SimilarityIndex(grid, np.zeros(0, dtype=np.int64), {
+                name: (np.zeros((0, len(grid)), dtype=np.float32), np.zeros((0, 2), dtype=np.int32)) for name in CURVES
+            })
+        return SimilarityIndex(grid, np.concatenate(ids), {
+            name: (np.concatenate(values), np.concatenate(bounds)) for name, (values, bounds) in parts.items()
+        })
+
+    root.mkdir(parents=True, exist_ok=True)
+    names = _files(root)
+    outputs = {name: open(root / f'{name}.part', 'wb') for name in names}
+    count = 0
+    try:
+        for batch_ids, rows in _iter_spectrum_rows(grid, batch_size):
+            outputs['ids.bin'].write(batch_ids.tobytes())
+            for name in CURVES:
+                values, bounds = _stack(rows, name)
+                outputs[f'{name}.bin'].write(values.tobytes())
+                outputs[f'{name}_bounds.bin'].write(bounds.tobytes())
+            count += len(batch_ids)
+    except BaseException:
+        for name, output in outputs.items():
+            output.close()
+            (root / f'{name}.part').unlink(missing_ok=True)
+        raise
+    for output in outputs.values():
+        output.close()
+
+    with _locked(root, exclusive=True):
+        previous = _read_header(root, grid)
+        for name in names:
+            os.replace(root / f'{name}.part', root / name)
+        # The header goes last: readers holding the shared lock see either the old or the new index
+        _write_header(root, grid, count, (previous or {}).get('generation', 0) + 1)
+    return _open(root, grid, count)
+
+
+_index_lock = threading.Lock()
+_cached_index = None
+_cached_state = None
+
+
+def _database_state():
+    return tuple(Spectrum.objects.aggregate(count=Count('id'), last=Max('updated_at')).values())
+
+
+def get_similarity_index():
+    """
+    The current index of this process, reopened when another process changed the on-disk index (or, without
+    SIMILARITY_INDEX_ROOT, rebuilt when spectra were added, changed or deleted).
+    """
+    global _cached_index, _cached_state
+    root = similarity_index_root()
+    with _index_lock:
+        if root is None:
+            state = _database_state()
+            if _cached_index is None or state != _cached_state:
+                _cached_index, _cached_state = build_similarity_index(), state
+            return _cached_index
+
+        grid = similarity_grid()
+        with _locked(root):
+            header = _read_header(root, grid)
+            if header is not None:
+                state = (str(root), header['generation'])
+                if _cached_index is None or state != _cached_state:
+                    _cached_index, _cached_state = _open(root, grid, header['count']), state
+                return _cached_index
+        _cached_index = build_similarity_index()
+        _cached_state = None  # Reopened from the header on the next call
+        return _cached_index
+
+
+def search_similar(query_rows, exclude=(), **options):
+    """
+    Query the current index (see SimilarityIndex.query for the options).
+    Returns ([(Spectrum, score)], (first, last) frequency of the compared band); the matching spectra are read with
+    their materials in one query.
+    """
+    index = get_similarity_index()
+    matches = index.query(query_rows, exclude=exclude, **options)
+    spectra = Spectrum.objects.select_related('material').in_bulk([pk for pk, _ in matches])
+    band = index.band(query_rows, options.get('curves', tuple(CURVES)), options.get('fmin'), options.get('fmax'))
+    # Spectra deleted since the index was read are skipped
+    return [(spectra[pk], score) for pk, score in matches if pk in spectra], index.band_frequencies(band)
+
+
+def search_similar_to_spectrum(spectrum, **options):
+    """search_similar for a stored spectrum (excluding itself), using its indexed rows where possible."""
+    query_rows = get_similarity_index().spectrum_rows(spectrum.pk)
+    if query_rows is None:
+        query_rows = spectrum_rows(similarity_grid(), spectrum)
+    return search_similar(query_rows, exclude=[spectrum.pk], **options)
+
+
+def _update_on_disk(root, upserts, removed=()):
+    """Write {spectrum id: curve rows} into the on-disk index and mask the rows of `removed` spectra."""
+    grid = similarity_grid()
+    with _locked(root, exclusive=True):
+        header = _read_header(root, grid)
+        if header is None:
+            return  # Built from the database, including these spectra, on the next query
+        count = header['count']
+        index = _open(root, grid, count, mode='r+')
+        changed = [pk for pk in list(upserts) + list(removed) if index.row(pk) is not None]
+        for pk in changed:
+            row = index.row(pk)
+            for name, (values, bounds) in index.curves.items():
+                if pk in upserts:
+                    values[row], lo, hi = upserts[pk][name]
+                    bounds[row] = (lo, hi)
+                else:
+                    bounds[row] = (0, 0)  # Never comparable, dropped by the next rebuild
+        for values, bounds in index.curves.values():
+            if isinstance(values, np.memmap):
+                values.flush()
+                bounds.flush()
+
+        new = [pk for pk in upserts if index.row(pk) is None]
+        if new:
+            with open(root / 'ids.bin', 'ab') as f:
+                f.write(np.array(new, dtype=np.int64).tobytes())
+            for name in CURVES:
+                values, bounds = _stack([upserts[pk] for pk in new], name)
+                with open(root / f'{name}.bin', 'ab') as f:
+                    f.write(values.tobytes())
+                with open(root / f'{name}_bounds.bin', 'ab') as f:
+                    f.write(bounds.tobytes())
+        if changed or new:
+            _write_header(root, grid, count + len(new), header['generation'] + 1)
+
+
+def update_similarity_index(spectra):
+    """
+    Add new or reprocessed spectra to the on-disk index (nothing to do for an in-memory index, which is rebuilt).
+    Failures are only reported, storing spectra must not depend on the index.
+    """
+    root = similarity_index_root()
+    spectra = [spectrum for spectrum in spectra if spectrum.pk is not None]
+    if root is None or not spectra:
+        return
+    try:
+        load_arrays([spectrum for spectrum in spectra if 'frequency_data' in spectrum.get_deferred_fields()],
+                    PROCESSED_ARRAY_FIELDS)
+        grid = similarity_grid()
+        _update_on_disk(root, {spectrum.pk: spectrum_rows(grid, spectrum) for spectrum in spectra})
+    except Exception:
+        logger.exception("Could not update the similarity index")
+
+
+@receiver(post_save, sender=Spectrum, dispatch_uid='spectra_update_similarity_index')
+def index_saved_spectrum(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not set(update_fields).intersection(PROCESSED_ARRAY_FIELDS):
+        return
+    transaction.on_commit(lambda: update_similarity_index([instance]))
+
+
+@receiver(post_delete, sender=Spectrum, dispatch_uid='spectra_remove_from_similarity_index')
+def remove_deleted_spectrum(sender, instance, **kwargs):
+    root = similarity_index_root()
+    if root is None:
+        return
+    try:
+        _update_on_disk(root, {}, removed=[instance.pk])
+    except Exception:
+        logger.exception("Could not update the similarity index")
@@ -0,0 +1,141 @@
+"""
+Staged-upload store for .thz files waiting to be processed.
+
+Uploads are streamed chunk by chunk into STAGED_UPLOAD_ROOT while their SHA-256 is computed, so memory use per
+upload is bounded by the chunk size. Every staged upload is identified by an opaque random key; sessions and
+processing jobs only keep that key. Staged files that are older than STAGED_UPLOAD_TTL are removed by the
+`cleanup_staged_uploads` management command.
+"""
+import hashlib
+import json
+import os
+import re
+import secrets
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from django.conf import settings
+
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_STAGED_UPLOAD_TTL = 24 * 3600
+
+_KEY_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+@dataclass
+class StagedUpload:
+    key: str
+    name: str
+    size: int
+    sha256: str
+
+    @property
+    def path(self):
+        return str(_data_path(self.key))
+
+
+def staging_root():
+    root = Path(getattr(settings, 'STAGED_UPLOAD_ROOT', None) or Path(settings.BASE_DIR) / 'staged_uploads')
+    root.mkdir(parents=True, exist_ok=True)
+    return root
+
+
+def staged_upload_ttl():
+    return getattr(settings, 'STAGED_UPLOAD_TTL', DEFAULT_STAGED_UPLOAD_TTL)
+
+
+def _data_path(key):
+    return staging_root() / f"{key}.upload"
+
+
+def _info_path(key):
+    return staging_root() / f"{key}.json"
+
+
+def _iter_chunks(fileobj, chunk_size):
+    if hasattr(fileobj, 'chunks'):
+        yield from fileobj.chunks(chunk_size)
+        return
+    if hasattr(fileobj, 'seek'):
+        fileobj.seek(0)
+    while chunk := fileobj.read(chunk_size):
+        yield chunk
+
+
+def stage_upload(fileobj, name=None, chunk_size=CHUNK_SIZE):
+    """
+    Stream `fileobj` (an UploadedFile, django File or binary file object) into the store.
+    The data is written to a temporary name first and renamed once complete, so a staged file is never partial.
+    """
+    key = secrets.token_hex(16)
+    name = Path(name or getattr(fileobj, 'name', None) or 'upload').name
+    digest = hashlib.sha256()
+    size = 0
+
+    partial = staging_root() / f"{key}.part"
+    try:
+        with open(partial, 'wb') as out:
+            for chunk in _iter_chunks(fileobj, chunk_size):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        os.replace(partial, _data_path(key))
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+
+    staged = StagedUpload(key=key, name=name, size=size, sha256=digest.hexdigest())
+    _info_path(key).write_text(json.dumps({'name': staged.name, 'size': staged.size, 'sha256': staged.sha256}))
+    return staged
+
+
+def file_sha256(fileobj, chunk_size=CHUNK_SIZE):
+    """SHA-256 of `fileobj` (same argument types as stage_upload), read chunk by chunk."""
+    digest = hashlib.sha256()
+    for chunk in _iter_chunks(fileobj, chunk_size):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_staged(key):
+    """Return the StagedUpload for `key`, or None if the key is invalid, expired or already discarded."""
+    if not key or not _KEY_RE.match(key):
+        return None
+    try:
+        info = json.loads(_info_path(key).read_text())
+    except (OSError, ValueError):
+        return None
+    if not _data_path(key).exists():
+        return None
+    return StagedUpload(key=key, name=info['name'], size=info['size'], sha256=info['sha256'])
+
+
+def discard_staged(key):
+    if not key or not _KEY_RE.match(key):
+        return
+    _data_path(key).unlink(missing_ok=True)
+    _info_path(key).unlink(missing_ok=True)
+
+
+def cleanup_staged_uploads(max_age=None, keep=()):
+    """
+    Remove staged files (and leftovers of interrupted writes) older than `max_age` seconds, except the keys in `keep`.
+    Returns the keys that were removed.
+    """
+    max_age = staged_upload_ttl() if max_age is None else max_age
+    cutoff = time.time() - max_age
+    keep = set(keep)
+    removed = set()
+    for path in staging_root().iterdir():
+        key = path.name.split('.', 1)[0]
+        if key in keep or not _KEY_RE.match(key):
+            continue
+        try:
+            if path.stat().st_mtime >= cutoff:
+                continue
+            path.unlink()
+        except FileNotFoundError:
+            continue
+        removed.add(key)
+    return removed
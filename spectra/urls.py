@@ -11,14 +11,23 @@ urlpatterns = [
     path('spectra', views.SpectrumListView.as_view(), name='spectrum_list'),
 
     path('<int:pk>/', views.spectrum_list_or_detail, name='spectrum_detail'),
+    path('<int:pk>/plot-data/', views.spectrum_plot_data, name='spectrum_plot_data'),
     path('<int:pk>/download/', views.download_spectrum_file, name='download_spectrum_file'),
+    path('export/', views.export_spectra, name='export_spectra'),
     path('spectrum/upload/', views.upload_spectrum, name='upload_spectrum'),
+    path('spectrum/upload/bulk/', views.bulk_upload, name='bulk_upload'),
+    path('spectrum/upload/jobs/<int:pk>/', views.processing_job_view, name='processing_job'),
     path('token/regenerate/', views.regenerate_token_view, name='regenerate_token'),
     path('material/<int:material_id>/image/', views.material_image_view, name='material_image'),
 
     path('api/upload/', views.api_upload_spectrum, name='api_upload_spectrum'),
+    path('api/upload/bulk/', views.api_bulk_upload, name='api_bulk_upload'),
     path('api/spectra/', views.api_spectrum_list, name='api_spectrum_list'),
+    path('api/spectra/batch/', views.api_spectrum_batch, name='api_spectrum_batch'),
     path('api/spectra/<int:pk>/', views.api_spectrum_detail, name='api_spectrum_detail'),
+    path('api/spectra/<int:pk>/similar/', views.api_similar_spectra, name='api_similar_spectra'),
+    path('api/similar/', views.api_similarity_search, name='api_similarity_search'),
+    path('api/jobs/<int:pk>/', views.api_processing_job, name='api_processing_job'),
 
     # Password Change URLs
     path('password_change/',
@@ -1,27 +1,58 @@
 # spectra/views.py
-import base64
-
-from pydotthz import DotthzFile, DotthzMeasurement, DotthzMetaData
-from django.forms import forms
 from django.shortcuts import redirect
 from django.contrib.auth.decorators import login_required
 from django.views.generic import ListView
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework import status
 
-from .serializers import SpectrumSerializer
-from .models import Material
-from .forms import SpectrumUploadForm, SpectrumFilterForm
+from .serializers import ProcessingJobSerializer, SpectrumSerializer
+from .models import Material, ProcessingJob
+from .forms import (
+    ApiUploadForm, BulkUploadForm, FrequencyRangeForm, SimilarityQueryForm, SpectrumUploadForm, SpectrumFilterForm,
+)
+from .jobs import (
+    IdempotencyConflict, enqueue_bulk_upload, enqueue_upload, find_idempotent_job, max_queued_jobs, queued_job_count,
+    retry_job,
+)
+from .export import (
+    cached_spectrum_export, export_filename, stream_zip_export, write_multi_measurement_export, write_spectra,
+)
+from .facets import facet_counts, with_queries
+from .pagination import SpectrumCursorPagination, SpectrumSortedPagination
+from .renderers import BINARY_RENDERERS
+from .similarity import (
+    CURVES as SIMILARITY_CURVES, curve_rows, get_similarity_index, search_similar, search_similar_to_spectrum,
+    similarity_grid, spectrum_rows,
+)
+from .staging import discard_staged, get_staged, stage_upload
 import io
+import logging
+import tempfile
 from rest_framework.authtoken.models import Token
-from django.http import HttpResponse
-import numpy as np
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 
 from django.shortcuts import render, get_object_or_404
-from .models import Spectrum
+from .models import ARRAY_FIELDS, PROCESSED_ARRAY_FIELDS, RAW_ARRAY_FIELDS, Spectrum, load_arrays
+from .processing import (
+    DEFAULT_PREVIEW_WIDTH, PREVIEW_CURVES, PREVIEW_WIDTHS, build_plot_previews, decimate_curve, parse_thz_file,
+    resample_spectrum, slice_frequency_range,
+)
 import plotly.graph_objs as go
+from django.http import JsonResponse
+from django.conf import settings
+from django.core.cache import cache
+from django import forms
+from django.urls import reverse
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Default renderers (JSON, browsable API) plus the binary formats for analysis clients
+API_RENDERERS = list(api_settings.DEFAULT_RENDERER_CLASSES) + BINARY_RENDERERS
 
 
 def home_view(request):
@@ -40,25 +71,7 @@ def home_view(request):
 def spectrum_list_or_detail(request, pk=None):
     spectra = Spectrum.objects.select_related('material', 'uploaded_by').all()
     filter_form = SpectrumFilterForm(request.GET or None)
-
-    if filter_form.is_valid():
-        name = filter_form.cleaned_data.get('name')
-        uploaded_by = filter_form.cleaned_data.get('uploaded_by')
-        upload_date_from = filter_form.cleaned_data.get('upload_date_from')
-        upload_date_to = filter_form.cleaned_data.get('upload_date_to')
-        meta_key = filter_form.cleaned_data.get('meta_key')
-        meta_value = filter_form.cleaned_data.get('meta_value')
-
-        if name:
-            spectra = spectra.filter(material__name__icontains=name)
-        if uploaded_by:
-            spectra = spectra.filter(uploaded_by__username__icontains=uploaded_by)
-        if upload_date_from:
-            spectra = spectra.filter(upload_timestamp__date__gte=upload_date_from)
-        if upload_date_to:
-            spectra = spectra.filter(upload_timestamp__date__lte=upload_date_to)
-        if meta_key and meta_value:
-            spectra = spectra.filter(metadata__has_key=meta_key, metadata__contains={meta_key: meta_value})
+    spectra = filter_form.filter_queryset(spectra)
 
     spectrum = None
     plotly_fig_refidx = None
@@ -76,15 +89,18 @@ def spectrum_list_or_detail(request, pk=None):
     )
 
     if pk is not None:
-        spectrum = get_object_or_404(Spectrum, pk=pk)
-        freq = getattr(spectrum, 'frequency_data', [])
-        refidx = getattr(spectrum, 'refractive_index_data', [])
-        abscoeff = getattr(spectrum, 'absorption_coefficient_data', [])
+        spectrum = get_object_or_404(
+            Spectrum.objects.select_related('material', 'uploaded_by').with_arrays('plot_previews'), pk=pk
+        )
+        # Plot the decimated previews, the page fetches full resolution data from spectrum_plot_data on zoom
+        preview = _plot_preview(spectrum)
+        refidx = preview.get('refractive_index')
+        abscoeff = preview.get('absorption_coefficient')
 
         # Refractive index plot
         fig_refidx = go.Figure()
-        if freq and refidx:
-            fig_refidx.add_trace(go.Scatter(x=freq, y=refidx, mode='lines', name=spectrum.material.name))
+        if refidx:
+            fig_refidx.add_trace(go.Scatter(x=refidx['x'], y=refidx['y'], mode='lines', name=spectrum.material.name))
             fig_refidx.update_layout(
                 title="Refractive Index",
                 xaxis_title="Frequency [THz]",
@@ -97,8 +113,9 @@ def spectrum_list_or_detail(request, pk=None):
 
         # Absorption coefficient plot
         fig_abscoeff = go.Figure()
-        if freq and abscoeff:
-            fig_abscoeff.add_trace(go.Scatter(x=freq, y=abscoeff, mode='lines', name=spectrum.material.name))
+        if abscoeff:
+            fig_abscoeff.add_trace(go.Scatter(x=abscoeff['x'], y=abscoeff['y'], mode='lines',
+                                              name=spectrum.material.name))
             fig_abscoeff.update_layout(
                 title="Absorption Coefficient",
                 xaxis_title="Frequency [THz]",
@@ -127,6 +144,7 @@ def spectrum_list_or_detail(request, pk=None):
     return render(request, 'spectra/spectrum_list.html', {
         'spectra': spectra,
         'filter_form': filter_form,
+        'facets': with_queries(facet_counts(filter_form, spectra), request.GET),
         'selected_spectrum': spectrum,
         'plotly_fig_refidx': plotly_fig_refidx,
         'plotly_fig_abscoeff': plotly_fig_abscoeff,
@@ -134,6 +152,46 @@ def spectrum_list_or_detail(request, pk=None):
     })
 
 
+def _plot_preview(spectrum, width=DEFAULT_PREVIEW_WIDTH):
+    """Stored plot preview of a spectrum, computed on the fly for spectra uploaded before previews existed."""
+    previews = spectrum.plot_previews or {}
+    if str(width) in previews:
+        return previews[str(width)]
+    return build_plot_previews(
+        spectrum.frequency_data, spectrum.refractive_index_data, spectrum.absorption_coefficient_data,
+        widths=(width,)
+    )[str(width)]
+
+
+def spectrum_plot_data(request, pk):
+    """
+    Full resolution curves within a frequency window (fmin/fmax in THz), decimated to at most `width` points.
+    Requested by the detail page when the user zooms into a plot.
+    """
+    spectrum = get_object_or_404(Spectrum.objects.with_arrays(*PROCESSED_ARRAY_FIELDS), pk=pk)
+    try:
+        fmin = float(request.GET['fmin']) if request.GET.get('fmin') else None
+        fmax = float(request.GET['fmax']) if request.GET.get('fmax') else None
+        width = int(request.GET.get('width', DEFAULT_PREVIEW_WIDTH))
+    except ValueError:
+        return JsonResponse({'error': 'fmin, fmax and width must be numbers.'}, status=400)
+    width = max(3, min(width, max(PREVIEW_WIDTHS)))
+
+    frequency = spectrum.frequency_data
+    window = slice_frequency_range(frequency, fmin, fmax)
+    # Include one point beyond each edge so the curve reaches the border of the plot
+    window = slice(max(window.start - 1, 0), min(window.stop + 1, len(frequency)))
+
+    data = {}
+    for name, field_name in PREVIEW_CURVES.items():
+        values = getattr(spectrum, field_name)
+        if len(values) != len(frequency) or window.start >= window.stop:
+            continue
+        x, y = decimate_curve(frequency[window], values[window], width)
+        data[name] = {'x': x.tolist(), 'y': y.tolist()}
+    return JsonResponse(data)
+
+
 class SpectrumListView(ListView):
     model = Spectrum
     template_name = 'spectra/spectrum_list.html'
@@ -143,29 +201,12 @@ class SpectrumListView(ListView):
     def get_queryset(self):
         queryset = super().get_queryset().select_related('material', 'uploaded_by')
         self.filter_form = SpectrumFilterForm(self.request.GET or None)
-        if self.filter_form.is_valid():
-            name = self.filter_form.cleaned_data.get('name')
-            uploaded_by = self.filter_form.cleaned_data.get('uploaded_by')
-            upload_date_from = self.filter_form.cleaned_data.get('upload_date_from')
-            upload_date_to = self.filter_form.cleaned_data.get('upload_date_to')
-            meta_key = self.filter_form.cleaned_data.get('meta_key')
-            meta_value = self.filter_form.cleaned_data.get('meta_value')
-
-            if name:
-                queryset = queryset.filter(material__name__icontains=name)
-            if uploaded_by:
-                queryset = queryset.filter(uploaded_by__username__icontains=uploaded_by)
-            if upload_date_from:
-                queryset = queryset.filter(upload_timestamp__date__gte=upload_date_from)
-            if upload_date_to:
-                queryset = queryset.filter(upload_timestamp__date__lte=upload_date_to)
-            if meta_key and meta_value:
-                queryset = queryset.filter(metadata__has_key=meta_key, metadata__contains={meta_key: meta_value})
-        return queryset
+        return self.filter_form.filter_queryset(queryset)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['filter_form'] = getattr(self, 'filter_form', SpectrumFilterForm())
+        context['facets'] = with_queries(facet_counts(context['filter_form'], self.object_list), self.request.GET)
         return context
 
 
@@ -185,281 +226,625 @@ def regenerate_token_view(request):
     return redirect('spectra:home')
 
 
+# Session key holding the staging key of a .thz file that was uploaded with an otherwise invalid form
+STAGED_UPLOAD_SESSION_KEY = 'staged_upload_key'
+
+
 @login_required
 def upload_spectrum(request):
     initial_form_data = {}
     if request.method == 'GET':
+        # A fresh form starts without a previously staged file
+        discard_staged(request.session.pop(STAGED_UPLOAD_SESSION_KEY, None))
         if 'material_id' in request.GET:
             try:
                 material_instance = Material.objects.get(pk=request.GET['material_id'])
                 initial_form_data['material_name'] = material_instance.name
             except (Material.DoesNotExist, ValueError):
                 pass
-        # Clear session state on a new GET request or initial page load
-        request.session.pop('upload_file_content_b64', None)
-        request.session.pop('upload_file_name', None)
-        request.session.pop('prompt_thickness', None)
         form = SpectrumUploadForm(initial=initial_form_data)
-        return render(request, 'spectra/upload_spectrum.html', {'form': form, 'prompt_thickness': False})
+        return render(request, 'spectra/upload_spectrum.html', {'form': form})
 
     # POST request handling
-    # Instantiate form once with all POST data and FILES
+    staged = get_staged(request.session.get(STAGED_UPLOAD_SESSION_KEY))
     form = SpectrumUploadForm(request.POST, request.FILES)
-    file_to_parse = None
-    # Determine if the template should prompt for thickness based on session state
-    prompt_thickness_context = request.session.get('prompt_thickness', False)
-
-    # Scenario 1: A new binary file is being uploaded in the current request
-    if 'binary_data_file' in request.FILES:
-        uploaded_file = request.FILES['binary_data_file']
-        binary_file_content_from_current_upload = uploaded_file.read()
-        # Reset file pointer so Django can handle the file if form.is_valid() is called later
-        # and the file needs to be processed by ModelForm's save.
-        uploaded_file.seek(0)
-
-        # Store file content in session for potential re-submission (e.g., if thickness is needed)
-        request.session['upload_file_content_b64'] = base64.b64encode(binary_file_content_from_current_upload).decode(
-            'ascii')
-        request.session['upload_file_name'] = uploaded_file.name
-        # If a new file is uploaded, reset the prompt_thickness flag in session and context
-        request.session['prompt_thickness'] = False
-        prompt_thickness_context = False
-        file_to_parse = io.BytesIO(binary_file_content_from_current_upload)
-
-    # Scenario 2: No new file in request.FILES, but one exists in session
-    # (e.g., user is re-submitting after being prompted for thickness)
-    elif request.session.get('upload_file_content_b64'):
-        file_bytes_b64 = request.session.get('upload_file_content_b64')
-        file_bytes = base64.b64decode(file_bytes_b64)
-        file_to_parse = io.BytesIO(file_bytes)
-        # prompt_thickness_context is already True if 'prompt_thickness' is true in session
-
-    # If we have binary file content (either from new upload or session)
-    if file_to_parse:
-        # Get sample_thickness value if user submitted it (e.g., after being prompted)
-        sample_thickness_val = request.POST.get('sample_thickness')
-        try:
-            # Call _parse_binary_file with the file content and optional thickness
-            material_name = form.data.get('material_name') # Or request.POST.get('material_name')
-            parsed_result = form._parse_binary_file(
-                file_to_parse,
-                material_name,
-                sample_thickness=sample_thickness_val
-            )
+    form.staged_upload_from_view = staged
+    is_valid = form.is_valid()
+
+    binary_file = form.cleaned_data.get('binary_data_file')
+    if binary_file:
+        # A newly selected file replaces a previously staged one
+        if staged:
+            discard_staged(staged.key)
+        staged = stage_upload(binary_file)
+
+    if not is_valid:
+        # Keep the .thz file on disk (the session only holds its key), so the user does not have to select it again
+        if staged:
+            request.session[STAGED_UPLOAD_SESSION_KEY] = staged.key
+        return render(request, 'spectra/upload_spectrum.html', {'form': form, 'staged_upload': staged})
+
+    if binary_file or (staged and not form.cleaned_data.get('data_file')):
+        # The .thz processing (HDF5 parsing, windowing, slab fit, ChemSpider lookups) runs in the
+        # `process_jobs` worker; the request only stages the file and hands out the job.
+        request.session.pop(STAGED_UPLOAD_SESSION_KEY, None)
+        job = enqueue_upload(
+            staged,
+            request.user,
+            form.cleaned_data['material_name'],
+            notes=form.cleaned_data.get('notes'),
+            sample_thickness=form.cleaned_data.get('sample_thickness'),
+            link_duplicate=form.cleaned_data.get('link_duplicate', False),
+            all_measurements=form.cleaned_data.get('all_measurements', False),
+            find_similar=form.cleaned_data.get('find_similar', False),
+        )
+        return redirect('spectra:processing_job', pk=job.pk)
+
+    # CSV route: nothing to process, save directly
+    if staged:
+        discard_staged(request.session.pop(STAGED_UPLOAD_SESSION_KEY, None))
+    spectrum_instance = form.save(commit=False)
+    spectrum_instance.uploaded_by = request.user  # Assign the logged-in user
+    spectrum_instance.save()
+    return redirect('spectra:spectrum_list')  # Or your desired success URL
 
-            # If parsing is successful and returns the expected tuple
-            if isinstance(parsed_result, tuple) and len(parsed_result) == 2:
-                spectral_data_dict, metadata_dict = parsed_result
-                # Attach parsed data to the form instance
-                form.parsed_spectral_data_from_view = spectral_data_dict
-                form.final_metadata_from_view = metadata_dict
-
-                # Successfully parsed, clear session state related to this file upload
-                request.session.pop('upload_file_content_b64', None)
-                request.session.pop('upload_file_name', None)
-                request.session.pop('prompt_thickness', None)
-                prompt_thickness_context = False  # Reset prompt on success
-            # No 'else' here; if parsing fails in a way that _parse_binary_file handles by returning
-            # something else (which it currently doesn't, it raises errors), that would be an issue.
 
-        except forms.ValidationError as e:
-            # Add validation errors from _parse_binary_file to the form
-            form.add_error(None, e)
-            # Check if the error is specifically about missing thickness
-            if any("Metadata 'Sample Thickness (mm)' not found and no thickness provided" in msg for msg in e.messages):
-                request.session['prompt_thickness'] = True  # Set flag to prompt for thickness on next render
-                prompt_thickness_context = True
-            else:
-                # For other parsing errors (e.g. multiple datasets), clear session file to avoid reprocessing bad data
-                # and reset thickness prompt as it's not the issue.
-                request.session.pop('upload_file_content_b64', None)
-                request.session.pop('upload_file_name', None)
-                request.session.pop('prompt_thickness', None)
-                prompt_thickness_context = False
-
-        except Exception as e:  # Catch other unexpected errors during parsing
-            form.add_error(None, f"An unexpected error occurred during file processing: {e}")
-            # Clear session and reset prompt for unexpected errors too
-            request.session.pop('upload_file_content_b64', None)
-            request.session.pop('upload_file_name', None)
-            request.session.pop('prompt_thickness', None)
-            prompt_thickness_context = False
-
-    # After attempting to parse (if applicable), validate the whole form.
-    # form.is_valid() will:
-    # - Be true if binary parsing succeeded and data was attached, and other fields are valid.
-    # - Be false if binary parsing failed and form.add_error was called.
-    # - Run standard validation for other fields (material_name, notes).
-    # - Handle CSV validation if data_file was uploaded and no binary_file.
-    if form.is_valid():
-        spectrum_instance = form.save(commit=False)
-        spectrum_instance.uploaded_by = request.user  # Assign the logged-in user
-        spectrum_instance.save()
-        # form.save_m2m() # Call if your form has many-to-many fields to save
-
-        # Fully clear session state on successful save
-        request.session.pop('upload_file_content_b64', None)
-        request.session.pop('upload_file_name', None)
-        request.session.pop('prompt_thickness', None)
-        return redirect('spectra:spectrum_list')  # Or your desired success URL
-    else:
-        # Form is not valid, re-render with errors.
-        # prompt_thickness_context should be correctly set if thickness is the issue.
-        return render(request, 'spectra/upload_spectrum.html', {
-            'form': form,
-            'prompt_thickness': prompt_thickness_context
-        })
-
-
-# You would also need to ensure your 'spectra/upload_spectrum.html' template
-# can conditionally display an input field for 'sample_thickness' when 'prompt_thickness' is true.
-# Example snippet for template:
-# {% if prompt_thickness %}
-#   <p class="errornote">Sample thickness is required. Please provide it below.</p>
-#   {{ form.sample_thickness.label_tag }}
-#   {{ form.sample_thickness }}
-#   {{ form.sample_thickness.errors }}
-# {% endif %}
-# This requires 'sample_thickness' to be a field in your SpectrumUploadForm.
+@login_required
+def bulk_upload(request):
+    """Upload several .thz files (or a zip archive) at once; they are ingested by the `process_jobs` worker."""
+    if request.method == 'GET':
+        return render(request, 'spectra/bulk_upload.html', {'form': BulkUploadForm()})
+
+    form = BulkUploadForm(request.POST, request.FILES)
+    if not form.is_valid():
+        return render(request, 'spectra/bulk_upload.html', {'form': form})
+
+    job = enqueue_bulk_upload(
+        form.cleaned_data['files'],
+        request.user,
+        material_name=form.cleaned_data.get('material_name'),
+        notes=form.cleaned_data.get('notes'),
+        sample_thickness=form.cleaned_data.get('sample_thickness'),
+        link_duplicate=form.cleaned_data.get('link_duplicate', False),
+        all_measurements=form.cleaned_data.get('all_measurements', False),
+    )
+    return redirect('spectra:processing_job', pk=job.pk)
+
+
+# Number of similar spectra listed on the job page of uploads with "Find similar spectra"
+SIMILAR_SPECTRA_SHOWN = 5
 
 
 @login_required
-def download_spectrum_file(request, pk):
-    spectrum = get_object_or_404(Spectrum, pk=pk)
+def processing_job_view(request, pk):
+    """Status page of an upload processing job. Reloads itself until the job is finished."""
+    job = get_object_or_404(ProcessingJob, pk=pk, uploaded_by=request.user)
+    thickness_error = None
 
-    filename = f"{spectrum.material.name.replace(' ', '_')}_{spectrum.pk}.thz"
-    thz_buffer = io.BytesIO()
+    if request.method == 'POST' and job.status == ProcessingJob.STATUS_FAILED and job.staged_upload:
+        # Retry, e.g. with the sample thickness the file's metadata was missing
+        try:
+            sample_thickness = float(request.POST['sample_thickness']) if request.POST.get('sample_thickness') else None
+        except ValueError:
+            thickness_error = "Please enter the sample thickness as a number (mm)."
+        else:
+            retry_job(job, sample_thickness=sample_thickness)
+            return redirect('spectra:processing_job', pk=job.pk)
+
+    similar_spectra = None
+    if job.find_similar and job.status == ProcessingJob.STATUS_DONE and job.spectrum is not None:
+        try:
+            similar_spectra, _ = search_similar_to_spectrum(job.spectrum, k=SIMILAR_SPECTRA_SHOWN)
+        except ValueError:
+            similar_spectra = []
+
+    return render(request, 'spectra/processing_job.html', {
+        'job': job,
+        'thickness_error': thickness_error,
+        'similar_spectra': similar_spectra,
+    })
 
-    # Define known standard metadata fields for pydotthz.DotthzMetaData
-    standard_meta_fields = [
-        'user', 'email', 'institution', 'orcid', 'description',
-        'date', 'time', 'version', 'instrument', 'mode'
-    ]
 
-    try:
-        with DotthzFile(thz_buffer, "w") as f:
-            measurement_name = f"{spectrum.material.name.replace(' ', '_')}_ID{spectrum.pk}"
-            measurement = DotthzMeasurement()
-            measurement.datasets = {}
-
-            meta_data = DotthzMetaData()
-            # Populate metadata from spectrum.metadata
-            if spectrum.metadata:
-                for key, value in spectrum.metadata.items():
-                    if value is None:  # Skip None values or pydotthz might error
-                        continue
-                    if key in standard_meta_fields:
-                        setattr(meta_data, key, str(value))  # Ensure value is string if expected
-                    else:
-                        meta_data.md[key] = value
-
-            if not meta_data.description and spectrum.notes:  # If not set from metadata, use notes
-                meta_data.description = spectrum.notes
-            elif not meta_data.description:
-                meta_data.description = f"Exported data for {spectrum.material.name}"
-
-            # Ensure some key identifiers from the database are in the custom metadata
-            meta_data.md["DatabaseSpectrumID"] = spectrum.pk
-            meta_data.md["DatabaseMaterialName"] = spectrum.material.name
-            meta_data.md["DatabaseUploadTimestamp"] = spectrum.upload_timestamp.isoformat()
-            meta_data.md["DatabaseUploadUser"] = spectrum.uploaded_by.username
-            if spectrum.notes:
-                meta_data.md["DatabaseNotes"] = spectrum.notes
-
-            raw_sample_list_t = spectrum.raw_sample_data_t
-            raw_sample_list_p = spectrum.raw_sample_data_p
-            if raw_sample_list_t and raw_sample_list_p:
-                try:
-                    raw_sample_np = np.array([np.array([t, p]) for t, p in zip(raw_sample_list_t, raw_sample_list_p)],
-                                             dtype=float)
-                    measurement.datasets["Sample"] = raw_sample_np
-                except Exception as e_rs:
-                    print(f"Could not process raw_sample_data for spectrum {pk}: {e_rs}")
-
-            raw_reference_list_t = spectrum.raw_reference_data_t
-            raw_reference_list_p = spectrum.raw_reference_data_p
-            if raw_reference_list_t and raw_reference_list_p:
-                try:
-                    raw_reference_np = np.array(
-                        [np.array([t, p]) for t, p in zip(raw_reference_list_t, raw_reference_list_p)], dtype=float)
-                    measurement.datasets["Reference"] = raw_reference_np
-                except Exception as e_rr:
-                    print(f"Could not process raw_reference_data for spectrum {pk}: {e_rr}")
-
-            measurement.meta_data = meta_data
-            f.write_measurement(measurement_name, measurement)
+@login_required
+def download_spectrum_file(request, pk):
+    # The arrays stay deferred: they are only read if the export is not cached yet
+    spectrum = get_object_or_404(Spectrum.objects.select_related('material', 'uploaded_by'), pk=pk)
+    filename = export_filename(spectrum)
 
+    try:
+        path = cached_spectrum_export(spectrum)
+        if path is not None:
+            thz_file = open(path, 'rb')
+        else:
+            thz_file = io.BytesIO()
+            write_spectra(thz_file, [spectrum])
+            thz_file.seek(0)
     except Exception as e:
         print(f"Error creating .thz file for spectrum {pk}: {e}")
         return HttpResponse(f"Could not generate .thz file due to an internal error. Details: {e}", status=500,
                             content_type="text/plain")
 
-    thz_buffer.seek(0)
-    file_content = thz_buffer.getvalue()
-    thz_buffer.close()
+    return FileResponse(thz_file, as_attachment=True, filename=filename, content_type='application/pydotthz')
 
-    response = HttpResponse(file_content, content_type='application/pydotthz')  # Or application/octet-stream
-    response['Content-Disposition'] = f'attachment; filename="{filename}"'
-    return response
+
+@login_required
+def export_spectra(request):
+    """
+    Download many spectra at once: all spectra matching the SpectrumFilterForm parameters, or only those given by
+    `ids` (comma-separated or repeated). `format=zip` (default) streams a zip archive with one .thz file per
+    spectrum, `format=thz` returns a single .thz file with one measurement per spectrum.
+    """
+    spectra = Spectrum.objects.all()
+    ids = [value for param in request.GET.getlist('ids') for value in param.split(',') if value.strip()]
+    if ids:
+        try:
+            spectra = spectra.filter(pk__in=[int(value) for value in ids])
+        except ValueError:
+            return HttpResponse("'ids' must be a comma-separated list of spectrum ids.", status=400,
+                                content_type="text/plain")
+    else:
+        spectra = SpectrumFilterForm(request.GET or None).filter_queryset(spectra)
+
+    export_format = request.GET.get('format', 'zip')
+    if export_format not in ('zip', 'thz'):
+        return HttpResponse("'format' must be 'zip' or 'thz'.", status=400, content_type="text/plain")
+    if not spectra.exists():
+        return HttpResponse("No spectra match the request.", status=404, content_type="text/plain")
+
+    if export_format == 'zip':
+        response = StreamingHttpResponse(stream_zip_export(spectra), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="spectra.zip"'
+        return response
+
+    # HDF5 needs a seekable file, so the combined file is built in a temporary file that is removed once sent
+    thz_file = tempfile.TemporaryFile()
+    try:
+        write_multi_measurement_export(spectra, thz_file)
+    except Exception as e:
+        thz_file.close()
+        logger.exception("Error creating combined .thz file")
+        return HttpResponse(f"Could not generate .thz file due to an internal error. Details: {e}", status=500,
+                            content_type="text/plain")
+    thz_file.seek(0)
+    return FileResponse(thz_file, as_attachment=True, filename="spectra.thz", content_type='application/pydotthz')
+
+
+# Longest accepted Idempotency-Key header (the length of ProcessingJob.idempotency_key)
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+
+def _job_response(request, job, headers=None):
+    # 202 while the job is queued or running; the job's url (also in the Location header) reports its progress
+    serializer = ProcessingJobSerializer(job, context={'request': request})
+    return Response(serializer.data, status=status.HTTP_200_OK if job.is_finished else status.HTTP_202_ACCEPTED,
+                    headers={'Location': serializer.data['url'], **(headers or {})})
 
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def api_upload_spectrum(request):
     """
-    API endpoint to upload a new spectrum.
-    Expects 'binary_data_file' and 'material_name' in request.data.
+    API endpoint to upload a .thz file (multipart: 'binary_data_file', 'material_name', optional 'sample_thickness',
+    'notes', 'all_measurements', 'link_duplicate' and 'metadata', a JSON object of metadata overrides).
+    Authenticate with `Authorization: Token <key>`.
+
+    The file is processed by the `process_jobs` worker: returns 202 with the processing job, whose url (also in the
+    Location header) reports its status and the new spectrum. With an `Idempotency-Key` header, a retry with the
+    same key returns the job of the first request instead of uploading the file again (409 if the file differs).
+    Returns 429 while the user has API_UPLOAD_MAX_QUEUED_JOBS unfinished jobs.
     """
-    # This is a simplified version. You'll need to adapt it to your
-    # existing upload_spectrum logic, especially file handling and metadata extraction.
-    # Consider using a serializer for validation and saving.
-    # For example, if your SpectrumSerializer can handle file uploads:
-    # serializer = SpectrumSerializer(data=request.data, context={'request': request})
-    # if serializer.is_valid():
-    #     serializer.save(uploaded_by=request.user)
-    #     return Response(serializer.data, status=status.HTTP_201_CREATED)
-    # return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-
-    # Placeholder logic:
-    if 'binary_data_file' not in request.FILES or 'material_name' not in request.data:
-        return Response({'error': 'Missing required fields (binary_data_file, material_name).'},
+    idempotency_key = request.headers.get('Idempotency-Key', '').strip()
+    if len(idempotency_key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        return Response({'error': f"Idempotency-Key must not be longer than {MAX_IDEMPOTENCY_KEY_LENGTH} characters."},
                         status=status.HTTP_400_BAD_REQUEST)
 
-    # Add your file processing and model creation logic here
-    # Example:
-    # spectrum = Spectrum.objects.create(
-    #     material_name=request.data['material_name'],
-    #     binary_data_file=request.FILES['binary_data_file'],
-    #     uploaded_by=request.user
-    # )
-    # # Perform any additional processing like metadata extraction if needed
-    # spectrum.save()
-    # return Response({'message': 'Spectrum uploaded successfully', 'id': spectrum.id}, status=status.HTTP_201_CREATED)
+    form = ApiUploadForm(request.data, request.FILES)
+    if not form.is_valid():
+        return Response(form.errors, status=status.HTTP_400_BAD_REQUEST)
+    binary_file = form.cleaned_data['binary_data_file']
+
+    try:
+        if idempotency_key:
+            job = find_idempotent_job(request.user, idempotency_key, binary_file)
+            if job is not None:
+                return _job_response(request, job, headers={'Idempotent-Replayed': 'true'})
+
+        # The web process only stages files; bounding each user's queue keeps bursts of uploads from piling up
+        # unbounded work (and staged files) in front of the worker pool.
+        if queued_job_count(request.user) >= max_queued_jobs():
+            return Response({'error': "Too many uploads are waiting for processing, please retry later."},
+                            status=status.HTTP_429_TOO_MANY_REQUESTS, headers={'Retry-After': '30'})
+
+        job = enqueue_upload(
+            binary_file,
+            request.user,
+            form.cleaned_data['material_name'],
+            notes=form.cleaned_data.get('notes'),
+            sample_thickness=form.cleaned_data.get('sample_thickness'),
+            link_duplicate=form.cleaned_data.get('link_duplicate', False),
+            all_measurements=form.cleaned_data.get('all_measurements', False),
+            find_similar=form.cleaned_data.get('find_similar', False),
+            metadata_overrides=form.cleaned_data.get('metadata'),
+            idempotency_key=idempotency_key,
+        )
+    except IdempotencyConflict as e:
+        return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
+    return _job_response(request, job)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def api_bulk_upload(request):
+    """
+    API endpoint to upload several .thz files (multipart field 'files', repeated) or a zip archive.
+    Returns 202 with the processing job; poll its url for the per-file report.
+    """
+    form = BulkUploadForm(request.data, request.FILES)
+    if not form.is_valid():
+        return Response(form.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    job = enqueue_bulk_upload(
+        form.cleaned_data['files'],
+        request.user,
+        material_name=form.cleaned_data.get('material_name'),
+        notes=form.cleaned_data.get('notes'),
+        sample_thickness=form.cleaned_data.get('sample_thickness'),
+        link_duplicate=form.cleaned_data.get('link_duplicate', False),
+        all_measurements=form.cleaned_data.get('all_measurements', False),
+    )
+    serializer = ProcessingJobSerializer(job, context={'request': request})
+    return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+
+def _serializer_context(request):
+    # Binary renderers (MessagePack, .npz, Arrow, Parquet) get the arrays as NumPy arrays instead of lists
+    return {'request': request, 'raw_arrays': getattr(request.accepted_renderer, 'raw_arrays', False)}
+
 
-    return Response({'message': 'API upload endpoint hit. Implement actual upload logic.'}, status=status.HTTP_200_OK)
+def _split_values(values):
+    return [part.strip() for value in values for part in str(value).split(',') if part.strip()]
+
+
+def _split_param(request, name):
+    return _split_values(request.query_params.getlist(name))
+
+
+def _split_data(request, name):
+    """A list parameter of the request body: a JSON list or string, or repeated and/or comma-separated form values."""
+    if hasattr(request.data, 'getlist'):
+        return _split_values(request.data.getlist(name))
+    values = request.data.get(name) if isinstance(request.data, dict) else None
+    if values is None:
+        return []
+    return _split_values(values if isinstance(values, list) else [values])
+
+
+def _unknown_fields_response(fields, exclude):
+    unknown = set(fields or ()).union(exclude) - set(SpectrumSerializer.Meta.fields)
+    if not unknown:
+        return None
+    return Response({'error': f"Unknown fields: {', '.join(sorted(unknown))}."}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def _spectrum_queryset(fields, exclude, frequency_range):
+    """
+    Spectra with their related objects and the selected arrays loaded in the same query.
+    With a frequency range, the processed arrays are left out: _apply_frequency_range reads them only for spectra
+    whose window is not cached. Returns (queryset, whether the frequency range applies).
+    """
+    selected = [name for name in (fields or SpectrumSerializer.Meta.fields) if name not in exclude]
+    spectra = Spectrum.objects.select_related('material', 'uploaded_by', 'processing_profile')
+    arrays = [name for name in ARRAY_FIELDS if name in selected]
+    ranged = bool(frequency_range) and any(name in PROCESSED_ARRAY_FIELDS for name in arrays)
+    if ranged:
+        arrays = [name for name in arrays if name not in PROCESSED_ARRAY_FIELDS]
+    if arrays:
+        spectra = spectra.with_arrays(*arrays)
+    if 'peaks' in selected:
+        spectra = spectra.prefetch_related('peaks')
+    return spectra, ranged
+
+
+def _frequency_range(request):
+    """
+    FrequencyRangeForm of the request's fmin/fmax/step/n_points parameters.
+    Returns (parameters, None), with empty parameters if none were given, or (None, error response).
+    """
+    form = FrequencyRangeForm(request.query_params)
+    if not form.is_valid():
+        return None, Response({'error': form.errors}, status=status.HTTP_400_BAD_REQUEST)
+    return form.parameters, None
+
+
+def _frequency_range_key(spectrum, parameters):
+    # updated_at changes whenever the spectrum is reprocessed, so stale entries are never read
+    arguments = ','.join(f'{name}={parameters[name]!r}' for name in sorted(parameters))
+    return f'spectrum-range:{spectrum.pk}:{spectrum.updated_at.timestamp()}:{arguments}'
+
+
+def _apply_frequency_range(spectra, parameters):
+    """
+    Replace the processed arrays of the spectra by their window/resampled version (see resample_spectrum).
+    Results are kept in Django's cache for SPECTRUM_RANGE_CACHE_TIMEOUT seconds; the processed arrays are only read
+    from the database, in one query, for spectra that are not cached.
+    Raises ValueError if the parameters would give too many points.
+    """
+    keys = {spectrum.pk: _frequency_range_key(spectrum, parameters) for spectrum in spectra}
+    results = cache.get_many(keys.values())
+    missing = [spectrum for spectrum in spectra if keys[spectrum.pk] not in results]
+    load_arrays([spectrum for spectrum in missing if 'frequency_data' in spectrum.get_deferred_fields()],
+                PROCESSED_ARRAY_FIELDS)
+
+    computed = {}
+    for spectrum in missing:
+        frequency, curves = resample_spectrum(
+            spectrum.frequency_data,
+            {name: getattr(spectrum, name) for name in PROCESSED_ARRAY_FIELDS if name != 'frequency_data'},
+            **parameters,
+        )
+        computed[keys[spectrum.pk]] = {'frequency_data': frequency, **curves}
+    if computed:
+        cache.set_many(computed, timeout=getattr(settings, 'SPECTRUM_RANGE_CACHE_TIMEOUT', 3600))
+    results.update(computed)
+
+    for spectrum in spectra:
+        for name, values in results[keys[spectrum.pk]].items():
+            setattr(spectrum, name, values)
+
+
+# Spectra read from the database and serialized at a time by streamed list responses
+STREAM_CHUNK_SIZE = 100
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _stream_spectra(spectra, fields, exclude, frequency_range, ranged, context):
+    """
+    Generator of a JSON array of the serialized spectra. The queryset is read with a database cursor
+    (`.iterator()`) STREAM_CHUNK_SIZE spectra at a time and serialized one by one, so memory use does not depend on
+    the number of spectra.
+    """
+    encoder = JSONEncoder()
+    # One serializer for all spectra; only one serialized spectrum exists at a time
+    serializer = SpectrumSerializer(many=True, fields=fields, exclude=exclude, context=context).child
+    separator = '['
+    for chunk in _chunks(spectra.iterator(chunk_size=STREAM_CHUNK_SIZE), STREAM_CHUNK_SIZE):
+        if ranged:
+            _apply_frequency_range(chunk, frequency_range)
+        for spectrum in chunk:
+            yield separator + encoder.encode(serializer.to_representation(spectrum))
+            separator = ','
+    yield ']' if separator == ',' else '[]'
 
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@renderer_classes(API_RENDERERS)
 def api_spectrum_list(request):
     """
-    API endpoint to list all spectra.
+    API endpoint to list spectra, cursor-paginated (`?cursor=`, `?page_size=`) and filtered with the parameters of
+    SpectrumFilterForm. Arrays are omitted unless requested: `?fields=id,material_name,frequency_data` selects
+    fields, `?exclude=url,download_url` drops them.
+    `?fmin=&fmax=` (THz) cut the processed arrays to a frequency window, `?step=` (THz) or `?n_points=` resample them
+    onto a regular grid.
+    Besides JSON, MessagePack and the columnar formats .npz, Arrow and Parquet are available
+    (`?format=` or Accept header), see spectra/renderers.py.
+    `?stream=true` returns all matching spectra, unpaginated, as a streamed JSON array (e.g. for mirrors).
+    `?q=` is a full-text search (spectra/search.py); its results come best match first.
+    `?sort=` orders by a summary column instead (e.g. `-max_absorption`), see SpectrumFilterForm.
+    `?facets=true` adds the counts of the matching spectra per material, uploader, upload month and common metadata
+    value (`facets`, see spectra/facets.py).
     """
-    spectra = Spectrum.objects.all()  # Or filter as needed, e.g., by user
-    serializer = SpectrumSerializer(spectra, many=True, context={'request': request})
-    return Response(serializer.data)
+    frequency_range, error = _frequency_range(request)
+    if error is not None:
+        return error
+    fields = _split_param(request, 'fields') or None
+    exclude = _split_param(request, 'exclude')
+    error = _unknown_fields_response(fields, exclude)
+    if error is not None:
+        return error
+    if fields is None:
+        exclude = set(exclude).union(ARRAY_FIELDS)
+
+    spectra, ranged = _spectrum_queryset(fields, exclude, frequency_range)
+    filter_form = SpectrumFilterForm(request.query_params or None)
+    spectra = filter_form.filter_queryset(spectra)
+    ordering = filter_form.ordering
+    if ordering is None and 'search_rank' in spectra.query.annotations:
+        # Full-text search results, best match first
+        ordering = ('search_rank', '-id')
+
+    if request.query_params.get('stream', '').lower() in ('1', 'true', 'yes'):
+        if request.accepted_renderer.format not in ('json', 'api'):
+            return Response({'error': "Streamed lists are only available as JSON."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return StreamingHttpResponse(
+            _stream_spectra(spectra.order_by(*ordering or ('-id',)), fields, exclude,
+                            frequency_range, ranged, {'request': request, 'raw_arrays': False}),
+            content_type='application/json',
+        )
+
+    paginator = SpectrumSortedPagination(ordering) if ordering else SpectrumCursorPagination()
+    page = paginator.paginate_queryset(spectra, request)
+    if ranged:
+        try:
+            _apply_frequency_range(page, frequency_range)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    serializer = SpectrumSerializer(page, many=True, fields=fields, exclude=exclude,
+                                    context=_serializer_context(request))
+    response = paginator.get_paginated_response(serializer.data)
+    if request.query_params.get('facets', '').lower() in ('1', 'true', 'yes'):
+        response.data['facets'] = facet_counts(filter_form, spectra)
+    return response
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@renderer_classes(API_RENDERERS)
+def api_spectrum_batch(request):
+    """
+    API endpoint to fetch many spectra with one request and one query, e.g. for comparison tools.
+    POST `{"ids": [1, 2, 3], "fields": ["id", "frequency_data"], "exclude": []}` (JSON lists or comma-separated
+    strings; form data works as well). All fields are returned unless `fields`/`exclude` are given.
+    Returns `{"results": [...], "missing": [...]}`, with the spectra in the order of `ids` and the ids that do not
+    exist. At most API_BATCH_MAX_IDS ids per request. Takes the fmin/fmax/step/n_points query parameters, and all
+    formats of the list (`?format=` or Accept header).
+    """
+    frequency_range, error = _frequency_range(request)
+    if error is not None:
+        return error
+    try:
+        ids = list(dict.fromkeys(int(value) for value in _split_data(request, 'ids')))
+    except ValueError:
+        return Response({'error': "'ids' must be a list of spectrum ids."}, status=status.HTTP_400_BAD_REQUEST)
+    max_ids = getattr(settings, 'API_BATCH_MAX_IDS', 1000)
+    if not ids or len(ids) > max_ids:
+        return Response({'error': f"Between 1 and {max_ids} spectrum ids are required."},
+                        status=status.HTTP_400_BAD_REQUEST)
+    fields = _split_data(request, 'fields') or None
+    exclude = _split_data(request, 'exclude')
+    error = _unknown_fields_response(fields, exclude)
+    if error is not None:
+        return error
+
+    spectra, ranged = _spectrum_queryset(fields, exclude, frequency_range)
+    by_pk = spectra.in_bulk(ids)
+    found = [by_pk[pk] for pk in ids if pk in by_pk]
+    if ranged:
+        try:
+            _apply_frequency_range(found, frequency_range)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    serializer = SpectrumSerializer(found, many=True, fields=fields, exclude=exclude,
+                                    context=_serializer_context(request))
+    return Response({'results': serializer.data, 'missing': [pk for pk in ids if pk not in by_pk]})
 
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@renderer_classes(API_RENDERERS)
 def api_spectrum_detail(request, pk):
     """
     API endpoint to retrieve a single spectrum's details.
+    Takes the same fmin/fmax/step/n_points parameters as the list.
+    Besides JSON, MessagePack, .npz, Arrow and Parquet are available (`?format=` or Accept header).
     """
+    frequency_range, error = _frequency_range(request)
+    if error is not None:
+        return error
+    spectra = Spectrum.objects.select_related('material', 'uploaded_by', 'processing_profile')
+    # With a frequency range, the processed arrays are only read if the window is not cached
+    spectra = spectra.with_arrays(*RAW_ARRAY_FIELDS) if frequency_range else spectra.with_arrays()
     try:
-        spectrum = Spectrum.objects.get(pk=pk)
+        spectrum = spectra.get(pk=pk)
     except Spectrum.DoesNotExist:
         return Response({'error': 'Spectrum not found.'}, status=status.HTTP_404_NOT_FOUND)
+    if frequency_range:
+        try:
+            _apply_frequency_range([spectrum], frequency_range)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    serializer = SpectrumSerializer(spectrum, context=_serializer_context(request))
+    return Response(serializer.data)
+
+
+def _similarity_response(request, query_rows, options, exclude=()):
+    try:
+        matches, band = search_similar(query_rows, exclude=exclude, **options)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({
+        'metric': options['metric'],
+        'curves': list(options['curves']),
+        'band': band,
+        'results': [
+            {
+                'id': spectrum.pk,
+                'material_name': spectrum.material.name,
+                'score': score,
+                'url': request.build_absolute_uri(reverse('spectra:api_spectrum_detail', kwargs={'pk': spectrum.pk})),
+            }
+            for spectrum, score in matches
+        ],
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def api_similar_spectra(request, pk):
+    """
+    API endpoint listing the library spectra most similar to a stored spectrum, see spectra/similarity.py.
+    `?k=` results (default 10), `?metric=cosine|correlation|l2`, `?curves=both|refractive_index|absorption_coefficient`,
+    `?fmin=&fmax=` band in THz.
+    """
+    form = SimilarityQueryForm(request.query_params)
+    if not form.is_valid():
+        return Response({'error': form.errors}, status=status.HTTP_400_BAD_REQUEST)
+    spectrum = Spectrum.objects.filter(pk=pk).first()
+    if spectrum is None:
+        return Response({'error': 'Spectrum not found.'}, status=status.HTTP_404_NOT_FOUND)
+    # Indexed spectra are compared with their index rows, without reading their arrays
+    query_rows = get_similarity_index().spectrum_rows(pk) or spectrum_rows(similarity_grid(), spectrum)
+    return _similarity_response(request, query_rows, form.options, exclude=[spectrum.pk])
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def api_similarity_search(request):
+    """
+    API endpoint to find the library spectra most similar to a measurement that is not stored: either a .thz file
+    (multipart 'file', with 'sample_thickness' if its metadata has none), processed like an upload, or the
+    processed curves as JSON lists ('frequency' in THz, 'refractive_index', 'absorption_coefficient').
+    Takes the options of `api/spectra/<id>/similar/` as query parameters.
+    """
+    form = SimilarityQueryForm(request.query_params)
+    if not form.is_valid():
+        return Response({'error': form.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+    if 'file' in request.FILES:
+        try:
+            sample_thickness = float(request.data['sample_thickness']) if request.data.get('sample_thickness') else None
+            spectral_data_dict, _ = parse_thz_file(request.FILES['file'], 'query', sample_thickness=sample_thickness)
+        except ValueError:
+            return Response({'error': "'sample_thickness' must be a number (mm)."}, status=status.HTTP_400_BAD_REQUEST)
+        except forms.ValidationError as e:
+            return Response({'error': ' '.join(e.messages)}, status=status.HTTP_400_BAD_REQUEST)
+        # The parsed data uses the curve names of the index
+        frequency, curves = spectral_data_dict['frequency'], spectral_data_dict
+    else:
+        try:
+            frequency = np.asarray(request.data.get('frequency') or [], dtype=np.float64)
+            curves = {name: np.asarray(request.data.get(name) or [], dtype=np.float64) for name in SIMILARITY_CURVES}
+        except (TypeError, ValueError):
+            return Response({'error': "'frequency' and the curves must be lists of numbers."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if frequency.ndim != 1 or len(frequency) < 2 or np.any(np.diff(frequency) <= 0):
+            return Response({'error': "Send a .thz 'file', or 'frequency' (ascending, in THz) with the curves."},
+                            status=status.HTTP_400_BAD_REQUEST)
+    return _similarity_response(request, curve_rows(similarity_grid(), frequency, curves), form.options)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def api_processing_job(request, pk):
+    """
+    API endpoint to poll the status of an upload processing job.
+    """
+    try:
+        job = ProcessingJob.objects.get(pk=pk, uploaded_by=request.user)
+    except ProcessingJob.DoesNotExist:
+        return Response({'error': 'Processing job not found.'}, status=status.HTTP_404_NOT_FOUND)
 
-    serializer = SpectrumSerializer(spectrum, context={'request': request})
+    serializer = ProcessingJobSerializer(job, context={'request': request})
     return Response(serializer.data)
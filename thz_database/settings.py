@@ -97,6 +97,59 @@ DATABASES = {
 STATIC_URL = "static/"
 STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
 
+MEDIA_URL = "media/"
+MEDIA_ROOT = BASE_DIR / "media"
+
+# Uploaded .thz files waiting for processing (see spectra/staging.py). Not below MEDIA_ROOT, which is publicly served.
+STAGED_UPLOAD_ROOT = BASE_DIR / "staged_uploads"
+# Staged files older than this many seconds are removed by `manage.py cleanup_staged_uploads`
+STAGED_UPLOAD_TTL = 24 * 3600
+
+# Disk cache of processing results, keyed by raw data hash, thickness and processing parameters
+# (see spectra/processing_cache.py). Least recently used entries are evicted beyond the size limit; None disables it.
+PROCESSING_CACHE_ROOT = BASE_DIR / "processing_cache"
+PROCESSING_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Cached dotTHz exports of single spectra (see spectra/export.py); None disables the cache
+EXPORT_CACHE_ROOT = BASE_DIR / "export_cache"
+
+# Seconds that frequency windows/resampled arrays of the spectrum API (?fmin=&fmax=&step=&n_points=) stay in
+# Django's cache (see CACHES; the default is a per-process in-memory cache)
+SPECTRUM_RANGE_CACHE_TIMEOUT = 3600
+
+# Spectral similarity search (see spectra/similarity.py): curves are resampled onto np.linspace(*SIMILARITY_GRID)
+# (fmin THz, fmax THz, points). The index is memory-mapped from SIMILARITY_INDEX_ROOT; None keeps it in memory.
+SIMILARITY_GRID = (0.1, 4.0, 391)
+SIMILARITY_INDEX_ROOT = BASE_DIR / "similarity_index"
+
+# Full-text search (`?q=`, see spectra/search.py): metadata fields indexed besides material name, description and
+# notes
+SEARCH_METADATA_FIELDS = ('content', 'description', 'instrument', 'institution', 'mode', 'measurement')
+
+# Facet counts of the spectrum list (see spectra/facets.py): metadata keys counted besides material, uploader and
+# upload month, seconds the counts stay in Django's cache (they are renewed on upload) and the time all facets of a
+# request may take before their queries are interrupted
+FACET_METADATA_KEYS = ('instrument', 'institution', 'mode')
+FACET_CACHE_TIMEOUT = 600
+FACET_TIME_BUDGET = 0.5
+
+# ChemSpider lookups, see spectra/chemspider.py. Use 'spectra.chemspider.FixtureChemSpiderBackend' together with
+# CHEMSPIDER_FIXTURES (a JSON file, see `manage.py export_chemspider_fixture`) for tests and air-gapped deployments.
+CHEMSPIDER_BACKEND = 'spectra.chemspider.LiveChemSpiderBackend'
+CHEMSPIDER_FIXTURES = None
+CHEMSPIDER_TIMEOUT = 10  # seconds per request and per name search
+CHEMSPIDER_CACHE_TTL = None  # cached results never expire
+CHEMSPIDER_NEGATIVE_TTL = 7 * 24 * 3600  # searches without a result are retried after a week
+
+# Uploads through `api/upload/` are refused (429) while the user has this many pending or running processing jobs
+API_UPLOAD_MAX_QUEUED_JOBS = 50
+
+# Largest number of spectrum ids accepted by `api/spectra/batch/` per request
+API_BATCH_MAX_IDS = 1000
+
+# Number of worker processes used by `manage.py process_jobs` (defaults to the number of CPUs)
+PROCESSING_WORKERS = None
+
 # # Add STATICFILES_DIRS to tell Django where to find project-level static files
 STATICFILES_DIRS = [
     BASE_DIR / "static",  # If 'static' is in your project root (BASE_DIR)
@@ -112,5 +165,14 @@ LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'spectra:home'
 LOGOUT_REDIRECT_URL = 'spectra:home'
 
+# The API accepts the token shown on the home page (`Authorization: Token <key>`) besides the browser session
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'rest_framework.authentication.TokenAuthentication',
+        'rest_framework.authentication.SessionAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ],
+}
+
 # Database: Ensure your database supports JSONField (e.g., PostgreSQL, SQLite 3.38+ with Django 4.1+)
 # DATABASES = { ... }